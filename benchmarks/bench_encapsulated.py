@@ -0,0 +1,104 @@
+"""Throughput of `Instance.deidentify` on encapsulated pixel data, checking that it is never decoded.
+
+Writes multi-frame instances with JPEG, JPEG 2000 and RLE transfer syntaxes, each with a Basic
+Offset Table and one fragment per frame, then de-identifies them both streaming and not. Every
+pydicom entry point that decodes or encodes pixel data - pixel data handlers, `convert_pixel_data`,
+`decompress` and `compress` - is replaced with a tripwire that fails the run if called, and the
+encapsulated pixel data of every output is compared byte-for-byte with its input, e.g.:
+
+    python benchmarks/bench_encapsulated.py --frames 40 --frame_size 1
+
+Fragments hold random bytes, so any attempt to decode them would fail outright as well.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pydicom
+from pydicom import config
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import JPEGBaseline8Bit
+from pydicom.uid import JPEG2000Lossless
+from pydicom.uid import RLELossless
+
+from corpus import make_dataset
+
+
+TRANSFER_SYNTAXES = (JPEGBaseline8Bit, JPEG2000Lossless, RLELossless)
+
+calls = []
+
+
+def _tripwire(name: str):
+    def tripped(*args, **kwargs):
+        calls.append(name)
+        raise AssertionError(f'{name} was called, pixel data must never be decoded or encoded')
+    return tripped
+
+
+def install_tripwires() -> None:
+    """Makes every pixel data decode and encode entry point of pydicom fail loudly."""
+    for handler in config.pixel_data_handlers:
+        handler.get_pixeldata = _tripwire(f'{handler.__name__}.get_pixeldata')
+    for name in ('convert_pixel_data', 'decompress', 'compress'):
+        if hasattr(Dataset, name):
+            setattr(Dataset, name, _tripwire(f'Dataset.{name}'))
+
+
+def write_instance(path: Path, syntax: str, frames: int, frame_size: int) -> None:
+    """Writes a multi-frame instance of random fragments with a Basic Offset Table."""
+    ds = make_dataset(rows=64, pixels=True)
+    ds.file_meta.TransferSyntaxUID = syntax
+    ds.NumberOfFrames = frames
+    ds.PixelData = encapsulate([os.urandom(frame_size) for _ in range(frames)], has_bot=True)
+    ds['PixelData'].VR = 'OB'
+    ds['PixelData'].is_undefined_length = True
+    ds.save_as(path, write_like_original=False)
+
+
+def main(args: argparse.Namespace) -> None:
+    from deidcm.instance import Instance
+
+    install_tripwires()
+    frame_size = int(args.frame_size * (1 << 20))
+    with tempfile.TemporaryDirectory() as scratch:
+        scratch = Path(scratch)
+        for syntax in TRANSFER_SYNTAXES:
+            sources = []
+            for idx in range(args.count):
+                sources.append(scratch / f'{syntax.name.split()[0]}{idx}.dcm')
+                write_instance(sources[-1], syntax, args.frames, frame_size)
+            size = sum(path.stat().st_size for path in sources)
+            for stream in (False, True):
+                start = time.perf_counter()
+                outputs = []
+                for path in sources:
+                    outputs.append(path.with_suffix('.out.dcm'))
+                    Instance(path).deidentify(False, stream, outputs[-1])
+                seconds = time.perf_counter() - start
+                for source, output in zip(sources, outputs):
+                    original, deidentified = dcmread(source), dcmread(output)
+                    assert deidentified.file_meta.TransferSyntaxUID == syntax, f'{output} changed transfer syntax'
+                    assert deidentified.PixelData == original.PixelData, f'{output} changed encapsulated pixel data'
+                    assert 'PatientName' not in deidentified, f'{output} was not de-identified'
+                mode = 'stream' if stream else 'full'
+                print(f'{syntax.name:>40} {mode:>6}: {size / seconds / (1 << 20):10.1f} MB/s, '
+                    f'{args.count} x {args.frames} fragments identical')
+    print(f'pydicom {pydicom.__version__}: no pixel data handler or encoder was invoked ({len(calls)} calls)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=5, help='instances per transfer syntax')
+    parser.add_argument('-f', '--frames', type=int, default=20, help='frames, i.e. fragments, per instance')
+    parser.add_argument('-s', '--frame_size', type=float, default=1.0, help='size of each fragment in MB')
+    main(parser.parse_args())
@@ -0,0 +1,82 @@
+"""Deidentifier against AsyncDeidentifier on a local corpus with injected storage latency.
+
+Network file systems add a round trip to every directory listing, stat, open and mkdir. To
+emulate one locally, this benchmark wraps those calls with a fixed sleep in the benchmark
+process only, then times `Deidentifier.run` and `AsyncDeidentifier.run` on the same corpus
+shape, e.g.:
+
+    python benchmarks/bench_latency.py --corpus bench_corpus --shape series --latency 2 --concurrency 16
+
+Pool workers are separate processes and are not slowed down, as they only filter in-memory
+data in the asyncio front end; use the default single worker for comparable numbers.
+"""
+from __future__ import annotations
+
+import io
+import os
+import sys
+import time
+import builtins
+import argparse
+import tempfile
+from pathlib import Path
+from functools import wraps
+from collections import namedtuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from corpus import generate
+
+
+Args = namedtuple('Args', 'InputDirectory skip_private_tags no_bundled_output workers stream output_directory concurrency')
+
+
+def _delayed(func, latency: float):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        time.sleep(latency)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def inject_latency(latency: float) -> None:
+    """Adds `latency` seconds to every file system round trip made in this process."""
+    for module, name in ((builtins, 'open'), (io, 'open'), (os, 'open'), (os, 'scandir'), (os, 'stat'),
+            (os, 'mkdir'), (os, 'listdir')):
+        setattr(module, name, _delayed(getattr(module, name), latency))
+
+
+def time_run(cls: type, input_dir: Path, workers: int, concurrency: int) -> float:
+    with tempfile.TemporaryDirectory() as scratch:
+        start = time.perf_counter()
+        cls.create(Args(str(input_dir), False, False, workers, False, str(Path(scratch) / 'output'), concurrency)).run()
+        return time.perf_counter() - start
+
+
+def main(args: argparse.Namespace) -> None:
+    from deidcm.deidentifier import Deidentifier
+    from deidcm.aio import AsyncDeidentifier
+
+    corpus = Path(args.corpus).resolve()
+    if not (corpus / 'corpus.json').is_file():
+        generate(corpus, args.scale)
+    input_dir = corpus / args.shape
+    files = sum(1 for path in input_dir.rglob('*') if path.is_file())
+    inject_latency(args.latency / 1000)
+    print(f'{args.shape}: {files} files, {args.latency} ms per file system call')
+    timings = {}
+    for cls in (Deidentifier, AsyncDeidentifier):
+        timings[cls] = time_run(cls, input_dir, args.workers, args.concurrency)
+        print(f'{cls.__name__:>20}: {timings[cls]:8.2f} s {files / timings[cls]:10.1f} files/s')
+    print(f'{"speedup":>20}: {timings[Deidentifier] / timings[AsyncDeidentifier]:8.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--corpus', type=str, default='bench_corpus', help='corpus directory, generated if missing')
+    parser.add_argument('--scale', type=int, default=1, help='corpus scale, see corpus.py')
+    parser.add_argument('--shape', type=str, default='series', help='corpus shape to de-identify')
+    parser.add_argument('-l', '--latency', type=float, default=2.0, help='injected latency per call, in ms')
+    parser.add_argument('-a', '--concurrency', type=int, default=16, help='concurrency of the asyncio front end')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='deidentifier worker processes')
+    main(parser.parse_args())
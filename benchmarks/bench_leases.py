@@ -0,0 +1,93 @@
+"""Sharded batch over a shared `LeaseStore` with several local worker processes, one of them killed mid-run.
+
+Fills a local input bucket with copies of the zipped studies of the corpus, queues them in a
+lease store, and starts `--workers` worker processes taking studies from it, as separate nodes
+would. Once studies start completing, one worker is killed without warning, so that its leases
+expire and its studies are picked up by the others. The coordinator waits for the queue to drain,
+then checks that every study was uploaded exactly once as done, and prints the aggregated run
+report, e.g.:
+
+    python benchmarks/bench_leases.py --corpus bench_corpus --studies 24 --workers 3
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from corpus import generate
+
+
+def work(store_path: str, bucket_root: str, scratch: str, lease_seconds: float) -> None:
+    """Runs a worker until the queue is empty, as a node of its own would."""
+    from deidcm.batch import LocalBucket
+    from deidcm.lease import LeaseStore
+    from deidcm.lease import LeasedBatchRunner
+
+    store = LeaseStore(store_path, lease_seconds)
+    runner = LeasedBatchRunner(store, LocalBucket(Path(bucket_root) / 'in'), LocalBucket(Path(bucket_root) / 'out'),
+        scratch, poll_interval=0.2)
+    runner.run()
+
+
+def main(args: argparse.Namespace) -> None:
+    from deidcm.batch import load_studies
+    from deidcm.lease import LeaseStore
+
+    corpus = Path(args.corpus).resolve()
+    if not (corpus / 'corpus.json').is_file():
+        generate(corpus)
+    archives = sorted((corpus / 'archives').glob('*.zip'))
+    with tempfile.TemporaryDirectory() as scratch:
+        scratch = Path(scratch)
+        (scratch / 'in' / 'dicom').mkdir(parents=True)
+        records = []
+        for idx in range(args.studies):
+            shutil.copyfile(archives[idx % len(archives)], scratch / 'in' / 'dicom' / f'{idx:05}.zip')
+            records.append({'DICOM': f'dicom/{idx:05}.zip'})
+        (scratch / 'gore.json').write_text(json.dumps(records))
+        store = LeaseStore(scratch / 'leases.db', args.lease_seconds)
+        store.populate(load_studies(scratch / 'gore.json'))
+
+        start = time.perf_counter()
+        workers = [multiprocessing.Process(target=work, args=(str(scratch / 'leases.db'), str(scratch),
+            str(scratch / f'scratch{idx}'), args.lease_seconds)) for idx in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        killed = None
+        while args.kill and killed is None and store.report()['states'].get('done', 0) < args.studies // 4:
+            time.sleep(0.1)
+        if args.kill:
+            killed = workers[0]
+            os.kill(killed.pid, signal.SIGKILL)
+            print(f'killed worker {killed.pid} with {store.report()["states"]} studies')
+        report = store.wait(poll_interval=0.5)
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - start
+        outputs = sorted(path.name for path in (scratch / 'out').iterdir())
+
+    assert report['states'] == {'done': args.studies}, f'studies not all done: {report["states"]}'
+    assert outputs == [f'study{idx:03}.zip' for idx in range(args.studies)], 'outputs missing'
+    print(json.dumps({name: report[name] for name in ('states', 'wall_seconds', 'stages', 'failures')}, indent=2))
+    print(f'{args.studies} studies over {args.workers} workers in {seconds:.2f} s, '
+        f'{args.studies / seconds:.2f} studies/s, {len(report["workers"])} workers reported')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--corpus', type=str, default='bench_corpus', help='corpus directory, generated if missing')
+    parser.add_argument('-n', '--studies', type=int, default=24, help='studies in the batch')
+    parser.add_argument('-w', '--workers', type=int, default=3, help='worker processes')
+    parser.add_argument('-l', '--lease_seconds', type=float, default=2.0, help='lease time without a heartbeat')
+    parser.add_argument('--no_kill', dest='kill', action='store_false', help='let all workers finish')
+    main(parser.parse_args())
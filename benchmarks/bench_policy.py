@@ -0,0 +1,44 @@
+"""Micro-benchmark of the per-element keep-list filter cost.
+
+Compares the former keyword list scan against the compiled `TagPolicy` membership check, over
+all tags of a synthetic header, e.g.:
+
+    python benchmarks/bench_policy.py --repeat 200
+"""
+import sys
+import argparse
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pydicom.tag import Tag
+from pydicom.datadict import DicomDictionary
+
+from deidcm.policy import TagPolicy
+from deidcm.utils import parse_tag_config
+
+
+def main(repeat: int) -> None:
+    keywords = parse_tag_config('keep')
+    policy = TagPolicy.compile(keywords)
+    tags = [Tag(tag) for tag in sorted(DicomDictionary) if tag >> 16 not in (0x0002, 0xFFFE)][:300]
+
+    def list_scan():
+        return [tag for tag in tags if tag not in keywords]
+
+    def compiled():
+        return [tag for tag in tags if tag not in policy]
+
+    assert list_scan() == compiled()
+    n = repeat * len(tags)
+    for name, func in (('keyword list scan', list_scan), ('compiled policy', compiled)):
+        seconds = min(timeit.repeat(func, number=repeat, repeat=3))
+        print(f'{name:>20}: {seconds / n * 1e9:10.1f} ns/element')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', type=int, default=20, help='passes over the synthetic header')
+    args = parser.parse_args()
+    main(args.repeat)
@@ -0,0 +1,133 @@
+"""Throughput of `StoreSCP` relaying over loopback, against storing, de-identifying and forwarding files.
+
+Sends a series of instances from loopback SCUs, over several concurrent associations, first to a
+plain storage SCP that writes what it receives to disk, after which `Deidentifier` is run on the
+stored files and its outputs are forwarded to a sink SCP, then to `StoreSCP` forwarding straight
+to the sink. Every forwarded instance is checked to be de-identified, and the output directory
+of the receiver to stay free of received data, e.g.:
+
+    python benchmarks/bench_scp.py --count 200 --associations 4 --workers 2
+"""
+from __future__ import annotations
+
+import io
+import sys
+import time
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from collections import namedtuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pydicom import dcmread
+from pydicom.uid import CTImageStorage
+from pydicom.uid import ExplicitVRLittleEndian
+from pydicom.uid import generate_uid
+from pydicom.filewriter import write_file_meta_info
+from pynetdicom import AE
+from pynetdicom import evt
+
+from corpus import make_dataset
+
+
+Args = namedtuple('Args', 'InputDirectory skip_private_tags no_bundled_output workers stream output_directory')
+
+PORT = 11150
+
+
+def storage_ae(port: int, handler) -> object:
+    ae = AE(ae_title='SINK')
+    ae.add_supported_context(CTImageStorage, ExplicitVRLittleEndian)
+    return ae.start_server(('127.0.0.1', port), block=False, evt_handlers=[(evt.EVT_C_STORE, handler)])
+
+
+def send(datasets: list, port: int, associations: int) -> None:
+    """Sends datasets, or files, over a number of concurrent associations."""
+    def worker(chunk):
+        ae = AE(ae_title='MODALITY')
+        ae.add_requested_context(CTImageStorage, ExplicitVRLittleEndian)
+        assoc = ae.associate('127.0.0.1', port, ae_title='DEIDCM')
+        assert assoc.is_established, 'association rejected'
+        for ds in chunk:
+            status = assoc.send_c_store(ds)
+            assert status.Status == 0, f'C-STORE failed with status 0x{status.Status:04X}'
+        assoc.release()
+
+    threads = [threading.Thread(target=worker, args=(datasets[idx::associations],)) for idx in range(associations)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def main(args: argparse.Namespace) -> None:
+    from deidcm.deidentifier import Deidentifier
+    from deidcm.scp import StoreSCP
+
+    study = generate_uid()
+    datasets = []
+    for _ in range(args.count):
+        ds = make_dataset(rows=args.rows, study_uid=study)
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        datasets.append(ds)
+    size = sum(len(ds.PixelData) for ds in datasets)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        scratch = Path(scratch)
+        received = scratch / 'received'
+        received.mkdir()
+
+        def store(event):
+            with open(received / f'{event.request.AffectedSOPInstanceUID}.dcm', 'wb') as handler:
+                handler.write(b'\x00' * 128 + b'DICM')
+                write_file_meta_info(handler, event.file_meta)
+                handler.write(event.request.DataSet.getvalue())
+            return 0x0000
+
+        server = storage_ae(PORT, store)
+        start = time.perf_counter()
+        send(datasets, PORT, args.associations)
+        Deidentifier.create(Args(str(received), False, False, args.workers, False, str(scratch / 'output'))).run()
+        forwarded = []
+
+        def sink(event):
+            forwarded.append(event.request.DataSet.getvalue())
+            return 0x0000
+
+        sink_server = storage_ae(PORT + 1, sink)
+        send([str(path) for path in sorted((scratch / 'output').rglob('*.dcm'))], PORT + 1, args.associations)
+        disk_seconds = time.perf_counter() - start
+        server.shutdown()
+        assert len(forwarded) == args.count, f'{len(forwarded)} of {args.count} stored instances forwarded'
+        forwarded.clear()
+
+        empty = scratch / 'empty'
+        empty.mkdir()
+        deidentifier = Deidentifier.create(Args(str(empty), False, False, args.workers, False, str(empty)))
+        receiver = StoreSCP(deidentifier, PORT + 2, forward=f'SINK@127.0.0.1:{PORT + 1}', store=False)
+        receiver.start()
+        start = time.perf_counter()
+        send(datasets, PORT + 2, args.associations)
+        scp_seconds = time.perf_counter() - start
+        receiver.stop()
+        sink_server.shutdown()
+        assert not any(empty.iterdir()), 'received data was written to disk'
+
+    assert len(forwarded) == args.count, f'{len(forwarded)} of {args.count} instances forwarded'
+    for data in forwarded:
+        ds = dcmread(io.BytesIO(data), force=True)
+        assert 'PatientName' not in ds and 'PatientID' not in ds, 'forwarded instance was not de-identified'
+    for name, seconds in (('store, deidentify, send', disk_seconds), ('StoreSCP, forwarding', scp_seconds)):
+        print(f'{name:>26}: {seconds:8.2f} s {args.count / seconds:8.1f} instances/s {size / seconds / (1 << 20):8.1f} MB/s')
+    print(f'{"speedup":>26}: {disk_seconds / scp_seconds:8.2f}x, {args.count} forwarded instances de-identified')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=200, help='instances to send')
+    parser.add_argument('-r', '--rows', type=int, default=256, help='rows and columns of each instance')
+    parser.add_argument('-a', '--associations', type=int, default=4, help='concurrent associations')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='deidentifier worker processes')
+    main(parser.parse_args())
@@ -0,0 +1,200 @@
+"""Synthetic DICOM corpus generator for the benchmarks.
+
+Writes one input directory per shape, each usable as `InputDirectory` of the deidentifier:
+
+    singles/       stand-alone instances
+    series/        flat series directories
+    dicomdir/      studies in DICOMDIR format
+    archives/      zipped studies with nested directories, archives within archives are copied over as they are
+    multiframe/    large multi-frame objects
+    small_files/   deep trees of many small instances without pixel data
+    sf/            selection and screening form PDFs of both versions, only if PyMuPDF is installed
+
+e.g.:
+
+    python benchmarks/corpus.py bench_corpus --scale 2
+"""
+import json
+import shutil
+import argparse
+from pathlib import Path
+
+from pydicom.dataset import Dataset
+from pydicom.dataset import FileMetaDataset
+from pydicom.fileset import FileSet
+from pydicom.uid import CTImageStorage
+from pydicom.uid import ExplicitVRLittleEndian
+from pydicom.uid import generate_uid
+
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+
+SHAPES = ('singles', 'series', 'dicomdir', 'archives', 'multiframe', 'small_files', 'sf')
+
+
+def make_dataset(rows: int = 256, frames: int = 1, pixels: bool = True, study_uid: str = None,
+    series_uid: str = None, number: int = 1) -> Dataset:
+    """Creates a CT-like dataset with identifying attributes, private tags and optional pixel data."""
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = CTImageStorage
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study_uid or generate_uid()
+    ds.SeriesInstanceUID = series_uid or generate_uid()
+    ds.PatientName = 'DOE^JOHN'
+    ds.PatientID = '123456'
+    ds.PatientBirthDate = '19700101'
+    ds.InstitutionName = 'GENERAL HOSPITAL'
+    ds.ReferringPhysicianName = 'SMITH^JANE'
+    ds.StudyDate, ds.StudyTime, ds.StudyID = '20200101', '120000', '1'
+    ds.Modality = 'CT'
+    ds.SeriesNumber, ds.InstanceNumber = 1, number
+    ds.add_new(0x00090010, 'LO', 'ACME')
+    ds.add_new(0x00091010, 'LO', 'private value')
+    if pixels:
+        ds.Rows = ds.Columns = rows
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+        ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, 'MONOCHROME2'
+        if frames > 1:
+            ds.NumberOfFrames = frames
+        size = rows * rows * 2 * frames
+        ds.PixelData = (bytes(range(256)) * (size // 256 + 1))[:size]
+    return ds
+
+
+def write_series(path: Path, count: int, rows: int = 256, pixels: bool = True) -> list:
+    """Writes a series of instances into a directory."""
+    path.mkdir(parents=True, exist_ok=True)
+    study_uid, series_uid = generate_uid(), generate_uid()
+    datasets = []
+    for number in range(1, count + 1):
+        ds = make_dataset(rows, pixels=pixels, study_uid=study_uid, series_uid=series_uid, number=number)
+        ds.save_as(path / f'IM{number:05}.dcm', write_like_original=False)
+        datasets.append(ds)
+    return datasets
+
+
+def write_singles(root: Path, scale: int) -> None:
+    root.mkdir(parents=True)
+    for idx in range(20 * scale):
+        make_dataset().save_as(root / f'single{idx:04}.dcm', write_like_original=False)
+
+
+def write_flat_series(root: Path, scale: int) -> None:
+    for idx in range(2 * scale):
+        write_series(root / f'series{idx:02}', 50)
+        (root / f'series{idx:02}' / 'notes.txt').write_text('non-DICOM file copied over')
+
+
+def write_dicomdir(root: Path, scale: int) -> None:
+    for idx in range(scale):
+        study = root / f'patient{idx:02}'
+        study_uid = generate_uid()
+        fileset = FileSet()
+        for series in range(3):
+            series_uid = generate_uid()
+            for number in range(1, 21):
+                fileset.add(make_dataset(study_uid=study_uid, series_uid=series_uid, number=number))
+        fileset.write(study)
+
+
+def write_archives(root: Path, scale: int) -> None:
+    root.mkdir(parents=True)
+    staging = root / 'staging'
+    for idx in range(2 * scale):
+        for series in range(3):
+            write_series(staging / f'study{idx:02}' / f'exam{series}' / 'images', 20)
+        (staging / f'study{idx:02}' / 'report.txt').write_text('non-DICOM file copied over')
+        shutil.make_archive(str(root / f'study{idx:02}'), 'zip', staging)
+        shutil.rmtree(staging)
+
+
+def write_multiframe(root: Path, scale: int) -> None:
+    root.mkdir(parents=True)
+    for idx in range(2 * scale):
+        make_dataset(rows=512, frames=50).save_as(root / f'multiframe{idx:02}.dcm', write_like_original=False)
+
+
+def write_small_files(root: Path, scale: int) -> None:
+    for top in range(scale):
+        for branch in range(10):
+            write_series(root / f'tree{top:02}' / f'level{branch:02}' / 'leaf', 100, pixels=False)
+
+
+SF_NAMES = ('DOE JOHN', 'SMITH JANE ELIZABETH', 'LI WEI', 'MARTINEZ-GARCIA ANA MARIA', 'OBI CHUKWUEMEKA')
+
+
+def sf_lines(version: str, idx: int) -> list:
+    """Text lines of a synthetic selection ('new') or screening ('old') form, with varying PHI."""
+    name = SF_NAMES[idx % len(SF_NAMES)]
+    patient_id = f'{100000 + idx * 7919 % 900000}'
+    date = f'{idx % 12 + 1:02}/{idx % 28 + 1:02}/2020'
+    if version == 'new':
+        return ['Device Selection Form', f'Patient ID: {patient_id}', f'Patient Name: {name}', 'Case Date:', date,
+            'Physician: SMITH JANE', 'Device: ACME 3000']
+    return ['Patient Screening Form', f'Patient Name: {name}', f'Patient ID: {patient_id}', f'Date of Birth: 01/01/19{50 + idx % 50}',
+        'Procedure Date:', date, 'Physician: SMITH JANE', 'Implant: ACME 2000']
+
+
+def write_sf(root: Path, scale: int) -> None:
+    """Writes selection and screening forms of both versions, each on the same layout with varying PHI."""
+    if fitz is None:
+        return
+    root.mkdir(parents=True)
+    for idx in range(10 * scale):
+        version = 'new' if idx % 2 == 0 else 'old'
+        document = fitz.open()
+        for _ in range(3):
+            page = document.new_page()
+            for number, line in enumerate(sf_lines(version, idx)):
+                page.insert_text((72, 72 + 20 * number), line)
+        document.save(root / f'sf{idx:03}_{version}.pdf')
+
+
+WRITERS = {
+    'singles': write_singles,
+    'series': write_flat_series,
+    'dicomdir': write_dicomdir,
+    'archives': write_archives,
+    'multiframe': write_multiframe,
+    'small_files': write_small_files,
+    'sf': write_sf,
+}
+
+
+def generate(root: Path, scale: int = 1) -> dict:
+    """Generates all corpus shapes under root, replacing any previous corpus.
+
+    Returns
+    -------
+    : dict
+        Number of files and bytes of each generated shape.
+    """
+    root = Path(root)
+    shutil.rmtree(root, ignore_errors=True)
+    summary = {}
+    for shape in SHAPES:
+        WRITERS[shape](root / shape, scale)
+        if not (root / shape).is_dir():
+            continue
+        files = [path for path in (root / shape).rglob('*') if path.is_file()]
+        summary[shape] = {'files': len(files), 'bytes': sum(path.stat().st_size for path in files)}
+    with open(root / 'corpus.json', 'w') as handler:
+        json.dump({'scale': scale, 'shapes': summary}, handler, indent=2)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', type=str, help='directory to generate the corpus in')
+    parser.add_argument('--scale', type=int, default=1, help='multiplies the number of items of every shape')
+    args = parser.parse_args()
+    print(json.dumps(generate(Path(args.root), args.scale), indent=2))
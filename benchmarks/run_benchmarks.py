@@ -0,0 +1,216 @@
+"""Throughput benchmarks over a synthetic corpus, see `corpus.py`.
+
+Times `Deidentifier.run` on every corpus shape, along with `Instance.deidentify`,
+`deidentify_bytes` on files already in memory, `DicomDir.deidentify`, `Validator.check` and `SfRedactor.redact` on their own, and `redact_batch` over
+`--workers` processes. Each case runs in a
+fresh subprocess, so that its peak RSS is not skewed by the other cases, and reports files/s,
+MB/s and peak RSS. Results are saved to JSON along with the current commit, so that runs can be
+compared between commits, e.g.:
+
+    python benchmarks/run_benchmarks.py --corpus bench_corpus --output before.json
+    python benchmarks/run_benchmarks.py --corpus bench_corpus --output after.json --compare before.json
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from collections import namedtuple
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+
+import pydicom
+
+from corpus import generate
+
+
+DEIDENTIFIER_SHAPES = ('singles', 'series', 'dicomdir', 'archives', 'multiframe', 'small_files')
+CASES = (
+    *(f'deidentifier_run:{shape}' for shape in DEIDENTIFIER_SHAPES),
+    'instance_deidentify', 'memory_deidentify', 'dicomdir_deidentify', 'validator_check', 'sfredact', 'sfredact_batch',
+)
+
+Args = namedtuple('Args', 'InputDirectory skip_private_tags no_bundled_output workers stream output_directory')
+
+
+def peak_rss_mb() -> float | None:
+    """Peak resident set size of this process and its finished children, in MB."""
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+def _size(paths: list) -> int:
+    return sum(path.stat().st_size for path in paths)
+
+
+def run_case(case: str, corpus: Path, scratch: Path, workers: int, stream: bool) -> dict:
+    """Runs a single case in this process, returning number of files and bytes processed and wall time."""
+    from deidcm.deidentifier import Deidentifier
+    from deidcm.instance import Instance
+    from deidcm.dicomdir import DicomDir
+    from deidcm.validation import Validator
+    from deidcm.memory import deidentify_bytes
+
+    os.chdir(scratch)
+    name, _, shape = case.partition(':')
+    if name == 'deidentifier_run':
+        input_dir = corpus / shape
+        files = [path for path in input_dir.rglob('*') if path.is_file()]
+        start = time.perf_counter()
+        Deidentifier.create(Args(str(input_dir), False, False, workers, stream, str(scratch / 'output'))).run()
+        seconds = time.perf_counter() - start
+    elif name == 'instance_deidentify':
+        files = sorted((corpus / 'singles').glob('*.dcm')) + sorted((corpus / 'multiframe').glob('*.dcm'))
+        start = time.perf_counter()
+        for path in files:
+            Instance(path).deidentify(False, stream, scratch / path.name)
+        seconds = time.perf_counter() - start
+    elif name == 'memory_deidentify':
+        files = sorted((corpus / 'singles').glob('*.dcm')) + sorted((corpus / 'multiframe').glob('*.dcm'))
+        buffers = [path.read_bytes() for path in files]
+        start = time.perf_counter()
+        for data in buffers:
+            deidentify_bytes(data, stream=stream)
+        seconds = time.perf_counter() - start
+    elif name == 'dicomdir_deidentify':
+        files = sorted((corpus / 'dicomdir').glob('*/DICOMDIR'))
+        start = time.perf_counter()
+        for idx, path in enumerate(files):
+            DicomDir(path).deidentify(scratch / f'DICOMDIR{idx}')
+        seconds = time.perf_counter() - start
+    elif name == 'validator_check':
+        files = sorted(item for shape in DEIDENTIFIER_SHAPES for item in (corpus / shape).iterdir())
+        start = time.perf_counter()
+        for path in files:
+            Validator(path).check()
+        seconds = time.perf_counter() - start
+        files = [path for item in files for path in ([item] if item.is_file() else item.rglob('*')) if path.is_file()]
+    elif name == 'sfredact':
+        from sfredact import SfRedactor
+        files = sorted((corpus / 'sf').glob('*.pdf'))
+        start = time.perf_counter()
+        for path in files:
+            SfRedactor(str(path)).redact(str(scratch / path.name))
+        seconds = time.perf_counter() - start
+    elif name == 'sfredact_batch':
+        from sfredact import redact_batch
+        files = sorted((corpus / 'sf').glob('*.pdf'))
+        start = time.perf_counter()
+        redact_batch([(str(path), str(scratch / path.name)) for path in files], workers)
+        seconds = time.perf_counter() - start
+    else:
+        raise ValueError(f'unknown case {case}')
+    return {'files': len(files), 'bytes': _size(files), 'seconds': seconds}
+
+
+def measure(case: str, corpus: Path, workers: int, stream: bool, repeat: int) -> dict:
+    """Runs a case `repeat` times, each in a fresh subprocess, keeping the fastest run."""
+    best = None
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as scratch:
+            command = [sys.executable, __file__, '--case', case, '--corpus', str(corpus), '--scratch', scratch,
+                '--workers', str(workers)] + (['--stream'] if stream else [])
+            completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if completed.returncode != 0:
+            return {'error': completed.stderr.strip().splitlines()[-1]}
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    seconds = max(best['seconds'], 1e-9)
+    return {
+        **best,
+        'seconds': round(seconds, 4),
+        'files_per_second': round(best['files'] / seconds, 2),
+        'mb_per_second': round(best['bytes'] / seconds / (1 << 20), 2),
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, text=True, cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results: dict, baseline_path: Path) -> None:
+    """Prints throughput ratios against a previous results file."""
+    with open(baseline_path) as handler:
+        baseline = json.load(handler)
+    print(f'\ncompared to {baseline_path} (commit {baseline.get("commit")}):')
+    for case, result in results['cases'].items():
+        before = baseline['cases'].get(case, {})
+        if 'files_per_second' in result and before.get('files_per_second'):
+            ratio = result['files_per_second'] / before['files_per_second']
+            print(f'{case:>32}: {ratio:6.2f}x files/s')
+
+
+def main(args: argparse.Namespace) -> None:
+    corpus = Path(args.corpus).resolve()
+    if args.generate or not (corpus / 'corpus.json').is_file():
+        generate(corpus, args.scale)
+    cases = [case for case in CASES if not args.only or any(case.startswith(name) for name in args.only)]
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pydicom': pydicom.__version__,
+        'workers': args.workers,
+        'stream': args.stream,
+        'cases': {},
+    }
+    for case in cases:
+        if case.startswith('sfredact') and not (corpus / 'sf').is_dir():
+            results['cases'][case] = {'error': 'skipped, PyMuPDF is not installed'}
+            continue
+        result = measure(case, corpus, args.workers, args.stream, args.repeat)
+        results['cases'][case] = result
+        if 'error' in result:
+            print(f'{case:>32}: {result["error"]}')
+            continue
+        print(f'{case:>32}: {result["files_per_second"]:10.1f} files/s {result["mb_per_second"]:10.1f} MB/s '
+            f'{result["peak_rss_mb"]} MB peak RSS')
+    with open(args.output, 'w') as handler:
+        json.dump(results, handler, indent=2)
+    print(f'results saved to {args.output}')
+    if args.compare:
+        compare(results, Path(args.compare))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--corpus', type=str, default='bench_corpus', help='corpus directory, generated if missing')
+    parser.add_argument('-g', '--generate', action='store_true', help='regenerate the corpus')
+    parser.add_argument('--scale', type=int, default=1, help='corpus scale, see corpus.py')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per case, the fastest is kept')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='deidentifier worker processes')
+    parser.add_argument('-s', '--stream', action='store_true', help='header-only streaming de-identification')
+    parser.add_argument('--only', nargs='*', help='run only cases starting with these names')
+    parser.add_argument('-o', '--output', type=str, default='benchmark_results.json', help='results file')
+    parser.add_argument('--compare', type=str, help='previous results file to compare with')
+    parser.add_argument('--case', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--scratch', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        result = run_case(args.case, Path(args.corpus), Path(args.scratch), args.workers, args.stream)
+        result['peak_rss_mb'] = peak_rss_mb()
+        print(json.dumps(result))
+    else:
+        main(args)
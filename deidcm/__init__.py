@@ -6,3 +6,5 @@ package_config_path = package_path / 'config'
 package_data_path = package_path / 'data'
 
 from .deidentifier import Deidentifier
+from .memory import deidentify_dataset
+from .memory import deidentify_bytes
@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import os
+import time
+import asyncio
+import logging
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from deidcm.deidentifier import Deidentifier
+from deidcm.validation import Validator
+from deidcm.classifier import Classifier
+from deidcm.pool import Job
+from deidcm.pool import Result
+from deidcm.pool import JobRunner
+from deidcm.utils import clone_or_copy
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['AsyncDeidentifier']
+
+
+def _list_dir(path: str) -> tuple:
+	"""Sub-directory and file entries of a directory, sorted by name, see `walk()`."""
+	with os.scandir(path) as iterator:
+		entries = sorted(iterator, key=lambda entry: entry.name)
+	return [entry for entry in entries if entry.is_dir()], [entry for entry in entries if entry.is_file()]
+
+
+def _copy_file(entry: os.DirEntry, destination: Path) -> int:
+	"""Copies a file over as it is, returning its size."""
+	clone_or_copy(entry.path, destination)
+	return entry.stat().st_size
+
+
+def _read_file(path: Path) -> bytes:
+	with open(path, 'rb') as handler:
+		return handler.read()
+
+
+def _write_file(path: Path, data: bytes) -> None:
+	with open(path, 'wb') as handler:
+		handler.write(data)
+
+
+def _filter(runner: JobRunner, job: Job, data: bytes) -> Result:
+	"""De-identifies a file held in memory, waiting on the process pool of the runner if it has one."""
+	return runner.submit_buffer(job.kind, job.path.name, data).result()
+
+
+def _filter_path(runner: JobRunner, job: Job) -> Result:
+	"""De-identifies a file from its path, waiting on the process pool of the runner if it has one."""
+	return runner.submit(job).result()
+
+
+class AsyncDeidentifier(Deidentifier):
+	"""Deidentifier with an asyncio front end, for inputs on high latency storage, e.g. network file systems.
+
+	On such storage each directory listing, stat, read and write is a round trip, and the plain
+	deidentifier spends most of its time waiting on them one after another. Here they are issued
+	concurrently from a thread pool, up to `concurrency` at a time: top level items are validated
+	together, directory trees are listed a level at a time, all files are classified at once, and
+	non-DICOM files are copied over together. Instance jobs are read into memory, de-identified in
+	the CPU executor - the process pool of the runner with `workers` > 1, a single thread otherwise -
+	and written out, with up to `concurrency` jobs in flight, so that the I/O of some jobs overlaps
+	the filtering of others. At most `concurrency` files are held in memory at once. With `stream`,
+	jobs are instead handed to the CPU executor by path, as in `Deidentifier`, so that only their
+	headers are read and pixel data is copied over by the kernel, never held in memory.
+
+	Archives are streamed through the runner as in `Deidentifier`. Outputs, layout and metrics are
+	the same as those of the plain deidentifier, with the job reads and writes reported as 'fetch'
+	and 'store' stages.
+
+	Attributes
+	----------
+	concurrency: int
+		Number of I/O operations, and of instance jobs, in flight at most.
+
+	Methods
+	-------
+	create()
+		Creates deidentifier object with input args as attributes.
+	process()
+		Identifies type of each input item and calls appropriate processing routines.
+	process_items()
+		Stages and de-identifies given items together.
+	run()
+		Cleans any old output directory, and iterates processing through each item of input directory.
+	"""
+	def __init__(self) -> None:
+		self._checked = {}
+
+	@classmethod
+	def create(cls, args: argparse.ArgumentParser) -> deidentifier:
+		"""Creates a deidentifier object."""
+		setattr(cls, 'concurrency', getattr(args, 'concurrency', None) or 16)
+		return super().create(args)
+
+	async def _io(self, func, *args):
+		"""Runs a blocking call in the I/O thread pool."""
+		return await asyncio.get_running_loop().run_in_executor(self._threads, partial(func, *args))
+
+	async def _limited(self, func, *args):
+		"""Runs a blocking call in the I/O thread pool, once fewer than `concurrency` are in flight."""
+		async with self._limit:
+			return await self._io(func, *args)
+
+	async def _walk(self, top: Path) -> list:
+		"""Lists a directory tree a level at a time, listing all directories of a level concurrently.
+
+		Returns
+		-------
+		: list[tuple]
+			Same as `list(walk(top))`.
+		"""
+		listings = {}
+		level = [os.fspath(top)]
+		while level:
+			found = await asyncio.gather(*(self._limited(_list_dir, path) for path in level))
+			listings.update(zip(level, found))
+			level = [entry.path for dirs, _ in found for entry in dirs]
+
+		def preorder(path: str):
+			dirs, files = listings[path]
+			yield path, dirs, files
+			for entry in dirs:
+				yield from preorder(entry.path)
+
+		return list(preorder(os.fspath(top)))
+
+	async def _check_all(self, item_paths: list) -> dict:
+		"""Validates top level input items concurrently."""
+		self._limit = asyncio.Semaphore(self.concurrency)
+		classifier = Classifier()
+		checked = await asyncio.gather(*(self._limited(lambda path: Validator(path, classifier).check(), item_path)
+			for item_path in item_paths))
+		return dict(zip(item_paths, checked))
+
+	async def _copy(self, item: str, entry: os.DirEntry, destination: Path) -> None:
+		start = time.perf_counter()
+		size = await self._limited(_copy_file, entry, destination)
+		self.metrics.record(item, 'copy', time.perf_counter() - start, size, size)
+
+	async def _stage_dir(self, dir_name: str, item_path: Path) -> Path:
+		"""Stages a directory, see `Deidentifier._deidentify_dir()`."""
+		self._limit = asyncio.Semaphore(self.concurrency)
+		dir_path = self._output_path(f'{dir_name}_deidentified')
+		tree = await self._walk(item_path)
+		files = [entry for _, _, entries in tree for entry in entries]
+		verdicts = await asyncio.gather(*(self._limited(self._classifier.is_dicom, entry) for entry in files))
+		dicom = {entry.path for entry, verdict in zip(files, verdicts) if verdict}
+		# top level sub-directories containing DICOM data are renamed, as in `Deidentifier`
+		renames = {}
+		for path in dicom:
+			parts = Path(path).relative_to(item_path).parts
+			if len(parts) > 1 and parts[0] not in renames:
+				renames[parts[0]] = self._get_encode(parts[0])
+
+		outputs, levels = {}, {}
+		for root, _, _ in tree:
+			relative = Path(root).relative_to(item_path)
+			if relative.parts:
+				relative = Path(renames.get(relative.parts[0], relative.parts[0]), *relative.parts[1:])
+			outputs[root] = dir_path / relative
+			levels.setdefault(len(relative.parts), []).append(outputs[root])
+		for depth in sorted(levels):
+			await asyncio.gather(*(self._limited(os.mkdir, path) for path in levels[depth]))
+
+		copies = []
+		for root, _, entries in tree:
+			for entry in entries:
+				output_file = outputs[root] / entry.name
+				if entry.name == 'DICOMDIR':
+					self._jobs.append(Job('dicomdir', Path(entry.path), output_file))
+				elif entry.path in dicom:
+					self._jobs.append(Job('instance', Path(entry.path), output_file))
+				else:
+					copies.append(self._copy(dir_name, entry, output_file))
+		await asyncio.gather(*copies)
+		return dir_path
+
+	async def _run_job(self, runner: JobRunner, dispatch: ThreadPoolExecutor, job: Job) -> Result:
+		"""Reads, de-identifies and writes out a single file job."""
+		item = self._item_of(job.path)
+		async with self._limit:
+			if runner.stream:
+				result = await asyncio.get_running_loop().run_in_executor(dispatch, _filter_path, runner, job)
+				runner.advance()
+				return result._replace(path=str(job.path))
+			try:
+				start = time.perf_counter()
+				data = await self._io(_read_file, job.path)
+				self.metrics.record(item, 'fetch', time.perf_counter() - start, bytes_read=len(data))
+				result = await asyncio.get_running_loop().run_in_executor(dispatch, _filter, runner, job, data)
+				if result.error is None:
+					start = time.perf_counter()
+					await self._io(_write_file, job.output, result.data)
+					self.metrics.record(item, 'store', time.perf_counter() - start, bytes_written=len(result.data))
+			except OSError as error:
+				log.error(f'failed to deidentify {job.path}: {error!r}')
+				result = Result(str(job.path), repr(error))
+		runner.advance()
+		return result._replace(path=str(job.path), data=None)
+
+	async def _run_all(self, runner: JobRunner) -> list:
+		self._limit = asyncio.Semaphore(self.concurrency)
+		with ThreadPoolExecutor(max(1, runner.workers)) as dispatch:
+			return list(await asyncio.gather(*(self._run_job(runner, dispatch, job) for job in self._jobs)))
+
+	def _deidentify_dir(self, dir_name: str, item_path: Path) -> Path:
+		return asyncio.run(self._stage_dir(dir_name, item_path))
+
+	def _check(self, item_path: Path) -> namedtuple:
+		checked = self._checked.pop(item_path, None)
+		return checked if checked is not None else super()._check(item_path)
+
+	def _run_jobs(self, runner: JobRunner) -> list:
+		return asyncio.run(self._run_all(runner))
+
+	def process(self, item: str) -> None:
+		with ThreadPoolExecutor(self.concurrency) as self._threads:
+			super().process(item)
+
+	def process_items(self, items: list, cache: RunCache | None = None) -> dict:
+		with ThreadPoolExecutor(self.concurrency) as self._threads:
+			item_paths = [Path(f'{self.input_directory}/{item}') for item in items]
+			self._checked = asyncio.run(self._check_all(item_paths))
+			return super().process_items(items, cache)
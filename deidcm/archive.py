@@ -0,0 +1,453 @@
+from __future__ import annotations
+
+import io
+import os
+import bz2
+import lzma
+import gzip
+import zlib
+import queue
+import shutil
+import base64
+import logging
+import tarfile
+import zipfile
+import threading
+from pathlib import Path
+from typing import BinaryIO
+from typing import Callable
+from typing import Iterator
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import Future
+
+from pydicom.uid import UID
+
+from deidcm.classifier import DICOM_HEADER_SIZE
+from deidcm.classifier import is_dicom_header
+from deidcm.classifier import transfer_syntax
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['Archive', 'ARCHIVE_ERRORS', 'archive_format', 'split_archive_name']
+
+
+# zip local file header, empty archive end of central directory, spanned archive marker
+_ZIP_MAGIC = (b'PK\x03\x04', b'PK\x05\x06', b'PK\x07\x08')
+# raised when reading a corrupt or truncated archive
+ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError, zlib.error, lzma.LZMAError)
+_TAR_MAGIC_OFFSET = 257
+_TAR_MAGIC = b'ustar'
+_COMPRESSED_TAR_MAGIC = {
+	b'\x1f\x8b': ('gztar', gzip.open),
+	b'BZh': ('bztar', bz2.open),
+	b'\xfd7zXZ\x00': ('xztar', lzma.open),
+}
+_TAR_MODES = {'tar': '', 'gztar': 'gz', 'bztar': 'bz2', 'xztar': 'xz'}
+_ARCHIVE_SUFFIXES = ('.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.tar', '.zip')
+
+# non-DICOM members up to this size are buffered to keep pending DICOM jobs in flight
+BUFFERED_MEMBER_SIZE = 1 << 20
+# upper bound on member bytes held in memory while their jobs are in flight
+MAX_IN_FLIGHT_BYTES = 256 << 20
+# compression of output zip members: as in the input, all deflated, all stored, or stored only
+# if their pixel data is compressed already
+COMPRESSIONS = ('keep', 'deflate', 'store', 'auto')
+# members queued for the writer thread at most
+WRITE_QUEUE_SIZE = 8
+_CLOSE = object()
+
+Member = namedtuple('Member', 'name is_dir size info')
+
+
+def archive_format(path: Path) -> str | None:
+	"""Identifies archive format from its magic bytes, without unpacking it.
+
+	Parameters
+	----------
+	path: Path
+		Path to file.
+
+	Returns
+	-------
+	: str | None
+		One of 'zip', 'tar', 'gztar', 'bztar', 'xztar', or None if file is not a supported archive.
+	"""
+	try:
+		with open(path, 'rb') as handler:
+			head = handler.read(_TAR_MAGIC_OFFSET + len(_TAR_MAGIC))
+	except (IsADirectoryError, PermissionError):
+		return None
+	if head.startswith(_ZIP_MAGIC):
+		return 'zip'
+	if head[_TAR_MAGIC_OFFSET:].startswith(_TAR_MAGIC):
+		return 'tar'
+	for magic, (name, opener) in _COMPRESSED_TAR_MAGIC.items():
+		if head.startswith(magic):
+			try:
+				with opener(path, 'rb') as handler:
+					head = handler.read(_TAR_MAGIC_OFFSET + len(_TAR_MAGIC))
+			except (OSError, EOFError, lzma.LZMAError):
+				return None
+			return name if head[_TAR_MAGIC_OFFSET:].startswith(_TAR_MAGIC) else None
+	return None
+
+
+def split_archive_name(file_name: str) -> tuple:
+	"""Splits archive file name into stem and extension, keeping compound extensions like `.tar.gz`."""
+	for suffix in _ARCHIVE_SUFFIXES:
+		if file_name.lower().endswith(suffix):
+			return file_name[:-len(suffix)], file_name[-len(suffix):]
+	return os.path.splitext(file_name)
+
+
+def _normalized(name: str) -> str:
+	"""Member name without leading `./` and trailing `/`, empty for the `.` entry of tar archives."""
+	while name.startswith('./'):
+		name = name[2:]
+	name = name.rstrip('/')
+	return '' if name == '.' else name
+
+
+class Archive:
+	"""Reads and writes compressed DICOM data without extracting it to disk.
+
+	Members are read directly from the input archive and written straight into the output
+	archive in their original order. Zip archives are accessed randomly through their central
+	directory, while tar archives are read sequentially.
+
+	If all members live under a single top level directory, that directory is dropped from the
+	output member names. Top level sub-directories (under the
+	dropped one, if any) containing DICOM data are renamed with their encoded names, or with
+	the names returned by `rename` if given.
+
+	Zip members are compressed as in the input archive unless `compression` says otherwise, see
+	`ArchiveWriter`.
+
+	Output names depend on all member names and kinds, so `scan()` has to read every member
+	before `deidentify()` reads them again. For zip archives this only reads the leading bytes of
+	each member, but a compressed tar archive is decompressed in full by both passes.
+
+	Attributes
+	----------
+	path: Path
+		Path to archive.
+	format: str
+		Archive format, see `archive_format()`.
+	compression: str
+		Compression of output zip members, one of `COMPRESSIONS`.
+	members: list[Member]
+		All members in archive order, filled by `scan()`.
+	dicom: set[str]
+		Names of DICOM members, filled by `scan()`.
+
+	Methods
+	-------
+	has_dicom()
+		Checks whether any member is DICOM, stopping at the first one.
+	scan()
+		Lists all members and identifies DICOM ones.
+	output_name()
+		Maps member name to its name in the output archive.
+	open_member()
+		Opens member for reading.
+	writer()
+		Opens output archive of the same format for writing.
+	deidentify()
+		De-identifies DICOM members and writes all members into the output archive.
+	"""
+	def __init__(self, archive_path: Path, archive_format_name: str | None = None,
+		rename: Callable | None = None, compression: str = 'keep') -> None:
+		self.path = Path(archive_path)
+		self.rename = rename
+		self.format = archive_format_name or archive_format(self.path)
+		if self.format is None:
+			raise ValueError(f'{self.path} is not a supported archive')
+		if compression not in COMPRESSIONS:
+			raise ValueError(f'unknown archive compression {compression}, expected one of {COMPRESSIONS}')
+		self.compression = compression
+		self.members = []
+		self.dicom = set()
+		self._root = ''
+		self._renames = {}
+
+	def _iter_members(self) -> Iterator[tuple]:
+		"""Iterates members with their sniffed DICOM header bytes, in archive order."""
+		if self.format == 'zip':
+			with zipfile.ZipFile(self.path) as archive:
+				for info in archive.infolist():
+					member = Member(info.filename, info.is_dir(), info.file_size, info)
+					if member.is_dir:
+						yield member, b''
+						continue
+					with archive.open(info) as handler:
+						yield member, handler.read(DICOM_HEADER_SIZE)
+			return
+		with tarfile.open(self.path, f'r:{_TAR_MODES[self.format]}') as archive:
+			for info in archive:
+				if not (info.isdir() or info.isfile()):
+					continue
+				member = Member(info.name, info.isdir(), info.size, info)
+				if member.is_dir:
+					yield member, b''
+					continue
+				yield member, archive.extractfile(info).read(DICOM_HEADER_SIZE)
+
+	def has_dicom(self) -> bool:
+		"""Checks whether any member is DICOM, stopping at the first one."""
+		return any(is_dicom_header(head) for _, head in self._iter_members())
+
+	def scan(self) -> None:
+		"""Lists all members and identifies DICOM ones, reading only their leading bytes."""
+		self.members, self.dicom = [], set()
+		for member, head in self._iter_members():
+			self.members.append(member)
+			if is_dicom_header(head):
+				self.dicom.add(member.name)
+		self._root = ''
+		names = [(_normalized(member.name), member.is_dir) for member in self.members]
+		names = [(name, is_dir) for name, is_dir in names if name]
+		tops = {name.split('/')[0] for name, _ in names}
+		if len(tops) == 1:
+			top = tops.pop()
+			if all(name.startswith(f'{top}/') or (name == top and is_dir) for name, is_dir in names):
+				self._root = f'{top}/'
+		self._renames = {}
+		for name in self.dicom:
+			parts = _normalized(name)[len(self._root):].split('/')
+			if len(parts) > 1:
+				self._renames[parts[0]] = self._encode(parts[0])
+
+	def _encode(self, name: str) -> str:
+		"""Output name of a top level sub-directory containing DICOM data."""
+		if self.rename is not None:
+			return self.rename(name)
+		return base64.b64encode(name.encode('ascii')).decode('ascii')
+
+	def output_name(self, name: str) -> str | None:
+		"""Maps member name to its name in the output archive, None for the dropped root directory."""
+		name = _normalized(name)
+		relative = name[len(self._root):] if name.startswith(self._root) else name
+		if not relative or name == self._root.rstrip('/'):
+			return None
+		parts = relative.split('/')
+		parts[0] = self._renames.get(parts[0], parts[0])
+		return '/'.join(parts)
+
+	def open_member(self, member: Member, archive: zipfile.ZipFile | tarfile.TarFile) -> BinaryIO:
+		"""Opens member of an opened archive for reading."""
+		if self.format == 'zip':
+			return archive.open(member.info)
+		return archive.extractfile(member.info)
+
+	def reader(self) -> zipfile.ZipFile | tarfile.TarFile:
+		"""Opens input archive for reading."""
+		if self.format == 'zip':
+			return zipfile.ZipFile(self.path)
+		return tarfile.open(self.path, f'r:{_TAR_MODES[self.format]}')
+
+	def writer(self, output_path: Path) -> ArchiveWriter:
+		"""Opens output archive of the same format for writing."""
+		return ArchiveWriter(output_path, self.format, self.compression)
+
+	def deidentify(self, output_path: Path, runner: JobRunner) -> list:
+		"""De-identifies DICOM members and writes all members into the output archive.
+
+		Members are read one by one and DICOM ones are submitted to the job runner, while their
+		results are written out in archive order as soon as they are ready. Failed members are
+		left out of the output archive. `scan()` must be called first.
+
+		Parameters
+		----------
+		output_path: Path
+			Path to output archive.
+		runner: JobRunner
+			Runner to submit de-identification jobs to.
+
+		Returns
+		-------
+		: list[Result]
+			Results of the DICOM members.
+		"""
+		results, pending = [], deque()
+		in_flight = 0
+
+		def write_pending(max_count: int, max_bytes: int) -> None:
+			"""Writes out oldest pending members until both limits are satisfied."""
+			nonlocal in_flight
+			while pending and (len(pending) > max_count or in_flight > max_bytes):
+				name, member, payload, size = pending.popleft()
+				in_flight -= size
+				if member.is_dir:
+					writer.add_dir(name, member)
+					continue
+				if isinstance(payload, Future):
+					result = payload.result()
+					runner.advance()
+					results.append(result._replace(path=f'{self.path}/{member.name}', data=None))
+					if result.error is not None:
+						continue
+					payload = result.data
+				writer.add_bytes(name, payload, member)
+
+		with self.reader() as archive, self.writer(output_path) as writer:
+			for member in self.members:
+				name = self.output_name(member.name)
+				if name is None:
+					continue
+				if member.is_dir:
+					pending.append((name, member, None, 0))
+					continue
+				if member.name not in self.dicom and member.size > BUFFERED_MEMBER_SIZE:
+					write_pending(0, 0)
+					with self.open_member(member, archive) as source:
+						writer.add_stream(name, source, member)
+					continue
+				with self.open_member(member, archive) as source:
+					data = source.read()
+				payload = data
+				if member.name in self.dicom:
+					kind = 'dicomdir' if name.split('/')[-1] == 'DICOMDIR' else 'instance'
+					payload = runner.submit_buffer(kind, name, data)
+				pending.append((name, member, payload, len(data)))
+				in_flight += len(data)
+				write_pending(runner.window, MAX_IN_FLIGHT_BYTES)
+			write_pending(0, 0)
+		log.info(f'{self.path} ---> {output_path}')
+		return results
+
+
+class ArchiveWriter:
+	"""Writes members into a zip or tar archive as they become available.
+
+	Members added from memory are compressed and written by a background thread, so that
+	compression overlaps with reading and de-identifying the next members, while members streamed
+	from a file object are written right away once the queued ones are out. Zip archives switch to
+	ZIP64 records as needed, for members over 4 GB and archives with over 65535 members.
+
+	Compression of zip members is set by `compression`: 'keep' compresses each member as its input
+	member, 'deflate' and 'store' compress all members alike, and 'auto' stores DICOM members with
+	encapsulated or deflated transfer syntaxes, whose pixel data would not shrink any further, and
+	deflates all other members. Tar archives are compressed as a whole, as per their format.
+
+	Attributes
+	----------
+	path: Path
+		Path to output archive.
+	format: str
+		Archive format, see `archive_format()`.
+	compression: str
+		Compression of zip members, one of `COMPRESSIONS`.
+	"""
+	def __init__(self, output_path: Path, archive_format_name: str, compression: str = 'keep') -> None:
+		self.path = Path(output_path)
+		self.format = archive_format_name
+		self.compression = compression
+		if self.format == 'zip':
+			self._archive = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+		else:
+			self._archive = tarfile.open(self.path, f'w:{_TAR_MODES[self.format]}')
+		self._queue = queue.Queue(WRITE_QUEUE_SIZE)
+		self._error = None
+		self._thread = threading.Thread(target=self._drain, name=f'writer-{self.path.name}', daemon=True)
+		self._thread.start()
+
+	def __enter__(self) -> ArchiveWriter:
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.close()
+
+	def _drain(self) -> None:
+		"""Writes queued members until the writer is closed, keeping the first error."""
+		while True:
+			task = self._queue.get()
+			try:
+				if task is _CLOSE:
+					return
+				if self._error is None:
+					write, args = task
+					write(*args)
+			except Exception as error:
+				self._error = error
+			finally:
+				self._queue.task_done()
+
+	def _submit(self, write: Callable, *args) -> None:
+		"""Queues a member to be written by the writer thread."""
+		self._raise()
+		self._queue.put((write, args))
+
+	def _raise(self) -> None:
+		"""Raises the error the writer thread failed with, if any."""
+		if self._error is not None:
+			raise self._error
+
+	def close(self) -> None:
+		"""Writes out queued members and finalizes the output archive."""
+		if self._thread.is_alive():
+			self._queue.put(_CLOSE)
+			self._thread.join()
+		self._archive.close()
+		self._raise()
+
+	def _compress_type(self, member: Member, data: bytes | None = None) -> int:
+		"""Zip compression of an output member, see `compression`."""
+		if self.compression == 'keep':
+			return member.info.compress_type
+		if self.compression == 'store':
+			return zipfile.ZIP_STORED
+		if self.compression == 'auto' and data is not None:
+			syntax = transfer_syntax(data[:4096])
+			if syntax is not None and (UID(syntax).is_encapsulated or UID(syntax).is_deflated):
+				return zipfile.ZIP_STORED
+		return zipfile.ZIP_DEFLATED
+
+	def _zip_info(self, name: str, member: Member, data: bytes | None = None) -> zipfile.ZipInfo:
+		"""Member info for output, keeping timestamp and attributes of the input member."""
+		info = zipfile.ZipInfo(name, date_time=member.info.date_time)
+		info.compress_type = self._compress_type(member, data)
+		info.external_attr = member.info.external_attr
+		return info
+
+	def _tar_info(self, name: str, member: Member, size: int = 0) -> tarfile.TarInfo:
+		"""Member info for output, keeping timestamp and mode of the input member."""
+		info = tarfile.TarInfo(name)
+		info.type = tarfile.DIRTYPE if member.is_dir else tarfile.REGTYPE
+		info.mtime, info.mode, info.size = member.info.mtime, member.info.mode, size
+		return info
+
+	def _write_dir(self, name: str, member: Member) -> None:
+		if self.format == 'zip':
+			self._archive.writestr(self._zip_info(name, member), b'')
+		else:
+			self._archive.addfile(self._tar_info(name, member))
+
+	def _write_bytes(self, name: str, data: bytes, member: Member) -> None:
+		if self.format == 'zip':
+			self._archive.writestr(self._zip_info(name, member, data), data)
+		else:
+			self._archive.addfile(self._tar_info(name, member, len(data)), io.BytesIO(data))
+
+	def add_dir(self, name: str, member: Member) -> None:
+		"""Queues directory member."""
+		self._submit(self._write_dir, name.rstrip('/') + '/', member)
+
+	def add_bytes(self, name: str, data: bytes, member: Member) -> None:
+		"""Queues file member from bytes."""
+		self._submit(self._write_bytes, name, data, member)
+
+	def add_stream(self, name: str, source: BinaryIO, member: Member) -> None:
+		"""Adds file member of known size by copying it over from a file object in chunks.
+
+		Queued members are written out first, as the source can only be read while it is open.
+		"""
+		self._queue.join()
+		self._raise()
+		if self.format == 'zip':
+			with self._archive.open(self._zip_info(name, member), 'w', force_zip64=True) as destination:
+				shutil.copyfileobj(source, destination)
+		else:
+			self._archive.addfile(self._tar_info(name, member, member.size), source)
@@ -0,0 +1,358 @@
+from __future__ import annotations
+
+import json
+import time
+import queue
+import shutil
+import logging
+import threading
+from pathlib import Path
+from typing import Callable
+from collections import namedtuple
+
+from boto3.s3.transfer import TransferConfig
+
+from deidcm.deidentifier import Deidentifier
+from deidcm.manifest import RunManifest
+from deidcm.manifest import file_checksum
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['BatchRunner', 'LocalBucket', 'load_studies']
+
+
+Study = namedtuple('Study', 'index study_id dicom_key sf_key')
+LocalObject = namedtuple('LocalObject', 'key e_tag content_length')
+Args = namedtuple('Args', 'InputDirectory skip_private_tags no_bundled_output workers stream output_directory')
+
+# marks the end of a stage queue
+_DONE = None
+
+
+def load_studies(manifest_path: Path) -> list:
+	"""Parses a gore.json-style manifest of DICOM and SF object keys.
+
+	Parameters
+	----------
+	manifest_path: Path
+		Path to JSON list of {"DICOM": key, "SF": key} records.
+
+	Returns
+	-------
+	: list[Study]
+		Studies numbered in manifest order.
+	"""
+	with open(manifest_path, 'r') as handler:
+		records = json.load(handler)
+	return [Study(idx, f'study{idx:03}', record['DICOM'], record.get('SF')) for idx, record in enumerate(records)]
+
+
+class LocalBucket:
+	"""Filesystem-backed stand-in for a boto3 `Bucket` resource, for running batches locally.
+
+	Object keys map to files under the root directory.
+
+	Attributes
+	----------
+	root: Path
+		Directory holding the bucket objects.
+	name: str
+		Bucket name.
+	"""
+	def __init__(self, root: Path) -> None:
+		self.root = Path(root)
+		self.name = self.root.name
+
+	def Object(self, key: str) -> LocalObject:
+		"""Object summary, with size and modification time standing in for the ETag."""
+		stat = (self.root / key).stat()
+		return LocalObject(key, f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"', stat.st_size)
+
+	def download_file(self, Key: str, Filename: str, Config: TransferConfig | None = None, **kwargs) -> None:
+		"""Copies object to local file."""
+		shutil.copyfile(self.root / Key, Filename)
+
+	def upload_file(self, Filename: str, Key: str, Config: TransferConfig | None = None, **kwargs) -> None:
+		"""Copies local file to object."""
+		destination = self.root / Key
+		destination.parent.mkdir(parents=True, exist_ok=True)
+		shutil.copyfile(Filename, destination)
+
+
+class StageMetrics:
+	"""Thread-safe throughput counters of one batch stage.
+
+	Attributes
+	----------
+	name: str
+		Stage name.
+	count: int
+		Number of studies that went through the stage.
+	bytes: int
+		Number of bytes handled by the stage.
+	seconds: float
+		Time the stage was busy.
+	"""
+	def __init__(self, name: str) -> None:
+		self.name = name
+		self.count = 0
+		self.bytes = 0
+		self.seconds = 0.0
+		self._lock = threading.Lock()
+
+	def record(self, seconds: float, size: int) -> None:
+		"""Adds one study to the counters."""
+		with self._lock:
+			self.count += 1
+			self.bytes += size
+			self.seconds += seconds
+
+	def report(self) -> dict:
+		"""Counters with derived throughput."""
+		busy = self.seconds or float('nan')
+		return {
+			'studies': self.count,
+			'bytes': self.bytes,
+			'busy_seconds': round(self.seconds, 3),
+			'studies_per_second': round(self.count / busy, 3),
+			'megabytes_per_second': round(self.bytes / busy / 1e6, 3),
+		}
+
+
+class BatchRunner:
+	"""Pipelined batch de-identification of studies stored in S3.
+
+	Each study goes through three stages running concurrently, connected by bounded queues: while
+	one study is being de-identified the next ones are downloaded and the previous ones uploaded.
+	Every study gets its own scratch directory, which is removed once it is uploaded. Transfers
+	use boto3 multipart concurrency.
+
+	The DICOM archive of a study is never unpacked, it is de-identified straight into the output
+	archive which is uploaded as `{study_id}.zip`, along with the redacted SF as `{study_id}.pdf`.
+
+	With a run manifest, the state of every study along with ETag and size of its source objects,
+	failed instances and checksums of its outputs are recorded as it goes through the stages.
+	Studies already done from unchanged source objects are skipped, so an interrupted batch can
+	be rerun to only process the remaining and failed studies.
+
+	Attributes
+	----------
+	in_bucket: boto3 Bucket | LocalBucket
+		Bucket to download studies from.
+	out_bucket: boto3 Bucket | LocalBucket
+		Bucket to upload de-identified studies to.
+	scratch_root: Path
+		Directory to create per-study scratch directories in.
+	redactor: Callable[[str, str], None]
+		Redacts the SF file at the first path into the second one, SF is skipped if not given.
+	skip_private_tags: bool
+		If true all private tags are untouched. If false all of them nulled.
+	workers: int
+		Number of processes to de-identify each study with.
+	stream: bool
+		If true instances are de-identified header-only.
+	queue_size: int
+		Number of studies that can wait between two stages.
+	transfer_config: TransferConfig
+		boto3 multipart transfer settings.
+	manifest: RunManifest | None
+		Record of batch progress to resume from.
+	skipped: list[Study]
+		Studies skipped as already done.
+	metrics: dict[str, StageMetrics]
+		Throughput counters by stage.
+	failures: list[tuple]
+		Failed studies with the stage they failed at and the error.
+
+	Methods
+	-------
+	run()
+		Runs all studies through the pipeline and reports stage metrics.
+	"""
+	def __init__(self, in_bucket, out_bucket, scratch_root: Path, redactor: Callable | None = None,
+		skip_private_tags: bool = False, workers: int = 1, stream: bool = False, queue_size: int = 1,
+		transfer_concurrency: int = 10, manifest: RunManifest | None = None) -> None:
+		self.in_bucket = in_bucket
+		self.out_bucket = out_bucket
+		self.scratch_root = Path(scratch_root)
+		self.redactor = redactor
+		self.skip_private_tags = skip_private_tags
+		self.workers = workers
+		self.stream = stream
+		self.queue_size = queue_size
+		self.transfer_config = TransferConfig(max_concurrency=transfer_concurrency, use_threads=True)
+		self.manifest = manifest
+		self.metrics = {stage: StageMetrics(stage) for stage in ('download', 'deidentify', 'upload')}
+		self.failures = []
+		self.skipped = []
+
+	def _scratch(self, study: Study) -> Path:
+		"""Per-study scratch directory."""
+		return self.scratch_root / study.study_id
+
+	def _record(self, study: Study, **fields) -> None:
+		"""Records study state in manifest, if any."""
+		if self.manifest is not None:
+			self.manifest.record(study.study_id, **fields)
+
+	def _fail(self, study: Study, stage: str, error: Exception) -> None:
+		"""Records failed study and removes its scratch directory."""
+		log.error(f'{study.study_id} failed to {stage}: {error!r}')
+		self.failures.append((study, stage, repr(error)))
+		self._record(study, state='failed', stage=stage, error=repr(error))
+		shutil.rmtree(self._scratch(study), ignore_errors=True)
+
+	def _skip(self, study: Study) -> None:
+		"""Skips a study already done."""
+		log.info(f'skipping {study.study_id} as it is already done')
+		self.skipped.append(study)
+
+	def _describe_source(self, study: Study) -> dict:
+		"""Keys, ETags and sizes of source objects of a study."""
+		source = {}
+		for name, key in (('dicom', study.dicom_key), ('sf', study.sf_key)):
+			if key:
+				summary = self.in_bucket.Object(key)
+				source[name] = {'key': key, 'etag': summary.e_tag, 'size': summary.content_length}
+		return source
+
+	def _download(self, study: Study) -> None:
+		"""Downloads DICOM archive and SF of a study into its scratch directory."""
+		scratch = self._scratch(study)
+		if scratch.is_dir():
+			shutil.rmtree(scratch)
+		(scratch / 'input').mkdir(parents=True)
+		start = time.perf_counter()
+		dicom_path = scratch / 'input' / f'{study.study_id}.zip'
+		self.in_bucket.download_file(study.dicom_key, str(dicom_path), Config=self.transfer_config)
+		size = dicom_path.stat().st_size
+		if study.sf_key and self.redactor is not None:
+			self.in_bucket.download_file(study.sf_key, str(scratch / 'sf.pdf'), Config=self.transfer_config)
+			size += (scratch / 'sf.pdf').stat().st_size
+		self.metrics['download'].record(time.perf_counter() - start, size)
+
+	def _deidentify(self, study: Study) -> None:
+		"""De-identifies the DICOM archive and redacts the SF of a downloaded study."""
+		scratch = self._scratch(study)
+		start = time.perf_counter()
+		args = Args(str(scratch / 'input'), self.skip_private_tags, False, self.workers, self.stream, str(scratch / 'output'))
+		deidentifier = Deidentifier.create(args)
+		deidentifier.run()
+		if deidentifier.failures:
+			log.warning(f'{study.study_id}: {len(deidentifier.failures)} files left out as they failed to deidentify')
+		instances = {
+			'total': len(deidentifier.results),
+			'failed': {str(Path(result.path).relative_to(scratch / 'input')): result.error
+				for result in deidentifier.failures},
+		}
+		self._record(study, state='deidentified', instances=instances)
+		output_path = scratch / 'output' / f'{study.study_id}_deidentified.zip'
+		if not output_path.is_file():
+			raise FileNotFoundError(f'no deidentified DICOM archive at {output_path}')
+		output_path.rename(scratch / f'{study.study_id}.zip')
+		size = (scratch / f'{study.study_id}.zip').stat().st_size
+		if (scratch / 'sf.pdf').is_file():
+			self.redactor(str(scratch / 'sf.pdf'), str(scratch / f'{study.study_id}.pdf'))
+		self.metrics['deidentify'].record(time.perf_counter() - start, size)
+
+	def _upload(self, study: Study) -> None:
+		"""Uploads de-identified study and removes its scratch directory."""
+		scratch = self._scratch(study)
+		start = time.perf_counter()
+		size, outputs = 0, {}
+		for name in (f'{study.study_id}.zip', f'{study.study_id}.pdf'):
+			if (scratch / name).is_file():
+				outputs[name] = {'sha256': file_checksum(scratch / name), 'size': (scratch / name).stat().st_size}
+				self.out_bucket.upload_file(str(scratch / name), name, Config=self.transfer_config)
+				size += outputs[name]['size']
+		self.metrics['upload'].record(time.perf_counter() - start, size)
+		self._record(study, state='done', outputs=outputs)
+		shutil.rmtree(scratch)
+
+	def _download_stage(self, studies: list, downloaded: queue.Queue) -> None:
+		"""Downloads studies one after another, as long as there is room in the queue."""
+		for study in studies:
+			try:
+				if self.manifest is not None:
+					source = self._describe_source(study)
+					if self.manifest.is_done(study.study_id, source):
+						self._skip(study)
+						continue
+					self._record(study, state='started', source=source)
+				log.info(f'downloading {study.study_id}: {study.dicom_key}')
+				self._download(study)
+			except Exception as error:
+				self._fail(study, 'download', error)
+				continue
+			downloaded.put(study)
+		downloaded.put(_DONE)
+
+	def _deidentify_stage(self, downloaded: queue.Queue, processed: queue.Queue) -> None:
+		"""De-identifies downloaded studies one after another."""
+		while True:
+			study = downloaded.get()
+			if study is _DONE:
+				break
+			log.info(f'deidentifying {study.study_id}')
+			try:
+				self._deidentify(study)
+			except Exception as error:
+				self._fail(study, 'deidentify', error)
+				continue
+			processed.put(study)
+		processed.put(_DONE)
+
+	def _upload_stage(self, processed: queue.Queue, total: int) -> None:
+		"""Uploads de-identified studies one after another."""
+		while True:
+			study = processed.get()
+			if study is _DONE:
+				break
+			log.info(f'uploading {study.study_id}')
+			try:
+				self._upload(study)
+			except Exception as error:
+				self._fail(study, 'upload', error)
+				continue
+			log.info(f'---> done {study.study_id} ({study.index + 1}/{total})')
+
+	def run(self, studies: list) -> dict:
+		"""Runs all studies through the pipeline.
+
+		Parameters
+		----------
+		studies: list[Study]
+			Studies to process, see `load_studies()`.
+
+		Returns
+		-------
+		: dict
+			Wall time, number of skipped studies, stage metrics and failed studies.
+		"""
+		log.info(f'this batch will process {len(studies)} studies')
+		self.scratch_root.mkdir(parents=True, exist_ok=True)
+		downloaded, processed = queue.Queue(self.queue_size), queue.Queue(self.queue_size)
+		threads = [
+			threading.Thread(target=self._download_stage, args=(studies, downloaded), name='download'),
+			threading.Thread(target=self._upload_stage, args=(processed, len(studies)), name='upload'),
+		]
+		start = time.perf_counter()
+		for thread in threads:
+			thread.start()
+		try:
+			self._deidentify_stage(downloaded, processed)
+		finally:
+			for thread in threads:
+				thread.join()
+		report = {
+			'studies': len(studies),
+			'wall_seconds': round(time.perf_counter() - start, 3),
+			'skipped': len(self.skipped),
+			'stages': {name: metrics.report() for name, metrics in self.metrics.items()},
+			'failures': [{'study_id': study.study_id, 'stage': stage, 'error': error}
+				for study, stage, error in self.failures],
+		}
+		log.info(f'batch report: {json.dumps(report)}')
+		return report
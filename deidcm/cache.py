@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+
+from . import package_config_path
+from deidcm.classifier import walk
+from deidcm.manifest import file_checksum
+from deidcm.uids import UidMapper
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['RunCache', 'config_fingerprint']
+
+
+CACHE_FILE_NAME = '.deidcm_cache.json'
+
+
+def config_fingerprint(skip_private_tags: bool, uids: UidMapper | None = None, archive_compression: str = 'keep') -> str:
+	"""Sha256 hash value of the tag configs and options that determine de-identified outputs."""
+	h = hashlib.new('sha256')
+	for listname in ('keep', 'redact'):
+		with open(f'{package_config_path}/{listname}_tags.txt', 'rb') as handler:
+			h.update(handler.read())
+	h.update(f'skip_private_tags={skip_private_tags}'.encode())
+	h.update(f'archive_compression={archive_compression}'.encode())
+	if uids is not None:
+		# the key itself is never written out
+		h.update(uids.map_id('config_fingerprint').encode())
+	return h.hexdigest()
+
+
+class RunCache:
+	"""Cache of input items processed by previous runs, so that re-runs only process changed items.
+
+	Each top level input item is keyed by the relative path, size and modification time of all
+	of its files, and optionally by their contents. The whole cache is tied to a fingerprint of
+	the tag configs, so changing them invalidates every entry. Along with its key, the output
+	names of each item are recorded so that they can be reused, or removed once stale.
+
+	Attributes
+	----------
+	path: Path
+		Path to JSON cache file.
+	fingerprint: str
+		Fingerprint of the configs of the current run, see `config_fingerprint()`.
+	content_hash: bool
+		Whether item keys include content hashes, catching changes that keep size and mtime.
+	entries: dict[str, dict]
+		Key and output names of each cached item.
+
+	Methods
+	-------
+	item_key()
+		Computes the key of an input item.
+	is_fresh()
+		Checks whether an item is unchanged and its outputs are still in place.
+	outputs()
+		Output names recorded for an item.
+	update()
+		Records key and output names of a processed item.
+	forget()
+		Drops an item from the cache.
+	save()
+		Writes the cache to disk.
+	"""
+	def __init__(self, cache_path: Path, fingerprint: str, content_hash: bool = False) -> None:
+		self.path = Path(cache_path)
+		self.fingerprint = fingerprint
+		self.content_hash = content_hash
+		self.entries = {}
+		self._valid = False
+		self._load()
+
+	def _load(self) -> None:
+		"""Loads existing cache, which is valid only if it was written with the same configs."""
+		if not self.path.is_file():
+			return
+		try:
+			with open(self.path, 'r') as handler:
+				cache = json.load(handler)
+		except (OSError, ValueError) as error:
+			log.warning(f'ignoring unreadable cache at {self.path}: {error}')
+			return
+		self.entries = cache.get('items', {})
+		self._valid = cache.get('fingerprint') == self.fingerprint and cache.get('content_hash') == self.content_hash
+		if not self._valid:
+			log.info('tag configs or options changed since last run, all items will be processed')
+
+	def _file_key(self, path: Path, stat: os.stat_result) -> list:
+		"""Key of a single file."""
+		key = [stat.st_size, stat.st_mtime_ns]
+		if self.content_hash:
+			key.append(file_checksum(path))
+		return key
+
+	def item_key(self, item_path: Path) -> str:
+		"""Computes the key of an input item, i.e. a file or a directory tree."""
+		h = hashlib.new('sha256')
+		if item_path.is_dir():
+			for root, _, files in walk(item_path):
+				relative = Path(root).relative_to(item_path)
+				for entry in files:
+					h.update(json.dumps([str(relative / entry.name), *self._file_key(entry.path, entry.stat())]).encode())
+		else:
+			h.update(json.dumps(self._file_key(item_path, item_path.stat())).encode())
+		return h.hexdigest()
+
+	def is_fresh(self, item: str, key: str, output_root: Path) -> bool:
+		"""Checks whether an item is unchanged since last run and all of its outputs are still in place.
+
+		Parameters
+		----------
+		item: str
+			Name of input item.
+		key: str
+			Current key of the item, see `item_key()`.
+		output_root: Path
+			Directory the outputs were written to.
+		"""
+		entry = self.entries.get(item)
+		if not self._valid or entry is None or entry['key'] != key:
+			return False
+		return all((output_root / name).exists() for name in entry['outputs'])
+
+	def outputs(self, item: str) -> list:
+		"""Output names recorded for an item."""
+		return self.entries.get(item, {}).get('outputs', [])
+
+	def update(self, item: str, key: str, outputs: list) -> None:
+		"""Records key and output names of a processed item."""
+		self.entries[item] = {'key': key, 'outputs': outputs}
+
+	def forget(self, item: str) -> None:
+		"""Drops an item from the cache."""
+		self.entries.pop(item, None)
+
+	def save(self) -> None:
+		"""Writes the cache to disk, replacing the previous one atomically."""
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		cache = {'fingerprint': self.fingerprint, 'content_hash': self.content_hash, 'items': self.entries}
+		handle, temp_path = tempfile.mkstemp(dir=self.path.parent, prefix=f'{self.path.name}.')
+		with os.fdopen(handle, 'w') as handler:
+			json.dump(cache, handler, indent=1)
+		os.replace(temp_path, self.path)
+		self._valid = True
@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import os
+import struct
+import logging
+from pathlib import Path
+from typing import Iterator
+
+
+log = logging.getLogger(__name__)
+
+
+# size of preamble, and DICM prefix that follows it
+DICOM_HEADER_SIZE = 132
+# smallest data element, tag and length
+_ELEMENT_HEADER_SIZE = 8
+_VRS = {
+	b'AE', b'AS', b'AT', b'CS', b'DA', b'DS', b'DT', b'FD', b'FL', b'IS', b'LO', b'LT', b'OB', b'OD',
+	b'OF', b'OL', b'OV', b'OW', b'PN', b'SH', b'SL', b'SQ', b'SS', b'ST', b'SV', b'TM', b'UC', b'UI',
+	b'UL', b'UN', b'UR', b'US', b'UT', b'UV',
+}
+# explicit VRs with a reserved field followed by a 4-byte length
+EXTENDED_LENGTH_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+# groups a dataset written without preamble starts with: file meta, or identifying info
+_LEADING_GROUPS = (0x0002, 0x0008)
+
+
+def _is_raw_dataset(head: bytes) -> bool:
+	"""Checks whether leading bytes look like a little endian dataset written without preamble.
+
+	The first element must be a low numbered element of the file meta or identifying group,
+	followed by either a valid explicit VR or a plausible implicit VR length.
+	"""
+	if len(head) < _ELEMENT_HEADER_SIZE:
+		return False
+	group, element, length = struct.unpack('<HHL', head[:_ELEMENT_HEADER_SIZE])
+	if group not in _LEADING_GROUPS or element > 0x00FF:
+		return False
+	if head[4:6] in _VRS:
+		return True
+	return length % 2 == 0 and length <= 0x0400
+
+
+def is_dicom_header(head: bytes) -> bool:
+	"""Checks whether leading bytes of a file are DICOM.
+
+	Either a 128-byte preamble followed by DICM prefix, or a preamble-less dataset.
+
+	Parameters
+	----------
+	head: bytes
+		Up to `DICOM_HEADER_SIZE` leading bytes of the file.
+	"""
+	if head[128:DICOM_HEADER_SIZE] == b'DICM':
+		return True
+	return _is_raw_dataset(head)
+
+
+def transfer_syntax(data: bytes) -> str | None:
+	"""Transfer syntax UID from the file meta of a DICOM file, without parsing the dataset.
+
+	Parameters
+	----------
+	data: bytes
+		Leading bytes of the file, up to the end of its file meta at least.
+
+	Returns
+	-------
+	: str | None
+		Transfer syntax UID, None if the file has no preamble or no transfer syntax in its file meta.
+	"""
+	if data[128:DICOM_HEADER_SIZE] != b'DICM':
+		return None
+	offset = DICOM_HEADER_SIZE
+	# file meta is always explicit VR little endian
+	while offset + _ELEMENT_HEADER_SIZE <= len(data):
+		group, element = struct.unpack_from('<HH', data, offset)
+		if group != 0x0002:
+			break
+		if data[offset + 4:offset + 6] in EXTENDED_LENGTH_VRS:
+			length, = struct.unpack_from('<L', data, offset + 8)
+			offset += 12
+		else:
+			length, = struct.unpack_from('<H', data, offset + 6)
+			offset += 8
+		if element == 0x0010:
+			return bytes(data[offset:offset + length]).rstrip(b'\x00 ').decode('ascii', 'replace')
+		offset += length
+	return None
+
+
+def walk(top: Path | str) -> Iterator[tuple]:
+	"""Walks directory tree top-down with `os.scandir`, following symlinked directories.
+
+	Unlike `os.walk` the directory entries are yielded themselves, so that their cached file
+	type and stat results can be reused.
+
+	Yields
+	------
+	: tuple[str, list[os.DirEntry], list[os.DirEntry]]
+		Path to directory, and its sub-directory and file entries sorted by name.
+	"""
+	with os.scandir(top) as iterator:
+		entries = sorted(iterator, key=lambda entry: entry.name)
+	dirs = [entry for entry in entries if entry.is_dir()]
+	files = [entry for entry in entries if entry.is_file()]
+	yield os.fspath(top), dirs, files
+	for entry in dirs:
+		yield from walk(entry.path)
+
+
+class Classifier:
+	"""Classifies files as DICOM or not, reading at most the leading 132 bytes of each.
+
+	Verdicts are cached per path along with size and modification time of the file, so that
+	each file is read only once per run no matter how many times it is classified.
+
+	Methods
+	-------
+	is_dicom()
+		Checks if file is DICOM.
+	has_dicom()
+		Checks if directory tree contains any DICOM, stopping at the first one.
+	"""
+	def __init__(self) -> None:
+		self._verdicts = {}
+
+	def is_dicom(self, path: os.DirEntry | Path | str) -> bool:
+		"""Checks if file is DICOM.
+
+		Parameters
+		----------
+		path: os.DirEntry | Path | str
+			Path to file, directory entries reuse their cached stat result.
+		"""
+		path_to_file = os.fspath(path)
+		try:
+			stat = path.stat() if isinstance(path, os.DirEntry) else os.stat(path_to_file)
+		except OSError:
+			return False
+		key = (stat.st_size, stat.st_mtime_ns)
+		cached = self._verdicts.get(path_to_file)
+		if cached is not None and cached[0] == key:
+			return cached[1]
+		verdict = False
+		if stat.st_size >= _ELEMENT_HEADER_SIZE:
+			try:
+				with open(path_to_file, 'rb') as handler:
+					verdict = is_dicom_header(handler.read(DICOM_HEADER_SIZE))
+			except OSError as error:
+				log.warning(f'could not read {path_to_file}: {error}')
+		self._verdicts[path_to_file] = (key, verdict)
+		return verdict
+
+	def has_dicom(self, path_to_dir: Path | str) -> bool:
+		"""Checks if directory tree contains any DICOM, stopping at the first one."""
+		for _, _, files in walk(path_to_dir):
+			for entry in files:
+				if self.is_dicom(entry):
+					return True
+		return False
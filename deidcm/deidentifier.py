@@ -1,22 +1,32 @@
 from __future__ import annotations
 
 import os
-import glob
-import shutil
+import time
 import base64
-import hashlib
 import logging
 from pathlib import Path
 
-from tqdm import tqdm
-from pydicom.misc import is_dicom
-
 from deidcm.validation import Validator
-from deidcm.instance import Instance
-from deidcm.dicomdir import DicomDir
+from deidcm.classifier import Classifier
+from deidcm.classifier import walk
+from deidcm.archive import Archive
+from deidcm.archive import ARCHIVE_ERRORS
+from deidcm.archive import split_archive_name
+from deidcm.pool import Job
+from deidcm.pool import Result
+from deidcm.pool import Policies
+from deidcm.pool import JobRunner
 from deidcm.utils import clean
+from deidcm.utils import clone_or_copy
 from deidcm.utils import clean_old_output
-from deidcm.utils import output_bundler
+from deidcm.policy import load_policy
+from deidcm.cache import RunCache
+from deidcm.cache import CACHE_FILE_NAME
+from deidcm.cache import config_fingerprint
+from deidcm.metrics import RunMetrics
+from deidcm.metrics import file_size
+from deidcm.uids import hash_oneway
+from deidcm.uids import load_mapper
 
 
 log = logging.getLogger(__name__)
@@ -35,8 +45,37 @@ class Deidentifier:
 		Creates deidentifier object with input args as attributes.
 	process()
 		Identifies type of each input item and calls appropriate processing routines.
+	process_items()
+		Stages and de-identifies given items together.
 	run()
-		Cleans any old output directories, and iterates processing through each item of input directory.
+		Cleans any old output directory, and iterates processing through each item of input directory.
+		In incremental mode only new or changed items are processed, and previous outputs are reused.
+
+	Notes
+	-----
+	Processing is split in two phases. Each input item is first staged - its output directories are
+	created, archives are scanned - and every DICOM instance found is queued as an individual job.
+	All queued jobs, including the members of archives, are then run together, optionally over a
+	pool of `workers` processes. The output layout does not depend on the number of workers.
+
+	Outputs are written once, straight into their final location. That is `output_directory` if
+	given, otherwise `{input_directory}/deidentified`, or the working directory with
+	`no_bundled_output`. Runs with distinct output directories are isolated from one another.
+
+	With `incremental` set, a cache of processed items is kept in the output directory, see
+	`RunCache`. Re-runs then skip items left unchanged since the previous run along with the same
+	tag configs and options, and merge the outputs of the rest into the existing ones.
+
+	Every run records per-stage durations, bytes read and written and instance counts of each
+	item in `metrics`, see `RunMetrics`. The report is written as JSON to `metrics_path` and in
+	Prometheus text format to `prometheus_path`, if given.
+
+	With `uid_key` set, all UIDs are replaced with pseudonyms derived from the key, see `UidMapper`,
+	consistently across instances, DICOMDIR records, runs and batches, and directories are renamed
+	with pseudonyms instead of their encoded names. Mappings are also stored in `uid_store`, if given.
+
+	Jobs run over a process pool of their own, unless `executor` is set to an existing one, e.g.
+	a pool kept warm by a long-running service.
 	"""
 	
 	@classmethod
@@ -44,69 +83,137 @@ class Deidentifier:
 		"""Creates a deidentifier object."""
 		setattr(cls, 'input_directory', args.InputDirectory)
 		setattr(cls, 'no_bundled_output', args.no_bundled_output)
+		setattr(cls, 'output_directory', getattr(args, 'output_directory', None))
 		setattr(cls, 'skip_private_tags', args.skip_private_tags)
+		setattr(cls, 'workers', getattr(args, 'workers', 1) or 1)
+		setattr(cls, 'stream', getattr(args, 'stream', False))
+		setattr(cls, 'incremental', getattr(args, 'incremental', False))
+		setattr(cls, 'content_hash', getattr(args, 'content_hash', False))
+		setattr(cls, 'metrics_path', getattr(args, 'metrics', None))
+		setattr(cls, 'prometheus_path', getattr(args, 'prometheus', None))
+		setattr(cls, 'archive_compression', getattr(args, 'archive_compression', None) or 'keep')
+		setattr(cls, 'executor', None)
+		uid_key = getattr(args, 'uid_key', None)
+		uids = load_mapper(uid_key.encode(), getattr(args, 'uid_store', None)) if uid_key else None
+		setattr(cls, 'policies', Policies(load_policy('keep'), load_policy('redact'), uids))
 		deidentifier = cls()
 		log.info(f'deidentifier object created to process: {cls.input_directory}')
 		return deidentifier
 
-	def _deidentify_dicomdir(self, item_path) -> None:
+	def _deidentify_dicomdir(self, item_path) -> Path:
 		"""Process DICOMDIR file."""
-		dicom_path = Path('DICOMDIR')
-		shutil.copy(item_path, dicom_path)
-		DicomDir(dicom_path).deidentify()
+		dicomdir_path = self._output_path('DICOMDIR')
+		self._jobs.append(Job('dicomdir', item_path, dicomdir_path))
+		return dicomdir_path
 
-	def _deidentify_file(self, full_file_name: str, item_path: Path) -> None:
+	def _deidentify_file(self, full_file_name: str, item_path: Path) -> Path:
 		"""Processes plain DICOM file."""
 		fname, ext = os.path.splitext(full_file_name)
-		dicom_path = Path(f'{fname}_deidentified{ext}')
-		shutil.copy(item_path, dicom_path)
-		Instance(dicom_path).deidentify(self.skip_private_tags)
+		dicom_path = self._output_path(f'{fname}_deidentified{ext}')
+		self._jobs.append(Job('instance', item_path, dicom_path))
+		return dicom_path
 
 	def _get_hash_oneway(self, somestring: str) -> str:
 		"""Sha256 hash value."""
-		h = hashlib.new('sha256')
-		h.update(somestring.encode())
-		return h.hexdigest()
+		return hash_oneway(somestring)
 
 	def _get_encode(self, somestring: str) -> str:
-		"""Base64 encoding."""
+		"""Base64 encoding, or pseudonym if UIDs are pseudonymised."""
+		if self.policies.uids is not None:
+			return self.policies.uids.map_id(somestring)
 		return base64.b64encode(somestring.encode('ascii')).decode('ascii')
 
-	def _deidentify_dir(self, dir_name: str, item_path: Path) -> str:
-		"""Processes directory containing DICOM data."""
+	def _deidentify_dir(self, dir_name: str, item_path: Path) -> Path:
+		"""Processes directory containing DICOM data.
+
+		The output tree is created up front. DICOM files are queued to be read from the input tree
+		and written once into the output tree, while all other files are copied over as they are.
+		Top level sub-directories containing DICOM data are renamed with their encoded names.
+		"""
 		#dir_name = self._get_encode(dir_name)
-		dir_path = Path(f'{dir_name}_deidentified')
-		shutil.copytree(item_path, dir_path)
-
-		for item in os.listdir(dir_path):
-			subitem_path = Path(f'{dir_path}/{item}')
-			if subitem_path.is_dir():
-				subitem_is = Validator(subitem_path).check()
-				if subitem_is.dicom:
-					new_name = self._get_encode(item)
-					shutil.move(subitem_path, f'{dir_path}/{new_name}')
-		
-		for path_to_file in glob.glob(str(dir_path) + '**/**', recursive=True):
-			if path_to_file.split('/')[-1] == 'DICOMDIR':
-				DicomDir(path_to_file).deidentify()
-				continue
-			if Path(path_to_file).is_file() and is_dicom(path_to_file):
-				Instance(path_to_file).deidentify(self.skip_private_tags)
-		return dir_name
-
-	def _deidentify_compressed(self, item: str, item_path: Path) -> None:
-		"""Processes compressed files."""
-		fname, ext = os.path.splitext(item)
-		shutil.unpack_archive(item_path)
-		if Path(fname).is_file():
-			self._deidentify_file(fname, Path(fname))
-		else:
-			new_name = self._deidentify_dir(fname, Path(fname))
-		shutil.make_archive(f'{new_name}_deidentified', ext[1:], f'{new_name}_deidentified')
-		clean(Path(fname))
-		clean(Path(f'{new_name}_deidentified'))
+		dir_path = self._output_path(f'{dir_name}_deidentified')
+		renames = {}
+		_, subdirs, _ = next(walk(item_path))
+		for entry in subdirs:
+			subitem_is = Validator(Path(entry.path), self._classifier).check()
+			if subitem_is.dicom:
+				renames[entry.name] = self._get_encode(entry.name)
 
-	def process(self, item: str) -> None:
+		dir_path.mkdir()
+		for root, _, files in walk(item_path):
+			relative = Path(root).relative_to(item_path)
+			if relative.parts:
+				relative = Path(renames.get(relative.parts[0], relative.parts[0]), *relative.parts[1:])
+			(dir_path / relative).mkdir(exist_ok=True)
+			for entry in files:
+				output_file = dir_path / relative / entry.name
+				if entry.name == 'DICOMDIR':
+					self._jobs.append(Job('dicomdir', Path(entry.path), output_file))
+				elif self._classifier.is_dicom(entry):
+					self._jobs.append(Job('instance', Path(entry.path), output_file))
+				else:
+					size = entry.stat().st_size
+					with self.metrics.stage(dir_name, 'copy', bytes_read=size, bytes_written=size):
+						clone_or_copy(entry.path, output_file)
+		return dir_path
+
+	def _deidentify_compressed(self, item: str, item_path: Path, item_format: str) -> Path:
+		"""Processes compressed files.
+
+		The archive is never unpacked, its members are de-identified on the fly and written into
+		an output archive of the same format as soon as they are ready, compressed as set by
+		`archive_compression`.
+		"""
+		fname, ext = split_archive_name(item)
+		archive = Archive(item_path, item_format, self._get_encode, self.archive_compression)
+		with self.metrics.stage(item, 'scan'):
+			archive.scan()
+		archive_path = self._output_path(f'{fname}_deidentified{ext}')
+		self._archives.append((archive, archive_path))
+		return archive_path
+
+	def _reset(self) -> None:
+		"""Clears queued jobs and archives."""
+		self._jobs = []
+		self._archives = []
+		self._unreadable = []
+		self._classifier = Classifier()
+
+	def _check(self, item_path: Path) -> namedtuple:
+		"""Identifies type of an input item, see `Validator.check()`."""
+		return Validator(item_path, self._classifier).check()
+
+	def _run_jobs(self, runner: JobRunner) -> list:
+		"""Runs all queued file jobs, returning their results in order."""
+		return runner.run(self._jobs)
+
+	def _execute(self) -> None:
+		"""Runs all queued jobs and archives, and reports failed files."""
+		total = len(self._jobs) + sum(len(archive.dicom) for archive, _ in self._archives)
+		log.info(f'deidentifying {total} files with {self.workers} worker(s)')
+		with JobRunner(self.skip_private_tags, self.workers, self.policies, self.stream, total, self.executor) as runner:
+			results = self._unreadable + self._run_jobs(runner)
+			for archive, output_path in self._archives:
+				start = time.perf_counter()
+				try:
+					results += archive.deidentify(output_path, runner)
+				except ARCHIVE_ERRORS as error:
+					log.error(f'failed to read {archive.path}: {error!r}')
+					results.append(Result(str(archive.path), repr(error)))
+					if output_path.exists():
+						clean(output_path)
+					continue
+				self.metrics.record(archive.path.name, 'archive', time.perf_counter() - start,
+					file_size(archive.path), file_size(output_path))
+		self.results = results
+		self.failures = [result for result in results if result.error is not None]
+		for result in results:
+			self.metrics.merge(self._item_of(result.path), result.error is not None, result.timings)
+		if self.failures:
+			log.warning(f'{len(self.failures)} files could not be deidentified')
+		self._reset()
+
+	def _stage(self, item: str) -> Path | None:
 		"""Determined item type and calls individual processing methods for each type.
 
 		DICOMDIR file is processed separately.
@@ -115,30 +222,164 @@ class Deidentifier:
 		----------
 		item: str
 			Full file/dir name of processing item.
+
+		Returns
+		-------
+		: Path | None
+			Output path of the item, None if it holds no DICOM data.
 		"""
 		item_path = Path(f'{self.input_directory}/{item}')
-		item_is = Validator(item_path).check()
+		with self.metrics.stage(item, 'validate'):
+			item_is = self._check(item_path)
 		if item == 'DICOMDIR':
-			item_is.dicom = True
+			item_is = item_is._replace(dicom=True)
 			log.info(f'{item} --- {item_is}')
-			self._deidentify_dicomdir(item_path)
-			return
+			return self._deidentify_dicomdir(item_path)
 		log.info(f'{item} --- {item_is}')
+		if item_is.error is not None:
+			self._unreadable.append(Result(str(item_path), item_is.error))
+			return None
 		if item_is.dicom:
 			if not item_is.dir and not item_is.compressed:
-				self._deidentify_file(item, item_path)				
+				return self._deidentify_file(item, item_path)
 			if item_is.dir:
-				self._deidentify_dir(item, item_path)
+				return self._deidentify_dir(item, item_path)
 			if item_is.compressed:
-				self._deidentify_compressed(item, item_path)
+				try:
+					return self._deidentify_compressed(item, item_path, item_is.archive_format)
+				except ARCHIVE_ERRORS as error:
+					log.error(f'failed to read {item_path}: {error!r}')
+					self._unreadable.append(Result(str(item_path), repr(error)))
+		return None
+
+	def _output_root(self) -> Path:
+		"""Directory the outputs are written to."""
+		if self.output_directory:
+			return Path(self.output_directory)
+		if self.no_bundled_output:
+			return Path('.')
+		return Path(f'{self.input_directory}/deidentified')
+
+	def _output_path(self, name: str) -> Path:
+		"""Path to write an output to, removing any previous output of the same name."""
+		output_path = self._output_root() / name
+		if output_path.exists():
+			clean(output_path)
+		return output_path
+
+	def _items(self) -> list:
+		"""Input items to process, leaving out outputs and the cache of previous runs."""
+		output_root = self._output_root().resolve()
+		items = []
+		for item in sorted(os.listdir(self.input_directory)):
+			if item in ('deidentified', CACHE_FILE_NAME) or item.startswith(f'{CACHE_FILE_NAME}.'):
+				continue
+			if Path(f'{self.input_directory}/{item}').resolve() == output_root:
+				continue
+			items.append(item)
+		return items
+
+	def _cache_path(self) -> Path:
+		"""Path to the cache of items processed by previous runs, kept with their outputs."""
+		return self._output_root() / CACHE_FILE_NAME
+
+	def _open_cache(self) -> RunCache:
+		"""Cache of items processed by previous runs, see `RunCache`."""
+		return RunCache(self._cache_path(),
+			config_fingerprint(self.skip_private_tags, self.policies.uids, self.archive_compression), self.content_hash)
+
+	def _remove_outputs(self, names: list) -> None:
+		"""Removes outputs of a previous run."""
+		for name in names:
+			if (self._output_root() / name).exists():
+				clean(self._output_root() / name)
+
+	def _item_of(self, path: str) -> str:
+		"""Name of the input item a processed file belongs to."""
+		return Path(path).relative_to(Path(self.input_directory)).parts[0]
+
+	def _failed_items(self) -> set:
+		"""Names of input items with any file that failed to deidentify."""
+		return {self._item_of(result.path) for result in self.failures}
+
+	def _report(self) -> None:
+		"""Stops the run metrics and writes out the requested reports."""
+		self.metrics.finish()
+		if self.metrics_path:
+			self.metrics.write_json(self.metrics_path)
+		if self.prometheus_path:
+			self.metrics.write_prometheus(self.prometheus_path)
+
+	def process(self, item: str) -> None:
+		"""Stages a single item and de-identifies all of its instances.
+
+		Parameters
+		----------
+		item: str
+			Full file/dir name of processing item.
+		"""
+		self.metrics = RunMetrics()
+		self._output_root().mkdir(parents=True, exist_ok=True)
+		self._reset()
+		self._stage(item)
+		self._execute()
+		log.info(f'{item} <--- deidentified.')
+		self._report()
+
+	def process_items(self, items: list, cache: RunCache | None = None) -> dict:
+		"""Stages the given items and de-identifies all of their instances together.
+
+		Parameters
+		----------
+		items: list[str]
+			Full file/dir names of processing items.
+		cache: RunCache | None
+			Cache of processed items. Items left unchanged since cached are skipped, and the others
+			recorded once processed, unless any of their files failed.
+
+		Returns
+		-------
+		: dict[str, list]
+			Output names of each processed item.
+		"""
+		self._reset()
+		staged = {}
+		for item in items:
+			key = None
+			if cache is not None:
+				key = cache.item_key(Path(f'{self.input_directory}/{item}'))
+				if cache.is_fresh(item, key, self._output_root()):
+					log.info(f'{item} --- unchanged, reusing previous output')
+					continue
+				self._remove_outputs(cache.outputs(item))
+			output_path = self._stage(item)
+			staged[item] = (key, [output_path.name] if output_path is not None else [])
+		self._execute()
+		if cache is not None:
+			failed = self._failed_items()
+			for item, (key, outputs) in staged.items():
+				if item in failed:
+					cache.forget(item)
+				else:
+					cache.update(item, key, outputs)
+		return {item: outputs for item, (_, outputs) in staged.items()}
 
 	def run(self) -> None:
 		"""Processes each item in input directory, and bundles the outputs if applicable."""
-		clean_old_output(self.input_directory)
-		items = os.listdir(self.input_directory)
+		self.metrics = RunMetrics()
+		if not self.incremental and not self.output_directory and not self.no_bundled_output:
+			clean_old_output(self._output_root())
+		self._output_root().mkdir(parents=True, exist_ok=True)
+		items = self._items()
+		cache = self._open_cache() if self.incremental else None
 		log.info(f'processing {len(items)} items')
-		for item in tqdm(items, total=len(items)):
-			self.process(item)
-			log.info(f'{item} <--- deidentified.')
-		if not self.no_bundled_output:
-			output_bundler(self.input_directory)
+		staged = self.process_items(items, cache)
+		log.info(f'{len(staged)} items <--- deidentified.')
+		log.info(f'deidentified data ready at: {self._output_root()}')
+		if cache is not None:
+			for item in set(cache.entries) - set(items):
+				log.info(f'{item} --- removed from input, removing its output')
+				self._remove_outputs(cache.outputs(item))
+				cache.forget(item)
+			cache.save()
+		self._report()
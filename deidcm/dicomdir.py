@@ -1,17 +1,142 @@
 from __future__ import annotations
 
+import os
+import mmap
+import struct
 import logging
 import warnings
 from pathlib import Path
+from typing import BinaryIO
 
 from pydicom import dcmread
+from pydicom.uid import ExplicitVRLittleEndian
 
-from deidcm.utils import parse_tag_config
+from deidcm.policy import TagPolicy
+from deidcm.classifier import EXTENDED_LENGTH_VRS
+from deidcm.policy import load_policy
+from deidcm.uids import UidMapper
+from deidcm.utils import clone_or_copy
+from deidcm.metrics import Timings
+from deidcm.metrics import file_size
 
 
 log = logging.getLogger(__name__)
 
 
+_PREAMBLE_SIZE = 132
+_STRING_VRS = {b'AE', b'AS', b'CS', b'DA', b'DS', b'DT', b'IS', b'LO', b'LT', b'PN', b'SH', b'ST', b'TM', b'UC', b'UT'}
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+_ITEM = 0xFFFEE000
+_ITEM_DELIMITER = 0xFFFEE00D
+_SEQUENCE_DELIMITER = 0xFFFEE0DD
+_TRANSFER_SYNTAX_UID = 0x00020010
+_DIRECTORY_RECORD_SEQUENCE = 0x00041220
+
+
+class _Patcher:
+	"""Collects same-length value patches of a DICOMDIR with a minimal explicit VR little endian parser.
+
+	Only element headers are parsed, values are never decoded except for the ones to patch, and
+	nothing is written until the whole file was parsed successfully.
+	"""
+	def __init__(self, buffer: bytes | mmap.mmap, tags: TagPolicy, uids: UidMapper | None) -> None:
+		self.buffer = buffer
+		self.tags = tags
+		self.uids = uids
+		self.patches = []
+		self.redacted = 0
+
+	def _element(self, offset: int) -> tuple:
+		"""Parses element header at offset, returning its tag, VR, value offset and value length."""
+		group, element = struct.unpack_from('<HH', self.buffer, offset)
+		tag = group << 16 | element
+		if group == 0xFFFE:
+			length, = struct.unpack_from('<L', self.buffer, offset + 4)
+			return tag, None, offset + 8, length
+		vr = bytes(self.buffer[offset + 4:offset + 6])
+		if vr in EXTENDED_LENGTH_VRS:
+			length, = struct.unpack_from('<L', self.buffer, offset + 8)
+			return tag, vr, offset + 12, length
+		length, = struct.unpack_from('<H', self.buffer, offset + 6)
+		return tag, vr, offset + 8, length
+
+	def _value(self, start: int, length: int) -> bytes:
+		return bytes(self.buffer[start:start + length]).rstrip(b' \0')
+
+	def _visit(self, tag: int, vr: bytes, start: int, length: int, in_record: bool) -> None:
+		"""Queues patches of a single element value."""
+		if vr == b'UI' and self.uids is not None and not self.uids.keeps(tag):
+			uid = self._value(start, length).decode('ascii')
+			pseudonym = self.uids.map_uid(uid)
+			if pseudonym != uid:
+				self.patches.append((start, pseudonym.encode('ascii')))
+		elif in_record and vr in _STRING_VRS and tag in self.tags:
+			value = self._value(start, length)
+			if value:
+				self.patches.append((start, b'0' * len(value)))
+				self.redacted += 1
+
+	def dataset(self, offset: int, end: int | None, in_record: bool = False) -> int:
+		"""Walks elements from offset up to end, or up to an item delimiter if end is None.
+
+		Returns
+		-------
+		: int
+			Offset right after the dataset.
+		"""
+		while end is None or offset < end:
+			tag, vr, start, length = self._element(offset)
+			if tag == _ITEM_DELIMITER:
+				return start
+			if vr == b'SQ':
+				offset = self.sequence(start, length, in_record or tag == _DIRECTORY_RECORD_SEQUENCE)
+				continue
+			if length == _UNDEFINED_LENGTH:
+				raise ValueError(f'undefined length {vr} element at offset {offset}')
+			if start + length > len(self.buffer):
+				raise ValueError(f'element at offset {offset} runs past the end of file')
+			self._visit(tag, vr, start, length, in_record)
+			offset = start + length
+		return offset
+
+	def sequence(self, offset: int, length: int, in_record: bool) -> int:
+		"""Walks items of a sequence value, returning the offset right after it."""
+		end = None if length == _UNDEFINED_LENGTH else offset + length
+		while end is None or offset < end:
+			tag, _, start, item_length = self._element(offset)
+			if tag == _SEQUENCE_DELIMITER:
+				return start
+			if tag != _ITEM:
+				raise ValueError(f'unexpected tag {tag:08X} in sequence at offset {offset}')
+			if item_length == _UNDEFINED_LENGTH:
+				offset = self.dataset(start, None, in_record)
+			else:
+				self.dataset(start, start + item_length, in_record)
+				offset = start + item_length
+		return offset
+
+	def parse(self) -> list:
+		"""Parses the whole file, returning the patches as (offset, bytes) pairs."""
+		if bytes(self.buffer[128:_PREAMBLE_SIZE]) != b'DICM':
+			raise ValueError('no DICM prefix')
+		tag, vr, start, length = self._element(_PREAMBLE_SIZE)
+		if tag != 0x00020000 or vr != b'UL':
+			raise ValueError('no file meta group length')
+		meta_end = start + length + struct.unpack_from('<L', self.buffer, start)[0]
+		transfer_syntax = None
+		offset = start + length
+		while offset < meta_end:
+			tag, vr, start, length = self._element(offset)
+			if tag == _TRANSFER_SYNTAX_UID:
+				transfer_syntax = self._value(start, length).decode('ascii')
+			self._visit(tag, vr, start, length, False)
+			offset = start + length
+		if transfer_syntax != ExplicitVRLittleEndian:
+			raise ValueError(f'unsupported transfer syntax {transfer_syntax}')
+		self.dataset(meta_end, len(self.buffer))
+		return self.patches
+
+
 class DicomDir:
 	"""Deidentifies a given DICOMDIR instance file.
 
@@ -23,45 +148,129 @@ class DicomDir:
 	"JOHN" becomes "0000". The sole purpose here is to preserve the native byte offsets among 
 	records.
 
+	Since every edit keeps the value length, the file is never re-serialised. A minimal parser
+	locates the values to redact in all records, and they are overwritten in place in a memory
+	mapped copy of the file. DICOMDIR files not in explicit VR little endian, as mandated by the
+	standard, fall back to a full read and write with pydicom.
+
 
 	Attributes
 	----------
 	path: Path
 		Path to DICOMDIR instance.
-	tags: list[str]
-		List of tag names to be de-identified.
+	tags: TagPolicy
+		Compiled list of tags to be redacted.
+	uids: UidMapper | None
+		Mapper to pseudonymise UIDs of all records with, keeping their lengths and so the offsets.
+	timings: Timings
+		Durations and bytes of the read, redact and write stages.
 
 	Methods
 	-------
 	deidentify()
-		Parses the entire contents and removes tags from de-identification tag list.
+		Redacts tags from de-identification tag list in place, in all records.
 	"""
-	def __init__(self, dicom_path: Path) -> None:
+	def __init__(self, dicom_path: Path, policy: TagPolicy | None = None, uids: UidMapper | None = None) -> None:
 		self.path = dicom_path
-		self.tags = parse_tag_config('redact')
+		self.tags = policy if policy is not None else load_policy('redact')
+		self.uids = uids
+		self.timings = Timings()
 
 	def _redact_tags(self, header: pydicom.FileDataSet) -> None:
-		"""Redacts PHI tags within the first two records of (0004, 1220) sequence.
-
-		Record#1: PATIENT
-		Record#2: STUDY
+		"""Redacts PHI tags within the records of (0004, 1220) sequence, e.g. PATIENT and STUDY.
 
 		Parameters
 		----------
 		header: pydicom.FileDataSet
 			Parsed DICOMDIR header.
 		"""
-		for record in range(2):
-			for elem in header[0x0004, 0x1220][record]:
-				if elem.tag in self.tags:
+		for record, item in enumerate(header[0x0004, 0x1220]):
+			for elem in item:
+				if elem.tag in self.tags and elem.value:
 					log.info(f'redacting {elem.tag} in record {record+1}')
 					with warnings.catch_warnings():
 						warnings.simplefilter("ignore")
 						elem.value = '0' * len(elem.value)
 
-	def deidentify(self) -> None:
-		"""Performs DICOMDIR de-identification."""
-		with dcmread(self.path) as header:
+	def _deidentify_in_place(self, output_path: Path | BinaryIO) -> bool:
+		"""Patches redacted values into a copy of the file, without re-serialising it.
+
+		Returns
+		-------
+		: bool
+			False if the file could not be parsed and nothing was written.
+		"""
+		with self.timings.stage('read', bytes_read=file_size(self.path)):
+			if hasattr(self.path, 'read'):
+				self.path.seek(0)
+				buffer = self.path.read()
+				patcher = _Patcher(buffer, self.tags, self.uids)
+				patches = self._parse(patcher)
+			else:
+				with open(self.path, 'rb') as source:
+					if os.fstat(source.fileno()).st_size < _PREAMBLE_SIZE:
+						return False
+					with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+						patcher = _Patcher(buffer, self.tags, self.uids)
+						patches = self._parse(patcher)
+			if patches is None:
+				return False
+		log.info(f'---> {getattr(self.path, "name", self.path)}: {patcher.redacted} values redacted')
+		with self.timings.stage('redact'):
+			if self.uids is not None:
+				self.uids.flush()
+			if hasattr(output_path, 'write'):
+				if not hasattr(self.path, 'read'):
+					with open(self.path, 'rb') as source:
+						buffer = source.read()
+				output = bytearray(buffer)
+				for offset, value in patches:
+					output[offset:offset + len(value)] = value
+		with self.timings.stage('write'):
+			if hasattr(output_path, 'write'):
+				if output_path is self.path:
+					output_path.seek(0)
+				output_path.write(output)
+			else:
+				if not (os.path.exists(output_path) and os.path.samefile(output_path, self.path)):
+					clone_or_copy(self.path, output_path)
+				with open(output_path, 'r+b') as destination, mmap.mmap(destination.fileno(), 0) as mapped:
+					for offset, value in patches:
+						mapped[offset:offset + len(value)] = value
+					mapped.flush()
+		self.timings.add('write', bytes_written=sum(len(value) for _, value in patches))
+		return True
+
+	def _parse(self, patcher: _Patcher) -> list | None:
+		"""Collects patches, None if the file is not a DICOMDIR the parser supports."""
+		try:
+			return patcher.parse()
+		except (ValueError, struct.error, UnicodeDecodeError) as error:
+			log.info(f'{getattr(self.path, "name", self.path)} can not be patched in place, rewriting it: {error}')
+			return None
+
+	def deidentify(self, output_path: Path | BinaryIO | None = None) -> None:
+		"""Performs DICOMDIR de-identification.
+
+		Parameters
+		----------
+		output_path: Path | BinaryIO
+			Where to write the de-identified copy, overwrites the DICOMDIR itself if not given.
+		"""
+		output_path = output_path if output_path is not None else self.path
+		if self._deidentify_in_place(output_path):
+			return
+		with self.timings.stage('read', bytes_read=file_size(self.path)):
+			if hasattr(self.path, 'read'):
+				# left at the end of file by the attempt to patch it in place
+				self.path.seek(0)
+			header = dcmread(self.path)
+		with header:
 			log.info(f'---> {self.path}')
-			self._redact_tags(header)
-			header.save_as(self.path)
+			with self.timings.stage('redact'):
+				self._redact_tags(header)
+				if self.uids is not None:
+					self.uids.remap(header)
+			with self.timings.stage('write'):
+				header.save_as(output_path)
+		self.timings.add('write', bytes_written=file_size(output_path))
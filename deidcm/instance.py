@@ -1,46 +1,77 @@
 from __future__ import annotations
 
+import os
+import struct
 import logging
+import tempfile
 from pathlib import Path
+from typing import BinaryIO
+from typing import Iterator
+from contextlib import contextmanager
 
 from pydicom import dcmread
+from pydicom.uid import UID
+from pydicom.uid import DeflatedExplicitVRLittleEndian
 
-from deidcm.utils import parse_tag_config
+from deidcm.classifier import EXTENDED_LENGTH_VRS
+from deidcm.classifier import transfer_syntax
+from deidcm.policy import TagPolicy
+from deidcm.policy import load_policy
+from deidcm.uids import UidMapper
+from deidcm.utils import copy_range
+from deidcm.metrics import Timings
+from deidcm.metrics import file_size
 
 
 log = logging.getLogger(__name__)
 
 
+# leading bytes read to find the transfer syntax, enough for the file meta of any usual instance
+_FILE_META_SIZE = 4096
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+_ITEM = (0xFFFE, 0xE000)
+_SEQUENCE_DELIMITER = (0xFFFE, 0xE0DD)
+
+
 class Instance:
 	"""Deidentifies a given DICOM instance.
 
 	Attributes
 	----------
-	path: Path
-		Path to DICOM instance.
-	tags: list
-		List of tag names to be de-identified.
+	path: Path | BinaryIO
+		Path to DICOM instance, or a seekable file object holding it.
+	tags: TagPolicy
+		Compiled keep-list of tags.
+	uids: UidMapper | None
+		Mapper to pseudonymise UIDs with, UIDs are kept as they are if not given.
+	timings: Timings
+		Durations and bytes of the read, filter and write stages.
 
 	Methods
 	-------
+	edit()
+		Applies keep-list, private tag and UID edits to a parsed header.
 	deidentify()
 		Reads header until pixel_data and recursively nulls values of de-identification tag list.
+
+	Notes
+	-----
+	In streaming mode only the header up to the pixel data element is parsed. The de-identified
+	header is written out and the pixel data element is then copied over byte-for-byte, by the
+	kernel between regular files, or else as a slice of a memory map of the source file (or of the
+	buffer of an in-memory source). Memory use is thus bounded by the header size, and pixel data
+	is neither decoded nor materialised as a bytes object. Deflated transfer syntax can not be streamed and falls back to a full read.
+
+	Instances with encapsulated transfer syntaxes, e.g. JPEG, JPEG 2000 and RLE, are always
+	de-identified this way, streaming or not. Their Basic Offset Table and fragments are thus
+	copied over byte-for-byte and never reach pydicom, so no pixel data handler or encoder can
+	ever decode or re-encode them, and the transfer syntax of the output stays the same.
 	"""
-	def __init__(self, dicom_path: Path) -> None:
+	def __init__(self, dicom_path: Path, policy: TagPolicy | None = None, uids: UidMapper | None = None) -> None:
 		self.path = dicom_path
-		self.tags = parse_tag_config('keep')
-
-	def _filter_tags(self, header: pydicom.FileDataSet) -> None:
-		"""Filters base level tags and removes if it does not exist in keep-list.
-
-		Parameters
-		----------
-		header: pydicom.FileDataSet
-			Parsed DICOM header including pixel data.
-		"""
-		for elem in header:
-			if elem.tag not in self.tags:
-				del header[elem.tag]
+		self.tags = policy if policy is not None else load_policy('keep')
+		self.uids = uids
+		self.timings = Timings()
 
 	def _recursive_edit(self, header: pydicom.FileDataSet, tag_name: str) -> None:
 		"""Recursively edits inplace all occurences of given tag value.
@@ -65,21 +96,150 @@ class Instance:
 			if elem.tag.group % 2 != 0:
 				elem.value = ''
 
-	def deidentify(self, priv_tag_flag: bool) -> None:
+	@staticmethod
+	def edit(header: pydicom.Dataset, policy: TagPolicy, priv_tag_flag: bool, uids: UidMapper | None = None) -> None:
+		"""Applies keep-list, private tag and UID edits to a parsed header in place.
+
+		Parameters
+		----------
+		header: pydicom.Dataset
+			Parsed DICOM header, with or without pixel data.
+		policy: TagPolicy
+			Compiled keep-list of tags, base level elements not in it are removed.
+		priv_tag_flag: bool
+			If true all private tags are untouched. If false all of them removed.
+		uids: UidMapper | None
+			Mapper to pseudonymise UIDs with, UIDs are kept as they are if not given.
+		"""
+		# For keep list
+		policy.filter(header)
+		# For remove list
+		#for tag in self.tags:
+		#	self._recursive_edit(header, tag)
+		if not priv_tag_flag:
+			header.remove_private_tags()
+		if uids is not None:
+			uids.remap(header)
+
+	@staticmethod
+	def _locate_element_end(source: BinaryIO, is_implicit_VR: bool, is_little_endian: bool) -> tuple:
+		"""Parses the element header at current position and locates the end of its value.
+
+		Undefined length values, e.g. encapsulated pixel data, are walked item by item up to the
+		sequence delimiter without reading the item values.
+
+		Returns
+		-------
+		: tuple[int, int]
+			Tag of the element and offset right after its value.
+		"""
+		endian = '<' if is_little_endian else '>'
+		group, element = struct.unpack(f'{endian}HH', source.read(4))
+		if is_implicit_VR:
+			length, = struct.unpack(f'{endian}L', source.read(4))
+		elif source.read(2) in EXTENDED_LENGTH_VRS:
+			length, = struct.unpack(f'{endian}2xL', source.read(6))
+		else:
+			length, = struct.unpack(f'{endian}H', source.read(2))
+		if length != _UNDEFINED_LENGTH:
+			return group << 16 | element, source.tell() + length
+		while True:
+			item_group, item_element, item_length = struct.unpack(f'{endian}HHL', source.read(8))
+			if (item_group, item_element) == _SEQUENCE_DELIMITER:
+				return group << 16 | element, source.tell()
+			if (item_group, item_element) != _ITEM:
+				raise ValueError(f'unexpected tag ({item_group:04X},{item_element:04X}) in undefined length value')
+			source.seek(item_length, os.SEEK_CUR)
+
+	def _is_encapsulated(self) -> bool:
+		"""Checks whether the instance has an encapsulated transfer syntax, from its file meta only."""
+		with self._open_source() as source:
+			syntax = transfer_syntax(source.read(_FILE_META_SIZE))
+		return syntax is not None and UID(syntax).is_encapsulated
+
+	@contextmanager
+	def _open_source(self) -> Iterator[BinaryIO]:
+		"""Opens the instance for reading, file objects are rewound and left open."""
+		if hasattr(self.path, 'read'):
+			self.path.seek(0)
+			yield self.path
+			return
+		with open(self.path, 'rb') as source:
+			yield source
+
+	def _write_stream(self, header: pydicom.FileDataSet, source: BinaryIO, destination: BinaryIO,
+		pixel_tag: int | None, pixel_start: int, pixel_end: int) -> None:
+		"""Writes the de-identified header and copies the pixel data element over from source."""
+		header.save_as(destination)
+		if pixel_tag is not None and pixel_tag in self.tags:
+			copy_range(source, destination, pixel_start, pixel_end - pixel_start)
+
+	def _deidentify_stream(self, priv_tag_flag: bool, output_path: Path | BinaryIO) -> bool:
+		"""Performs header-only de-identification and copies pixel data over untouched.
+
+		The output is written to a temporary file next to the output path and then moved in place,
+		so that the output path can also be the instance itself. File object outputs are written
+		to directly.
+
+		Returns
+		-------
+		: bool
+			False if the instance can not be streamed and nothing was written.
+		"""
+		with self._open_source() as source:
+			with self.timings.stage('read'):
+				header = dcmread(source, stop_before_pixels=True, force=True)
+				if header.file_meta.get('TransferSyntaxUID') == DeflatedExplicitVRLittleEndian:
+					return False
+				pixel_start = source.tell()
+				pixel_tag, pixel_end = None, pixel_start
+				if pixel_start < source.seek(0, os.SEEK_END):
+					source.seek(pixel_start)
+					pixel_tag, pixel_end = self._locate_element_end(source, header.is_implicit_VR, header.is_little_endian)
+			self.timings.add('read', bytes_read=pixel_start)
+			with self.timings.stage('filter'):
+				self.edit(header, self.tags, priv_tag_flag, self.uids)
+			copied = pixel_end - pixel_start if pixel_tag is not None and pixel_tag in self.tags else 0
+			if hasattr(output_path, 'write'):
+				with self.timings.stage('write', bytes_read=copied):
+					self._write_stream(header, source, output_path, pixel_tag, pixel_start, pixel_end)
+				self.timings.add('write', bytes_written=file_size(output_path))
+				return True
+			output_path = Path(output_path)
+			descriptor, temp_path = tempfile.mkstemp(dir=output_path.parent, prefix=f'.{output_path.name}.')
+			try:
+				with os.fdopen(descriptor, 'wb') as destination, self.timings.stage('write', bytes_read=copied):
+					self._write_stream(header, source, destination, pixel_tag, pixel_start, pixel_end)
+					self.timings.add('write', bytes_written=destination.tell())
+			except BaseException:
+				os.remove(temp_path)
+				raise
+		os.replace(temp_path, output_path)
+		return True
+
+	def deidentify(self, priv_tag_flag: bool, stream: bool = False, output_path: Path | BinaryIO | None = None) -> None:
 		"""Performs instance de-identification.
 
 		Parameters
 		----------
 		priv_tag_flag: bool
 			If true all private tags are untouched. If false all of them nulled.
+		stream: bool
+			If true only the header is parsed and pixel data is copied over byte-for-byte. Always
+			the case for encapsulated pixel data.
+		output_path: Path | BinaryIO
+			Where to write the de-identified copy, overwrites the instance itself if not given.
 		"""
-		with dcmread(self.path) as header:
-			log.info(f'---> {self.path}')
-			# For keep list
-			self._filter_tags(header)
-			# For remove list
-			#for tag in self.tags:
-			#	self._recursive_edit(header, tag)
-			if not priv_tag_flag:
-				header.remove_private_tags()
-			header.save_as(self.path)
+		log.info(f'---> {getattr(self.path, "name", self.path)}')
+		output_path = output_path if output_path is not None else self.path
+		if (stream or self._is_encapsulated()) and self._deidentify_stream(priv_tag_flag, output_path):
+			return
+		with self._open_source() as source:
+			with self.timings.stage('read'):
+				header = dcmread(source, force=True)
+			self.timings.add('read', bytes_read=source.tell())
+			with self.timings.stage('filter'):
+				self.edit(header, self.tags, priv_tag_flag, self.uids)
+			with self.timings.stage('write'):
+				header.save_as(output_path)
+			self.timings.add('write', bytes_written=file_size(output_path))
@@ -0,0 +1,336 @@
+from __future__ import annotations
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from typing import Iterator
+from contextlib import contextmanager
+
+from deidcm.batch import Study
+from deidcm.batch import BatchRunner
+from deidcm.batch import StageMetrics
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['LeaseStore', 'LeasedBatchRunner']
+
+
+_SCHEMA = (
+	'CREATE TABLE IF NOT EXISTS studies (study_id TEXT PRIMARY KEY, idx INTEGER NOT NULL, dicom_key TEXT NOT NULL, '
+	'sf_key TEXT, state TEXT NOT NULL, worker TEXT, expires REAL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, '
+	'claimed REAL, finished REAL)',
+	'CREATE INDEX IF NOT EXISTS studies_state ON studies (state, idx)',
+	'CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, host TEXT, pid INTEGER, heartbeat REAL, stages TEXT)',
+)
+
+
+class LeaseStore:
+	"""Shared queue of batch studies, leased out one at a time to workers on any number of nodes.
+
+	The queue is a SQLite database, e.g. on a shared file system all nodes mount. It runs in
+	rollback journal mode rather than WAL, which needs shared memory between processes and thus
+	a single host, and every change is a short `BEGIN IMMEDIATE` transaction.
+
+	A claimed study is leased to its worker for `lease_seconds`, and the lease is extended by the
+	heartbeats of the worker. Studies whose lease runs out, e.g. as their worker crashed or lost
+	its node, are handed out again, as are studies a worker failed on, until they have been
+	claimed `max_attempts` times and are given up as failed. Lease times are wall clock times, so
+	node clocks should be kept in sync, e.g. with NTP, well within `lease_seconds`.
+
+	Attributes
+	----------
+	path: Path
+		Path to SQLite database.
+	lease_seconds: float
+		Time a study stays leased to a worker without a heartbeat.
+	max_attempts: int
+		Number of times a study is claimed at most.
+
+	Methods
+	-------
+	populate()
+		Adds studies of a batch to the queue.
+	claim()
+		Leases the next study to a worker.
+	heartbeat()
+		Extends the leases of a worker and records its stage metrics.
+	complete()
+		Marks a study as done.
+	release()
+		Returns a failed study to the queue, or gives it up.
+	remaining()
+		Number of studies not done or given up yet.
+	wait()
+		Waits until all studies are done or given up.
+	report()
+		Run report aggregated over all workers.
+	"""
+	def __init__(self, store_path: Path | str, lease_seconds: float = 300.0, max_attempts: int = 3) -> None:
+		self.path = Path(store_path)
+		self.lease_seconds = lease_seconds
+		self.max_attempts = max_attempts
+		self._lock = threading.Lock()
+		self._store = None
+
+	def _connect(self) -> sqlite3.Connection:
+		"""Opens the store, creating it if needed."""
+		if self._store is None:
+			# heartbeats come from a thread of their own, calls are serialised by the lock
+			self._store = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+			self._store.execute('PRAGMA journal_mode=DELETE')
+			for statement in _SCHEMA:
+				self._store.execute(statement)
+		return self._store
+
+	@contextmanager
+	def _transaction(self) -> Iterator[sqlite3.Connection]:
+		"""Runs statements in a transaction holding the write lock of the database from the start."""
+		with self._lock:
+			store = self._connect()
+			store.execute('BEGIN IMMEDIATE')
+			try:
+				yield store
+			except BaseException:
+				store.execute('ROLLBACK')
+				raise
+			store.execute('COMMIT')
+
+	def populate(self, studies: list) -> int:
+		"""Adds studies of a batch to the queue, keeping the state of studies already in it.
+
+		Returns
+		-------
+		: int
+			Number of studies added.
+		"""
+		with self._transaction() as store:
+			before = store.execute('SELECT COUNT(*) FROM studies').fetchone()[0]
+			store.executemany("INSERT OR IGNORE INTO studies (study_id, idx, dicom_key, sf_key, state) "
+				"VALUES (?, ?, ?, ?, 'pending')",
+				[(study.study_id, study.index, study.dicom_key, study.sf_key) for study in studies])
+			added = store.execute('SELECT COUNT(*) FROM studies').fetchone()[0] - before
+		log.info(f'{added} of {len(studies)} studies added to {self.path}')
+		return added
+
+	def _expire(self, store: sqlite3.Connection, now: float) -> None:
+		"""Returns studies with expired leases to the queue, or gives them up."""
+		for study_id, worker, attempts in store.execute("SELECT study_id, worker, attempts FROM studies "
+			"WHERE state = 'leased' AND expires < ?", (now,)).fetchall():
+			state = 'failed' if attempts >= self.max_attempts else 'pending'
+			log.warning(f'lease of {study_id} by {worker} expired after attempt {attempts}, {state}')
+			store.execute('UPDATE studies SET state = ?, worker = NULL, expires = NULL, error = ? WHERE study_id = ?',
+				(state, f'lease of {worker} expired', study_id))
+
+	def claim(self, worker: str) -> Study | None:
+		"""Leases the next study to a worker, None if no study is pending."""
+		now = time.time()
+		with self._transaction() as store:
+			self._expire(store, now)
+			row = store.execute("SELECT study_id, idx, dicom_key, sf_key FROM studies WHERE state = 'pending' "
+				'ORDER BY idx LIMIT 1').fetchone()
+			if row is None:
+				return None
+			store.execute("UPDATE studies SET state = 'leased', worker = ?, expires = ?, attempts = attempts + 1, "
+				'claimed = COALESCE(claimed, ?) WHERE study_id = ?', (worker, now + self.lease_seconds, now, row[0]))
+		study_id, index, dicom_key, sf_key = row
+		return Study(index, study_id, dicom_key, sf_key)
+
+	def heartbeat(self, worker: str, stages: dict | None = None) -> int:
+		"""Extends the leases of a worker and records its stage metrics so far.
+
+		Returns
+		-------
+		: int
+			Number of leases extended.
+		"""
+		now = time.time()
+		with self._transaction() as store:
+			extended = store.execute("UPDATE studies SET expires = ? WHERE state = 'leased' AND worker = ?",
+				(now + self.lease_seconds, worker)).rowcount
+			store.execute('INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?, ?)',
+				(worker, socket.gethostname(), os.getpid(), now, json.dumps(stages or {})))
+		return extended
+
+	def complete(self, worker: str, study: Study) -> None:
+		"""Marks a study as done, even if its lease was lost in the meantime, as its outputs are uploaded."""
+		with self._transaction() as store:
+			owner = store.execute('SELECT worker FROM studies WHERE study_id = ?', (study.study_id,)).fetchone()
+			store.execute("UPDATE studies SET state = 'done', worker = ?, expires = NULL, error = NULL, finished = ? "
+				'WHERE study_id = ?', (worker, time.time(), study.study_id))
+		if owner is None or owner[0] != worker:
+			log.warning(f'{study.study_id} was done by {worker} after its lease was lost')
+
+	def release(self, worker: str, study: Study, error: str) -> None:
+		"""Returns a study a worker failed on to the queue, or gives it up after `max_attempts`."""
+		with self._transaction() as store:
+			store.execute("UPDATE studies SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+				"worker = NULL, expires = NULL, error = ? WHERE study_id = ? AND worker = ? AND state = 'leased'",
+				(self.max_attempts, error, study.study_id, worker))
+
+	def remaining(self) -> int:
+		"""Number of studies not done or given up yet."""
+		with self._lock:
+			return self._connect().execute("SELECT COUNT(*) FROM studies WHERE state IN ('pending', 'leased')").fetchone()[0]
+
+	def wait(self, poll_interval: float = 10.0) -> dict:
+		"""Waits until all studies are done or given up, expiring the leases of lost workers.
+
+		Returns
+		-------
+		: dict
+			Run report, see `report()`.
+		"""
+		while True:
+			with self._transaction() as store:
+				self._expire(store, time.time())
+			remaining = self.remaining()
+			if not remaining:
+				break
+			log.info(f'{remaining} studies remaining: {self.report()["states"]}')
+			time.sleep(poll_interval)
+		return self.report()
+
+	def report(self) -> dict:
+		"""Run report, with study states, failed studies and stage metrics summed over all workers."""
+		with self._lock:
+			store = self._connect()
+			states = dict(store.execute('SELECT state, COUNT(*) FROM studies GROUP BY state').fetchall())
+			failures = store.execute("SELECT study_id, attempts, error FROM studies WHERE state = 'failed' "
+				'ORDER BY idx').fetchall()
+			started, finished = store.execute('SELECT MIN(claimed), MAX(finished) FROM studies').fetchone()
+			workers = store.execute('SELECT worker, host, pid, heartbeat, stages FROM workers ORDER BY worker').fetchall()
+		stages = {}
+		for *_, worker_stages in workers:
+			for name, counters in json.loads(worker_stages).items():
+				metrics = stages.setdefault(name, StageMetrics(name))
+				metrics.count += counters['studies']
+				metrics.bytes += counters['bytes']
+				metrics.seconds += counters['busy_seconds']
+		return {
+			'studies': sum(states.values()),
+			'states': states,
+			'wall_seconds': round(finished - started, 3) if started is not None and finished is not None else None,
+			'stages': {name: metrics.report() for name, metrics in stages.items()},
+			'workers': {worker: {'host': host, 'pid': pid, 'heartbeat': heartbeat, 'stages': json.loads(worker_stages)}
+				for worker, host, pid, heartbeat, worker_stages in workers},
+			'failures': [{'study_id': study_id, 'attempts': attempts, 'error': error}
+				for study_id, attempts, error in failures],
+		}
+
+
+class _Claims:
+	"""Studies claimed one at a time as the pipeline asks for them, sized as the whole batch for progress."""
+	def __init__(self, runner: LeasedBatchRunner) -> None:
+		self.runner = runner
+
+	def __len__(self) -> int:
+		with self.runner.store._lock:
+			return self.runner.store._connect().execute('SELECT COUNT(*) FROM studies').fetchone()[0]
+
+	def __iter__(self) -> Iterator[Study]:
+		runner = self.runner
+		while not runner._stopped.is_set():
+			study = runner.store.claim(runner.worker_id)
+			if study is not None:
+				runner.claimed.append(study)
+				yield study
+				continue
+			if not runner.store.remaining():
+				return
+			# studies leased by other workers may still fail or expire and be handed out again
+			runner._stopped.wait(runner.poll_interval)
+
+
+class LeasedBatchRunner(BatchRunner):
+	"""Batch runner taking its studies from a shared `LeaseStore`, so that it can run on many nodes at once.
+
+	Studies are claimed one at a time as the download stage of the pipeline gets to them, so
+	that no worker holds more studies than it has in flight. Leases of the studies in flight are
+	extended by a heartbeat thread, which also records the stage metrics of the worker in the
+	store for the aggregated run report. Studies that fail at any stage are released back to the
+	store to be retried, by any worker, and done studies are marked as such once uploaded. The
+	worker keeps going until no study is pending or leased anymore.
+
+	Attributes
+	----------
+	store: LeaseStore
+		Shared queue of studies.
+	worker_id: str
+		Name of the worker in the store, host name and process id by default.
+	poll_interval: float
+		Seconds between claims while all remaining studies are leased by other workers.
+	claimed: list[Study]
+		Studies claimed by this worker.
+
+	Methods
+	-------
+	run()
+		Runs claimed studies through the pipeline until the queue is empty.
+	stop()
+		Stops claiming studies, those in flight are finished.
+	"""
+	def __init__(self, store: LeaseStore, in_bucket, out_bucket, scratch_root: Path, worker_id: str | None = None,
+		poll_interval: float = 5.0, **kwargs) -> None:
+		super().__init__(in_bucket, out_bucket, scratch_root, **kwargs)
+		self.store = store
+		self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+		self.poll_interval = poll_interval
+		self.claimed = []
+		self._stopped = threading.Event()
+		self._finished = threading.Event()
+
+	def _stages(self) -> dict:
+		return {name: metrics.report() for name, metrics in self.metrics.items()}
+
+	def _heartbeat(self) -> None:
+		"""Extends leases a few times per lease period until the run is over."""
+		while not self._finished.wait(self.store.lease_seconds / 4):
+			try:
+				self.store.heartbeat(self.worker_id, self._stages())
+			except sqlite3.Error as error:
+				# e.g. the shared file system is briefly unavailable, leases last a while longer
+				log.error(f'heartbeat of {self.worker_id} failed: {error!r}')
+
+	def _skip(self, study: Study) -> None:
+		super()._skip(study)
+		self.store.complete(self.worker_id, study)
+
+	def _fail(self, study: Study, stage: str, error: Exception) -> None:
+		super()._fail(study, stage, error)
+		self.store.release(self.worker_id, study, f'{stage}: {error!r}')
+
+	def _upload(self, study: Study) -> None:
+		super()._upload(study)
+		self.store.complete(self.worker_id, study)
+
+	def run(self) -> dict:
+		"""Runs claimed studies through the pipeline until the queue is empty.
+
+		Returns
+		-------
+		: dict
+			Report of this worker, see `BatchRunner.run()`, over the studies it claimed.
+		"""
+		log.info(f'worker {self.worker_id} taking studies from {self.store.path}')
+		self.store.heartbeat(self.worker_id)
+		heartbeat = threading.Thread(target=self._heartbeat, name='heartbeat', daemon=True)
+		heartbeat.start()
+		try:
+			report = super().run(_Claims(self))
+		finally:
+			self._finished.set()
+			heartbeat.join()
+			self.store.heartbeat(self.worker_id, self._stages())
+		report['studies'] = len(self.claimed)
+		return report
+
+	def stop(self) -> None:
+		"""Stops claiming studies, those in flight are finished."""
+		self._stopped.set()
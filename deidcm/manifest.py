@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from datetime import datetime
+from datetime import timezone
+from collections import Counter
+
+from deidcm.utils import COPY_CHUNK_SIZE
+
+
+log = logging.getLogger(__name__)
+
+
+def file_checksum(path: Path) -> str:
+	"""Sha256 hash value of file contents, read in chunks."""
+	h = hashlib.new('sha256')
+	with open(path, 'rb') as handler:
+		for chunk in iter(lambda: handler.read(COPY_CHUNK_SIZE), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+class RunManifest:
+	"""Persistent append-only record of batch progress, used to resume interrupted batches.
+
+	Every state change of a study is appended as one JSON line and flushed to disk right away,
+	so the manifest survives crashes at any point. On load the lines are replayed, later fields
+	of a study overriding earlier ones. A study counts as done only if its last state is 'done'
+	and its source objects are unchanged since, so a rerun skips completed studies and retries
+	failed or interrupted ones.
+
+	Attributes
+	----------
+	path: Path
+		Path to JSON lines manifest file.
+	studies: dict[str, dict]
+		Latest merged record of each study, by study id.
+
+	Methods
+	-------
+	record()
+		Appends a record for a study.
+	is_done()
+		Checks whether a study is done from the same source objects.
+	summary()
+		Number of studies by state.
+	"""
+	def __init__(self, manifest_path: Path) -> None:
+		self.path = Path(manifest_path)
+		self.studies = {}
+		self._lock = threading.Lock()
+		self._load()
+
+	def _load(self) -> None:
+		"""Replays existing manifest, skipping a line truncated by a crash."""
+		if not self.path.is_file():
+			return
+		with open(self.path, 'r') as handler:
+			lines = handler.readlines()
+		for number, line in enumerate(lines, 1):
+			try:
+				record = json.loads(line)
+			except json.JSONDecodeError:
+				log.warning(f'skipping unreadable line {number} of {self.path}')
+				continue
+			self.studies.setdefault(record['study_id'], {}).update(record)
+		if lines and not lines[-1].endswith('\n'):
+			with open(self.path, 'a') as handler:
+				handler.write('\n')
+		log.info(f'loaded manifest of {len(self.studies)} studies: {self.summary()}')
+
+	def record(self, study_id: str, **fields) -> None:
+		"""Appends a record for a study and flushes it to disk.
+
+		Parameters
+		----------
+		study_id: str
+			Study the record belongs to.
+		fields:
+			JSON serializable fields, e.g. state, source, outputs, instances or error.
+		"""
+		record = {'study_id': study_id, 'time': datetime.now(timezone.utc).isoformat(), **fields}
+		line = json.dumps(record) + '\n'
+		with self._lock:
+			with open(self.path, 'a') as handler:
+				handler.write(line)
+				handler.flush()
+				os.fsync(handler.fileno())
+			self.studies.setdefault(study_id, {}).update(record)
+
+	def is_done(self, study_id: str, source: dict) -> bool:
+		"""Checks whether a study is done from the same source objects.
+
+		Parameters
+		----------
+		study_id: str
+			Study to check.
+		source: dict
+			Current description of source objects, e.g. keys with their ETag and size.
+		"""
+		entry = self.studies.get(study_id, {})
+		return entry.get('state') == 'done' and entry.get('source') == source
+
+	def summary(self) -> dict:
+		"""Number of studies by their latest state."""
+		return dict(Counter(entry.get('state') for entry in self.studies.values()))
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import io
+import copy
+import logging
+from typing import BinaryIO
+
+from pydicom.dataset import Dataset
+
+from deidcm.instance import Instance
+from deidcm.policy import TagPolicy
+from deidcm.policy import load_policy
+from deidcm.uids import UidMapper
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['deidentify_dataset', 'deidentify_bytes']
+
+
+def deidentify_dataset(dataset: Dataset, skip_private_tags: bool = False, policy: TagPolicy | None = None,
+	uids: UidMapper | None = None, in_place: bool = False) -> Dataset:
+	"""De-identifies a parsed dataset, without any file system I/O.
+
+	The same keep-list, private tag and UID edits as for files are applied, see `Instance.edit()`. The
+	compiled keep-list of the package is loaded once per process and shared by all calls, as is
+	any policy or UID mapper passed in.
+
+	Parameters
+	----------
+	dataset: Dataset
+		Dataset to de-identify, e.g. from `dcmread()` or received over the network.
+	skip_private_tags: bool
+		If true all private tags are untouched. If false all of them removed.
+	policy: TagPolicy | None
+		Compiled keep-list, the package config if not given.
+	uids: UidMapper | None
+		Mapper to pseudonymise UIDs with, UIDs are kept as they are if not given.
+	in_place: bool
+		If true the dataset itself is edited, saving a deep copy.
+
+	Returns
+	-------
+	: Dataset
+		De-identified dataset, the given one if edited in place.
+	"""
+	header = dataset if in_place else copy.deepcopy(dataset)
+	Instance.edit(header, policy if policy is not None else load_policy('keep'), skip_private_tags, uids)
+	return header
+
+
+def deidentify_bytes(data: bytes | BinaryIO, skip_private_tags: bool = False, policy: TagPolicy | None = None,
+	uids: UidMapper | None = None, stream: bool = False) -> bytes:
+	"""De-identifies a DICOM file held in memory or read from a file object, without any file system I/O.
+
+	Encapsulated pixel data is passed through byte-for-byte, as for files, see `Instance`.
+
+	Parameters
+	----------
+	data: bytes | BinaryIO
+		Contents of a DICOM file, or a file object holding one, e.g. a request body. File objects
+		which can not seek are read into memory first.
+	skip_private_tags: bool
+		If true all private tags are untouched. If false all of them removed.
+	policy: TagPolicy | None
+		Compiled keep-list, the package config if not given.
+	uids: UidMapper | None
+		Mapper to pseudonymise UIDs with, UIDs are kept as they are if not given.
+	stream: bool
+		If true only the header is parsed and pixel data is copied over as it is.
+
+	Returns
+	-------
+	: bytes
+		De-identified DICOM file.
+	"""
+	if hasattr(data, 'read') and getattr(data, 'seekable', lambda: False)():
+		source = data
+	else:
+		source = io.BytesIO(data.read() if hasattr(data, 'read') else data)
+		source.name = '<memory>'
+	output = io.BytesIO()
+	Instance(source, policy, uids).deidentify(skip_private_tags, stream, output)
+	return output.getvalue()
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import os
+import json
+import time
+import logging
+from pathlib import Path
+from typing import BinaryIO
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['Timings', 'RunMetrics']
+
+
+_FIELDS = ('count', 'seconds', 'bytes_read', 'bytes_written')
+_PROMETHEUS_METRICS = (
+	('count', 'deidcm_stage_calls_total', 'Number of times each pipeline stage ran.'),
+	('seconds', 'deidcm_stage_seconds_total', 'Time spent in each pipeline stage.'),
+	('bytes_read', 'deidcm_stage_read_bytes_total', 'Bytes read by each pipeline stage.'),
+	('bytes_written', 'deidcm_stage_written_bytes_total', 'Bytes written by each pipeline stage.'),
+)
+
+
+def file_size(target: Path | BinaryIO) -> int:
+	"""Size of a file, given its path or a seekable file object whose position is kept."""
+	if not hasattr(target, 'seek'):
+		return os.path.getsize(target)
+	position = target.tell()
+	size = target.seek(0, os.SEEK_END)
+	target.seek(position)
+	return size
+
+
+def _empty() -> dict:
+	return dict.fromkeys(_FIELDS, 0)
+
+
+def _accumulate(target: dict, stage: str, counters: dict) -> None:
+	"""Adds stage counters into a dict of stages."""
+	totals = target.setdefault(stage, _empty())
+	for field in _FIELDS:
+		totals[field] += counters.get(field, 0)
+
+
+class Timings:
+	"""Durations and bytes of the pipeline stages of a single job.
+
+	Jobs may run in worker processes, so timings are kept as plain dicts which travel back with
+	the job result, and are merged into the run metrics there.
+
+	Attributes
+	----------
+	stages: dict[str, dict]
+		Counters of each stage, see `RunMetrics`.
+
+	Methods
+	-------
+	stage()
+		Times a block of code as a stage.
+	add()
+		Adds bytes to a stage.
+	"""
+	def __init__(self) -> None:
+		self.stages = {}
+
+	@contextmanager
+	def stage(self, name: str, bytes_read: int = 0, bytes_written: int = 0) -> None:
+		"""Times a block of code as a stage."""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			_accumulate(self.stages, name, {'count': 1, 'seconds': time.perf_counter() - start,
+				'bytes_read': bytes_read, 'bytes_written': bytes_written})
+
+	def add(self, name: str, bytes_read: int = 0, bytes_written: int = 0) -> None:
+		"""Adds bytes to a stage, e.g. once they are known after the stage ran."""
+		_accumulate(self.stages, name, {'bytes_read': bytes_read, 'bytes_written': bytes_written})
+
+
+class RunMetrics:
+	"""Per-stage durations, bytes read and written, and instance counts of a de-identification run.
+
+	Every stage is counted both for the whole run and for the top level input item it ran for.
+	Stages timed in the driver are e.g. 'validate', 'copy' and 'scan', while instance jobs report
+	'read', 'filter' and 'write' (and DICOMDIR jobs 'redact'). With the asyncio front end, job
+	reads and writes done in the driver are reported as 'fetch' and 'store'.
+
+	Attributes
+	----------
+	stages: dict[str, dict]
+		Count, seconds, bytes read and bytes written of each stage over the whole run.
+	items: dict[str, dict]
+		Instance counts and stages of each input item.
+
+	Methods
+	-------
+	stage()
+		Times a block of code as a stage of an item.
+	record()
+		Records a stage of an item.
+	merge()
+		Merges the outcome and timings of a job into an item.
+	report()
+		Structured run report.
+	write_json()
+		Writes run report as JSON.
+	write_prometheus()
+		Writes run totals in Prometheus text format.
+	"""
+	def __init__(self) -> None:
+		self.stages = {}
+		self.items = {}
+		self._start = time.perf_counter()
+		self._wall_seconds = None
+
+	def _item(self, item: str) -> dict:
+		return self.items.setdefault(item, {'instances': 0, 'failed': 0, 'stages': {}})
+
+	@contextmanager
+	def stage(self, item: str, name: str, bytes_read: int = 0, bytes_written: int = 0) -> None:
+		"""Times a block of code as a stage of an item."""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.record(item, name, time.perf_counter() - start, bytes_read, bytes_written)
+
+	def record(self, item: str, name: str, seconds: float, bytes_read: int = 0, bytes_written: int = 0) -> None:
+		"""Records a stage of an item."""
+		counters = {'count': 1, 'seconds': seconds, 'bytes_read': bytes_read, 'bytes_written': bytes_written}
+		_accumulate(self.stages, name, counters)
+		_accumulate(self._item(item)['stages'], name, counters)
+
+	def merge(self, item: str, failed: bool, stages: dict | None) -> None:
+		"""Merges the outcome and stage timings of a job into an item."""
+		entry = self._item(item)
+		entry['instances'] += 1
+		entry['failed'] += int(failed)
+		for name, counters in (stages or {}).items():
+			_accumulate(self.stages, name, counters)
+			_accumulate(entry['stages'], name, counters)
+
+	def finish(self) -> None:
+		"""Stops the run clock."""
+		self._wall_seconds = time.perf_counter() - self._start
+
+	def report(self) -> dict:
+		"""Structured run report, with stage counters over the whole run and by item."""
+		wall_seconds = self._wall_seconds if self._wall_seconds is not None else time.perf_counter() - self._start
+		return {
+			'wall_seconds': round(wall_seconds, 6),
+			'instances': sum(entry['instances'] for entry in self.items.values()),
+			'failed': sum(entry['failed'] for entry in self.items.values()),
+			'stages': self.stages,
+			'items': self.items,
+		}
+
+	def write_json(self, path: Path) -> None:
+		"""Writes run report as JSON."""
+		with open(path, 'w') as handler:
+			json.dump(self.report(), handler, indent=2)
+		log.info(f'run report written to {path}')
+
+	def write_prometheus(self, path: Path) -> None:
+		"""Writes run totals in Prometheus text exposition format, e.g. for the node exporter textfile collector.
+
+		The file is written next to its destination and moved in place, so that collectors never
+		read it half written.
+		"""
+		report = self.report()
+		lines = []
+		for field, metric, description in _PROMETHEUS_METRICS:
+			lines += [f'# HELP {metric} {description}', f'# TYPE {metric} counter']
+			lines += [f'{metric}{{stage="{name}"}} {counters[field]}' for name, counters in sorted(self.stages.items())]
+		lines += [
+			'# HELP deidcm_instances_total Number of DICOM instances processed.',
+			'# TYPE deidcm_instances_total counter',
+			f'deidcm_instances_total {report["instances"]}',
+			'# HELP deidcm_instances_failed_total Number of DICOM instances that failed to deidentify.',
+			'# TYPE deidcm_instances_failed_total counter',
+			f'deidcm_instances_failed_total {report["failed"]}',
+			'# HELP deidcm_run_seconds Wall time of the run.',
+			'# TYPE deidcm_run_seconds gauge',
+			f'deidcm_run_seconds {report["wall_seconds"]}',
+		]
+		temp_path = f'{path}.tmp'
+		with open(temp_path, 'w') as handler:
+			handler.write('\n'.join(lines) + '\n')
+		os.replace(temp_path, path)
+		log.info(f'prometheus metrics written to {path}')
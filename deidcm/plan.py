@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import json
+import logging
+from pathlib import Path
+from collections import namedtuple
+
+from deidcm.archive import Archive
+from deidcm.classifier import walk
+from deidcm.classifier import Classifier
+from deidcm.validation import Validator
+from deidcm.deidentifier import Deidentifier
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['RunPlanner', 'Rates', 'load_rates']
+
+
+Rates = namedtuple('Rates', 'per_file per_mb')
+
+# seconds per file and per MB of DICOM data for a single worker, fitted to the `deidentifier_run`
+# cases of `benchmarks/run_benchmarks.py` on a laptop class machine
+DEFAULT_RATES = Rates(0.0025, 0.0022)
+# benchmark cases whose file counts are not instance counts
+_UNFIT_SHAPES = ('archives',)
+
+
+def load_rates(results_path: Path | str) -> Rates:
+	"""Per worker rates fitted to the results of `run_benchmarks.py` on the target machine.
+
+	Seconds per file and per MB are fitted by least squares over the `deidentifier_run` cases,
+	and scaled by the number of workers the benchmarks were run with.
+	"""
+	with open(results_path) as handler:
+		results = json.load(handler)
+	samples = [(case['files'], case['bytes'] / (1 << 20), case['seconds'])
+		for name, case in results.get('cases', {}).items()
+		if name.startswith('deidentifier_run:') and name.partition(':')[2] not in _UNFIT_SHAPES and 'seconds' in case]
+	ff = sum(files * files for files, _, _ in samples)
+	fm = sum(files * mb for files, mb, _ in samples)
+	mm = sum(mb * mb for _, mb, _ in samples)
+	fs = sum(files * seconds for files, _, seconds in samples)
+	ms = sum(mb * seconds for _, mb, seconds in samples)
+	determinant = ff * mm - fm * fm
+	if len(samples) < 2 or determinant <= 0:
+		log.warning(f'{results_path} has too few deidentifier_run cases, using default rates')
+		return DEFAULT_RATES
+	workers = results.get('workers') or 1
+	per_file = max(0.0, (fs * mm - ms * fm) / determinant)
+	per_mb = max(0.0, (ms * ff - fs * fm) / determinant)
+	return Rates(per_file * workers, per_mb * workers)
+
+
+class RunPlanner:
+	"""Plans a run of the deidentifier without writing, copying or unpacking anything.
+
+	Every input item is inspected the way the run would see it: directories are walked and the
+	leading bytes of each file are sniffed for a DICOM header, while archives are listed through
+	their central directory, or read member by member for tar, and only the leading bytes of each
+	member are decompressed. The plan lists, for each item and in total, the DICOM instances,
+	DICOMDIR files and other files the run would process, their sizes and an estimated runtime,
+	along with the items it would skip and why.
+
+	Runtimes are estimated from seconds per file and per MB of DICOM data, see `load_rates()`,
+	spread evenly over `workers`. Other files are counted at the per file rate only.
+
+	Attributes
+	----------
+	deidentifier: Deidentifier
+		Deidentifier whose input, settings and incremental cache are planned for.
+	rates: Rates
+		Seconds per file and per MB of DICOM data, for a single worker.
+
+	Methods
+	-------
+	plan()
+		Plans every item of the input directory.
+	write()
+		Writes the plan as JSON.
+	"""
+	def __init__(self, deidentifier: Deidentifier, rates: Rates | None = None) -> None:
+		self.deidentifier = deidentifier
+		self.rates = rates if rates is not None else DEFAULT_RATES
+		self._classifier = Classifier()
+
+	def _estimate(self, entry: dict) -> float:
+		files = entry['instances'] + entry['dicomdirs'] + entry['copied']
+		seconds = files * self.rates.per_file + entry['dicom_bytes'] / (1 << 20) * self.rates.per_mb
+		return round(seconds / self.deidentifier.workers, 3)
+
+	def _plan_dir(self, item_path: Path, entry: dict) -> None:
+		for _, _, files in walk(item_path):
+			for file_entry in files:
+				size = file_entry.stat().st_size
+				entry['bytes'] += size
+				if file_entry.name == 'DICOMDIR':
+					entry['dicomdirs'] += 1
+					entry['dicom_bytes'] += size
+				elif self._classifier.is_dicom(file_entry):
+					entry['instances'] += 1
+					entry['dicom_bytes'] += size
+				else:
+					entry['copied'] += 1
+
+	def _plan_archive(self, item_path: Path, archive_format: str, entry: dict) -> None:
+		archive = Archive(item_path, archive_format)
+		archive.scan()
+		for member in archive.members:
+			if member.is_dir:
+				continue
+			entry['bytes'] += member.size
+			if member.name in archive.dicom:
+				entry['instances'] += 1
+				entry['dicom_bytes'] += member.size
+			else:
+				entry['copied'] += 1
+
+	def _plan_item(self, item: str, cache: RunCache | None) -> dict:
+		"""Plans a single input item."""
+		item_path = Path(f'{self.deidentifier.input_directory}/{item}')
+		validator = Validator(item_path, self._classifier)
+		kind = 'dir' if validator.dir else 'archive' if validator.compressed else 'file'
+		entry = {'kind': kind, 'action': 'deidentify', 'instances': 0, 'dicomdirs': 0, 'copied': 0,
+			'bytes': 0, 'dicom_bytes': 0}
+		if cache is not None and cache.is_fresh(item, cache.item_key(item_path), self.deidentifier._output_root()):
+			entry.update(action='skip', reason='unchanged since the previous run')
+			return entry
+		try:
+			if validator.dir:
+				self._plan_dir(item_path, entry)
+			elif validator.compressed:
+				entry['archive_format'] = validator.archive_format
+				self._plan_archive(item_path, validator.archive_format, entry)
+			else:
+				size = item_path.stat().st_size
+				entry['bytes'] = size
+				if item == 'DICOMDIR' or self._classifier.is_dicom(item_path):
+					entry['dicomdirs' if item == 'DICOMDIR' else 'instances'] += 1
+					entry['dicom_bytes'] = size
+		except Exception as error:
+			# e.g. a corrupt archive, which the run would fail on as well
+			log.error(f'failed to inspect {item}: {error!r}')
+			entry.update(action='skip', reason=f'unreadable: {error!r}')
+			return entry
+		if not entry['instances'] and not entry['dicomdirs']:
+			entry.update(action='skip', reason='no DICOM data')
+			entry['copied'] = 0
+			return entry
+		entry['estimated_seconds'] = self._estimate(entry)
+		return entry
+
+	def plan(self) -> dict:
+		"""Plans every item of the input directory.
+
+		Returns
+		-------
+		: dict
+			Plan of each item under 'items', with the sums over all items under 'totals'.
+		"""
+		deidentifier = self.deidentifier
+		cache = None
+		if deidentifier.incremental and deidentifier._cache_path().exists():
+			cache = deidentifier._open_cache()
+		items = {item: self._plan_item(item, cache) for item in deidentifier._items()}
+		planned = [entry for entry in items.values() if entry['action'] == 'deidentify']
+		totals = {
+			'items': len(items),
+			'skipped': len(items) - len(planned),
+			**{field: sum(entry[field] for entry in planned)
+				for field in ('instances', 'dicomdirs', 'copied', 'bytes', 'dicom_bytes')},
+			'estimated_seconds': round(sum(entry['estimated_seconds'] for entry in planned), 3),
+		}
+		log.info(f'plan: {totals["instances"]} instances in {len(planned)} items, {totals["skipped"]} items skipped, '
+			f'about {totals["estimated_seconds"]} s with {deidentifier.workers} worker(s)')
+		return {
+			'input_directory': str(deidentifier.input_directory),
+			'output_directory': str(deidentifier._output_root()),
+			'workers': deidentifier.workers,
+			'rates': self.rates._asdict(),
+			'totals': totals,
+			'items': items,
+		}
+
+	def write(self, path: Path | str) -> dict:
+		"""Plans every item of the input directory and writes the plan as JSON, to stdout for '-'."""
+		plan = self.plan()
+		if str(path) == '-':
+			print(json.dumps(plan, indent=2))
+		else:
+			with open(path, 'w') as handler:
+				json.dump(plan, handler, indent=2)
+			log.info(f'run plan written to {path}')
+		return plan
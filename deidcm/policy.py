@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import re
+import logging
+from functools import lru_cache
+
+from pydicom.datadict import tag_for_keyword
+
+from deidcm.utils import parse_tag_config
+
+
+log = logging.getLogger(__name__)
+
+
+_TAG = r'\(\s*([0-9A-Fa-fXx]{4})\s*,\s*([0-9A-Fa-fXx]{4})\s*\)'
+_TAG_PATTERN = re.compile(f'^{_TAG}$')
+_RANGE_PATTERN = re.compile(f'^{_TAG}\\s*-\\s*{_TAG}$')
+_PRIVATE_PATTERN = re.compile(r'^\(\s*([0-9A-Fa-f]{4})\s*,\s*"(.+)"\s*\)$')
+
+
+class TagPolicy:
+	"""Compiled tag list used to decide which elements are kept or redacted.
+
+	The tag config is parsed and resolved only once, every keyword is converted to its integer
+	tag value so that membership checks are constant time set lookups instead of keyword scans.
+
+	Supported config line formats:
+	 - standard keyword, e.g. `PatientName`
+	 - hexadecimal tag, e.g. `(0010,0010)`
+	 - tag with `x` wildcard digits, e.g. `(60xx,3000)`
+	 - inclusive tag range, e.g. `(0028,0100)-(0028,0103)`
+	 - private creator block, e.g. `(0009,"GEMS_IDEN_01")`, which covers the private creator
+	   element and every element of the block it reserves
+
+	Attributes
+	----------
+	tags: frozenset[int]
+		Exact tag values.
+	masks: tuple[tuple[int, int]]
+		(mask, value) pairs for wildcard tags.
+	ranges: tuple[tuple[int, int]]
+		Inclusive (lowest, highest) tag value pairs.
+	private_creators: frozenset[tuple[int, str]]
+		(group, creator name) pairs of private blocks.
+
+	Methods
+	-------
+	compile()
+		Creates a policy from config lines.
+	from_config()
+		Creates a policy from one of the package tag configs.
+	filter()
+		Removes all base level elements not covered by the policy.
+	"""
+	def __init__(self, tags: frozenset, masks: tuple = (), ranges: tuple = (),
+		private_creators: frozenset = frozenset()) -> None:
+		self.tags = tags
+		self.masks = masks
+		self.ranges = ranges
+		self.private_creators = private_creators
+
+	@classmethod
+	def compile(cls, lines: list) -> TagPolicy:
+		"""Resolves config lines into a policy.
+
+		Parameters
+		----------
+		lines: list[str]
+			Non-comment config lines.
+
+		Raises
+		------
+		ValueError
+			If a tag, range or private block line is malformed.
+		"""
+		tags, masks, ranges, private_creators = set(), [], [], set()
+		for line in lines:
+			line = line.strip()
+			if not line:
+				continue
+			if line.startswith('('):
+				cls._compile_tag_line(line, tags, masks, ranges, private_creators)
+				continue
+			tag = tag_for_keyword(line)
+			if tag is None:
+				log.warning(f'unknown tag keyword in config is ignored: {line}')
+				continue
+			tags.add(tag)
+		return cls(frozenset(tags), tuple(masks), tuple(ranges), frozenset(private_creators))
+
+	@staticmethod
+	def _compile_tag_line(line: str, tags: set, masks: list, ranges: list, private_creators: set) -> None:
+		"""Resolves a parenthesized tag, wildcard, range or private block line."""
+		match = _PRIVATE_PATTERN.match(line)
+		if match:
+			private_creators.add((int(match[1], 16), match[2].strip()))
+			return
+		match = _RANGE_PATTERN.match(line)
+		if match:
+			lowest = int(match[1] + match[2], 16)
+			highest = int(match[3] + match[4], 16)
+			ranges.append((min(lowest, highest), max(lowest, highest)))
+			return
+		match = _TAG_PATTERN.match(line)
+		if not match:
+			raise ValueError(f'malformed tag in config: {line}')
+		digits = (match[1] + match[2]).upper()
+		if 'X' not in digits:
+			tags.add(int(digits, 16))
+			return
+		mask = int(''.join('0' if digit == 'X' else 'F' for digit in digits), 16)
+		value = int(digits.replace('X', '0'), 16)
+		masks.append((mask, value))
+
+	@classmethod
+	def from_config(cls, listname: str) -> TagPolicy:
+		"""Compiles one of the package tag configs, i.e. 'keep' or 'redact'."""
+		return cls.compile(parse_tag_config(listname))
+
+	def __contains__(self, tag: int) -> bool:
+		if tag in self.tags:
+			return True
+		for mask, value in self.masks:
+			if tag & mask == value:
+				return True
+		for lowest, highest in self.ranges:
+			if lowest <= tag <= highest:
+				return True
+		return False
+
+	def _private_tags(self, header: pydicom.Dataset) -> tuple:
+		"""Resolves private creator elements and reserved blocks covered by the policy.
+
+		Returns
+		-------
+		: tuple[set[int], set[int]]
+			Private creator tags, and blocks as `tag >> 8` values of their elements.
+		"""
+		creators, blocks = set(), set()
+		if not self.private_creators:
+			return creators, blocks
+		groups = {group for group, _ in self.private_creators}
+		for tag in header.keys():
+			group, element = tag >> 16, tag & 0xFFFF
+			if group not in groups or not 0x0010 <= element <= 0x00FF:
+				continue
+			creator = header[tag].value
+			if isinstance(creator, bytes):
+				creator = creator.decode('ascii', 'replace')
+			if (group, str(creator).strip()) in self.private_creators:
+				creators.add(tag)
+				blocks.add((group << 8) | element)
+		return creators, blocks
+
+	def filter(self, header: pydicom.Dataset) -> None:
+		"""Removes in place all base level elements of the header not covered by the policy.
+
+		Parameters
+		----------
+		header: pydicom.Dataset
+			Parsed DICOM header.
+		"""
+		creators, blocks = self._private_tags(header)
+		for tag in list(header.keys()):
+			if tag in self or tag in creators or (tag >> 8) in blocks:
+				continue
+			del header[tag]
+
+
+@lru_cache(maxsize=None)
+def load_policy(listname: str) -> TagPolicy:
+	"""Compiled package tag config, parsed only once per process."""
+	return TagPolicy.from_config(listname)
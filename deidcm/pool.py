@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import io
+import logging
+from functools import partial
+from collections import namedtuple
+from concurrent.futures import Future
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
+
+from deidcm.instance import Instance
+from deidcm.dicomdir import DicomDir
+from deidcm.policy import load_policy
+
+
+log = logging.getLogger(__name__)
+
+
+Job = namedtuple('Job', 'kind path output', defaults=(None,))
+Result = namedtuple('Result', 'path error data timings', defaults=(None, None))
+Policies = namedtuple('Policies', 'keep redact uids', defaults=(None,))
+
+
+def warm_up() -> None:
+	"""Loads modules and tag configs in a worker process ahead of its first job."""
+	load_policy('keep')
+	load_policy('redact')
+
+
+def run_job(job: Job, priv_tag_flag: bool, policies: Policies | None = None, stream: bool = False) -> Result:
+	"""Runs a single de-identification job.
+
+	Any failure is isolated to the file of the job, logged, and reported back in the result
+	instead of being raised, so that one broken instance does not abort the whole run.
+
+	Parameters
+	----------
+	job: Job
+		Job kind ('instance' or 'dicomdir'), path to the source file and path to write the
+		de-identified copy to. The source is processed in place if no output is given.
+	priv_tag_flag: bool
+		If true all private tags are untouched. If false all of them nulled.
+	policies: Policies
+		Compiled keep and redact policies, loaded from package configs if not given, and UID
+		mapper to pseudonymise UIDs with, if any.
+	stream: bool
+		If true instances are de-identified header-only, with pixel data copied over byte-for-byte.
+
+	Returns
+	-------
+	: Result
+		Path of the processed file, the error message or None on success, and stage timings.
+	"""
+	keep, redact, uids = policies if policies is not None else (None, None, None)
+	try:
+		if job.kind == 'dicomdir':
+			handler = DicomDir(job.path, redact, uids)
+			handler.deidentify(job.output)
+		else:
+			handler = Instance(job.path, keep, uids)
+			handler.deidentify(priv_tag_flag, stream, job.output)
+	except Exception as error:
+		log.error(f'failed to deidentify {job.path}: {error!r}')
+		return Result(str(job.path), repr(error))
+	return Result(str(job.path), None, None, handler.timings.stages)
+
+
+def run_buffer(kind: str, name: str, data: bytes, priv_tag_flag: bool, policies: Policies | None = None,
+	stream: bool = False) -> Result:
+	"""Runs a single de-identification job on a file held in memory, e.g. an archive member.
+
+	Parameters
+	----------
+	kind: str
+		Job kind, 'instance' or 'dicomdir'.
+	name: str
+		Name of the file, used for reporting only.
+	data: bytes
+		File contents.
+	priv_tag_flag: bool
+		If true all private tags are untouched. If false all of them nulled.
+	policies: Policies
+		Compiled keep and redact policies, loaded from package configs if not given, and UID
+		mapper to pseudonymise UIDs with, if any.
+	stream: bool
+		If true instances are de-identified header-only, with pixel data copied over byte-for-byte.
+
+	Returns
+	-------
+	: Result
+		Name of the file, the error message or None on success, de-identified contents and stage timings.
+	"""
+	keep, redact, uids = policies if policies is not None else (None, None, None)
+	source, output = io.BytesIO(data), io.BytesIO()
+	source.name = name
+	try:
+		if kind == 'dicomdir':
+			handler = DicomDir(source, redact, uids)
+			handler.deidentify(output)
+		else:
+			handler = Instance(source, keep, uids)
+			handler.deidentify(priv_tag_flag, stream, output)
+	except Exception as error:
+		log.error(f'failed to deidentify {name}: {error!r}')
+		return Result(name, repr(error))
+	return Result(name, None, output.getvalue(), handler.timings.stages)
+
+
+class JobRunner:
+	"""Runs de-identification jobs either serially or over a process pool.
+
+	A single progress bar is shared by all jobs regardless of which input item they belong to.
+	Use as a context manager, the process pool is created on entry and shut down on exit
+	unless an existing executor is given.
+
+	Attributes
+	----------
+	priv_tag_flag: bool
+		If true all private tags are untouched. If false all of them nulled.
+	workers: int
+		Number of worker processes, 1 runs everything in the current process.
+	policies: Policies
+		Compiled keep and redact policies and UID mapper shared by all jobs.
+	stream: bool
+		If true instances are de-identified header-only, with pixel data copied over byte-for-byte.
+	total: int
+		Expected number of jobs, for progress reporting.
+	window: int
+		Number of in-memory jobs that callers should keep in flight at most.
+
+	Methods
+	-------
+	run()
+		Runs file jobs and returns their results in order.
+	submit()
+		Submits a file job and returns its future.
+	submit_buffer()
+		Submits an in-memory job and returns its future.
+	advance()
+		Advances progress bar by one job.
+	"""
+	def __init__(self, priv_tag_flag: bool, workers: int = 1, policies: Policies | None = None,
+		stream: bool = False, total: int = 0, executor: Executor | None = None) -> None:
+		self.priv_tag_flag = priv_tag_flag
+		self.workers = workers
+		self.policies = policies
+		self.stream = stream
+		self.total = total
+		self.window = max(2, workers * 4)
+		self._executor = executor
+		self._owns_executor = False
+
+	def __enter__(self) -> JobRunner:
+		self.progress = tqdm(total=self.total)
+		if self._executor is None and self.workers > 1:
+			self._executor = ProcessPoolExecutor(max_workers=self.workers)
+			self._owns_executor = True
+		return self
+
+	def __exit__(self, *args) -> None:
+		if self._owns_executor:
+			self._executor.shutdown()
+			self._executor, self._owns_executor = None, False
+		self.progress.close()
+
+	def run(self, jobs: list) -> list:
+		"""Runs file jobs.
+
+		Parameters
+		----------
+		jobs: list[Job]
+			Jobs to run.
+
+		Returns
+		-------
+		: list[Result]
+			Result of each job, in the same order as the jobs.
+		"""
+		task = partial(run_job, priv_tag_flag=self.priv_tag_flag, policies=self.policies, stream=self.stream)
+		results = []
+		if self._executor is None or len(jobs) <= 1:
+			for job in jobs:
+				results.append(task(job))
+				self.advance()
+			return results
+		chunksize = max(1, len(jobs) // (self.workers * 16))
+		for result in self._executor.map(task, jobs, chunksize=chunksize):
+			results.append(result)
+			self.advance()
+		return results
+
+	def submit(self, job: Job) -> Future:
+		"""Submits a file job, see `run_job()`.
+
+		Without a process pool the job is run right away and a completed future is returned.
+		Progress is not advanced, callers do so when they collect the result.
+		"""
+		task = partial(run_job, priv_tag_flag=self.priv_tag_flag, policies=self.policies, stream=self.stream)
+		if self._executor is None:
+			future = Future()
+			future.set_result(task(job))
+			return future
+		return self._executor.submit(task, job)
+
+	def submit_buffer(self, kind: str, name: str, data: bytes) -> Future:
+		"""Submits an in-memory job, see `run_buffer()`.
+
+		Without a process pool the job is run right away and a completed future is returned.
+		Progress is not advanced, callers do so when they collect the result.
+		"""
+		task = partial(run_buffer, priv_tag_flag=self.priv_tag_flag, policies=self.policies, stream=self.stream)
+		if self._executor is None:
+			future = Future()
+			future.set_result(task(kind, name, data))
+			return future
+		return self._executor.submit(task, kind, name, data)
+
+	def advance(self) -> None:
+		"""Advances progress bar by one job."""
+		self.progress.update()
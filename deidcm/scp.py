@@ -0,0 +1,283 @@
+from __future__ import annotations
+
+import io
+import os
+import re
+import time
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+
+from pydicom import dcmread
+from pydicom.filewriter import write_file_meta_info
+
+try:
+	from pynetdicom import AE
+	from pynetdicom import evt
+	from pynetdicom import build_context
+	from pynetdicom import StoragePresentationContexts
+	from pynetdicom import ALL_TRANSFER_SYNTAXES
+	from pynetdicom.sop_class import Verification
+except ImportError:
+	# only needed to receive instances over DICOM networking
+	AE = None
+
+from deidcm.deidentifier import Deidentifier
+from deidcm.metrics import RunMetrics
+from deidcm.pool import JobRunner
+from deidcm.pool import warm_up
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['StoreSCP', 'parse_destination']
+
+
+# C-STORE statuses, see DICOM PS3.4 Annex B.2.3
+STATUS_SUCCESS = 0x0000
+STATUS_OUT_OF_RESOURCES = 0xA700
+STATUS_CANNOT_UNDERSTAND = 0xC000
+_UID_TAGS = ('StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID')
+# UIDs name the output files, anything else could escape the output directory
+_UID_PATTERN = re.compile(r'[0-9]+(\.[0-9]+)*')
+
+
+def parse_destination(destination: str) -> tuple:
+	"""Splits a destination given as `AE_TITLE@host:port`."""
+	ae_title, _, address = destination.rpartition('@')
+	host, _, port = address.rpartition(':')
+	if not ae_title or not host or not port.isdigit():
+		raise ValueError(f'destination {destination!r} is not of the form AE_TITLE@host:port')
+	return ae_title, host, int(port)
+
+
+def _encode_file(event: evt.Event) -> bytes:
+	"""DICOM file of a received dataset, in memory and without decoding the dataset."""
+	buffer = io.BytesIO()
+	buffer.write(b'\x00' * 128 + b'DICM')
+	write_file_meta_info(buffer, event.file_meta)
+	buffer.write(event.request.DataSet.getvalue())
+	return buffer.getvalue()
+
+
+class StoreSCP:
+	"""Receives instances over DICOM networking and de-identifies them in memory.
+
+	Instances sent with C-STORE are wrapped in a file meta header and handed over as they were
+	received, never decoded into a dataset, to the same in-memory job as archive members, see
+	`run_buffer()`. They thus get the same keep-list, private tag and UID treatment as files of
+	the deidentifier, including byte-for-byte pass-through of encapsulated pixel data. Nothing is
+	written until de-identification is done, so identifying data never touches the disk.
+
+	De-identified instances are written to `{study}/{series}/{instance}.dcm` under the output
+	directory of the deidentifier, named after their de-identified UIDs, and forwarded to another
+	SCP if a destination is given, over one association per incoming association. Instances are
+	acknowledged only once written and forwarded, any failure is reported to the sender in the
+	C-STORE status.
+
+	Each association is handled in a thread of its own, with up to `max_associations` at once.
+	With `workers` > 1 the de-identification itself runs over the process pool of the
+	deidentifier, kept warm for the lifetime of the receiver, and otherwise in the association
+	threads one at a time.
+
+	Attributes
+	----------
+	deidentifier: Deidentifier
+		Deidentifier whose settings, output directory and metrics are used.
+	ae_title: str
+		Application entity title of the receiver.
+	port: int
+		Port to listen on, any free port if 0, in which case it is set to the actual port once started.
+	host: str
+		Address to listen on, all interfaces if empty.
+	forward: tuple | None
+		AE title, host and port of the SCP to forward de-identified instances to.
+	store: bool
+		Whether de-identified instances are written to the output directory.
+	max_associations: int
+		Number of associations handled at once at most.
+
+	Methods
+	-------
+	run()
+		Receives instances until stopped.
+	start()
+		Starts receiving instances in the background.
+	stop()
+		Stops receiving instances.
+	"""
+	def __init__(self, deidentifier: Deidentifier, port: int = 11112, ae_title: str = 'DEIDCM', host: str = '',
+		forward: str | None = None, store: bool = True, max_associations: int = 10) -> None:
+		if AE is None:
+			raise ImportError('receiving instances requires pynetdicom, install it with `pip install deidcm[scp]`')
+		self.deidentifier = deidentifier
+		self.ae_title = ae_title
+		self.port = port
+		self.host = host
+		self.forward = parse_destination(forward) if forward is not None else None
+		self.store = store
+		self.max_associations = max_associations
+		self._forwards = {}
+		self._lock = threading.Lock()
+		self._filter_lock = threading.Lock()
+		self._server = None
+		self._runner = None
+		self._executor = None
+		self._stopped = threading.Event()
+
+	def _application_entity(self) -> AE:
+		ae = AE(ae_title=self.ae_title)
+		ae.maximum_associations = self.max_associations
+		for context in StoragePresentationContexts:
+			ae.add_supported_context(context.abstract_syntax, ALL_TRANSFER_SYNTAXES)
+		ae.add_supported_context(Verification)
+		return ae
+
+	def _filter(self, name: str, data: bytes) -> Result:
+		"""De-identifies a received file, on the process pool if there is one."""
+		if self.deidentifier.workers > 1:
+			return self._runner.submit_buffer('instance', name, data).result()
+		# without a pool, jobs share the UID mapper of this process
+		with self._filter_lock:
+			return self._runner.submit_buffer('instance', name, data).result()
+
+	def _write(self, data: bytes) -> Path:
+		"""Writes a de-identified instance, named after its UIDs, and moves it in place once complete."""
+		header = dcmread(io.BytesIO(data), stop_before_pixels=True, specific_tags=list(_UID_TAGS))
+		study, series, instance = (str(header.get(keyword, 'unknown')) for keyword in _UID_TAGS)
+		for uid in (study, series, instance):
+			if uid != 'unknown' and not _UID_PATTERN.fullmatch(uid):
+				raise ValueError(f'invalid UID {uid!r}')
+		output_root = self.deidentifier._output_root()
+		output_path = output_root / study / series / f'{instance}.dcm'
+		if output_root.resolve() not in output_path.resolve().parents:
+			raise ValueError(f'{output_path} is outside of {output_root}')
+		output_path.parent.mkdir(parents=True, exist_ok=True)
+		descriptor, temp_path = tempfile.mkstemp(dir=output_path.parent, prefix=f'.{output_path.name}.')
+		try:
+			with os.fdopen(descriptor, 'wb') as destination:
+				destination.write(data)
+		except BaseException:
+			os.remove(temp_path)
+			raise
+		os.replace(temp_path, output_path)
+		return output_path
+
+	def _forward_association(self, assoc) -> Association:
+		"""Outgoing association of an incoming one, requesting the contexts accepted for the latter."""
+		with self._lock:
+			forward = self._forwards.get(assoc)
+		if forward is not None and forward.is_established:
+			return forward
+		ae_title, host, port = self.forward
+		ae = AE(ae_title=self.ae_title)
+		ae.requested_contexts = [build_context(context.abstract_syntax, context.transfer_syntax[0])
+			for context in assoc.accepted_contexts if context.abstract_syntax != Verification]
+		forward = ae.associate(host, port, ae_title=ae_title)
+		if not forward.is_established:
+			raise ConnectionError(f'association with {ae_title}@{host}:{port} was not accepted')
+		with self._lock:
+			self._forwards[assoc] = forward
+		return forward
+
+	def _send(self, assoc, data: bytes) -> int:
+		"""Forwards a de-identified instance, returning the status of the destination."""
+		status = self._forward_association(assoc).send_c_store(dcmread(io.BytesIO(data)))
+		return status.Status if 'Status' in status else STATUS_OUT_OF_RESOURCES
+
+	def _on_store(self, event: evt.Event) -> int:
+		"""Handles a C-STORE request."""
+		calling = event.assoc.requestor.ae_title.strip()
+		name = f'{calling}#{event.request.MessageID}'
+		result = self._filter(name, _encode_file(event))
+		with self._lock:
+			self.deidentifier.metrics.merge(calling, result.error is not None, result.timings)
+			self._runner.advance()
+		if result.error is not None:
+			return STATUS_CANNOT_UNDERSTAND
+		try:
+			if self.store:
+				start = time.perf_counter()
+				self._write(result.data)
+				with self._lock:
+					self.deidentifier.metrics.record(calling, 'store', time.perf_counter() - start,
+						bytes_written=len(result.data))
+			if self.forward is not None:
+				status = self._send(event.assoc, result.data)
+				if status != STATUS_SUCCESS:
+					log.error(f'{name} was refused by the destination with status 0x{status:04X}')
+					return status
+		except ValueError as error:
+			log.error(f'refused to store {name}: {error}')
+			return STATUS_CANNOT_UNDERSTAND
+		except (OSError, ConnectionError) as error:
+			log.error(f'failed to store {name}: {error!r}')
+			return STATUS_OUT_OF_RESOURCES
+		return STATUS_SUCCESS
+
+	def _on_close(self, event: evt.Event) -> None:
+		"""Releases the outgoing association of a closed incoming one."""
+		with self._lock:
+			forward = self._forwards.pop(event.assoc, None)
+		if forward is not None and forward.is_established:
+			forward.release()
+
+	def start(self, executor: Executor | None = None) -> None:
+		"""Starts receiving instances in the background.
+
+		Parameters
+		----------
+		executor: Executor | None
+			Worker pool to de-identify on, a pool of `workers` processes of the deidentifier is
+			created and warmed up if not given.
+		"""
+		deidentifier = self.deidentifier
+		deidentifier.metrics = RunMetrics()
+		if self.store:
+			deidentifier._output_root().mkdir(parents=True, exist_ok=True)
+		if executor is None and deidentifier.workers > 1:
+			executor = self._executor = ProcessPoolExecutor(max_workers=deidentifier.workers)
+			for future in [executor.submit(warm_up) for _ in range(deidentifier.workers)]:
+				future.result()
+		self._runner = JobRunner(deidentifier.skip_private_tags, deidentifier.workers, deidentifier.policies,
+			deidentifier.stream, executor=executor).__enter__()
+		handlers = [(evt.EVT_C_STORE, self._on_store), (evt.EVT_RELEASED, self._on_close),
+			(evt.EVT_ABORTED, self._on_close)]
+		self._server = self._application_entity().start_server((self.host, self.port), block=False,
+			evt_handlers=handlers)
+		self.port = self._server.server_address[1]
+		log.info(f'{self.ae_title} listening on port {self.port}'
+			f'{f", forwarding to {self.forward[0]}@{self.forward[1]}:{self.forward[2]}" if self.forward else ""}')
+
+	def stop(self) -> None:
+		"""Stops receiving instances, once the associations in progress are done, and writes out the reports."""
+		self._stopped.set()
+		if self._server is None:
+			return
+		self._server.shutdown()
+		self._server = None
+		with self._lock:
+			forwards, self._forwards = list(self._forwards.values()), {}
+		for forward in forwards:
+			if forward.is_established:
+				forward.release()
+		self._runner.__exit__(None, None, None)
+		if self._executor is not None:
+			self._executor.shutdown()
+		self._runner, self._executor = None, None
+		self.deidentifier._report()
+
+	def run(self, executor: Executor | None = None) -> None:
+		"""Receives instances until stopped, e.g. with `stop()` or a keyboard interrupt."""
+		self._stopped.clear()
+		self.start(executor)
+		try:
+			self._stopped.wait()
+		except KeyboardInterrupt:
+			log.info('stopping receiver')
+		finally:
+			self.stop()
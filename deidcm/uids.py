@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import hmac
+import sqlite3
+import hashlib
+import logging
+from pathlib import Path
+from functools import lru_cache
+
+from pydicom.datadict import DicomDictionary
+from pydicom.dataset import Dataset
+from pydicom.multival import MultiValue
+from pydicom._uid_dict import UID_dictionary
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['UidMapper', 'hash_oneway', 'load_mapper']
+
+
+# root of UIDs derived from 128-bit numbers, see DICOM PS3.5 B.2
+_UUID_ROOT = '2.25.'
+# shortest UID that still gets the UUID root, shorter ones map to a single numeric component
+_MIN_ROOTED_LENGTH = len(_UUID_ROOT) + 8
+# pseudonymous IDs, e.g. directory names, in hex digits
+ID_LENGTH = 16
+# mappings kept in memory per process before the cache starts over
+CACHE_SIZE = 1 << 20
+# UIDs of what rather than which, e.g. SOP classes, transfer syntaxes and implementations, private ones included
+CLASS_UID_TAGS = frozenset(tag for tag, (vr, _, _, _, keyword) in DicomDictionary.items()
+	if vr == 'UI' and ('ClassUID' in keyword or 'TransferSyntaxUID' in keyword))
+# the only file meta UID identifying an instance
+_MEDIA_STORAGE_SOP_INSTANCE_UID = 0x00020003
+
+
+def hash_oneway(somestring: str, key: bytes | None = None) -> str:
+	"""Sha256 hash value, keyed with HMAC if a key is given."""
+	if key is None:
+		h = hashlib.new('sha256')
+		h.update(somestring.encode())
+		return h.hexdigest()
+	return hmac.new(key, somestring.encode(), hashlib.sha256).hexdigest()
+
+
+class UidMapper:
+	"""Replaces UIDs and IDs with pseudonyms derived from a secret key.
+
+	Pseudonyms are keyed SHA-256 hashes of the originals, so the same UID maps to the same
+	pseudonym in every process, batch and run sharing the key, without any coordination. Study,
+	series and instance UIDs, including references to them in sequences and DICOMDIR records,
+	therefore stay consistent across a whole study. Only UIDs identifying instances are replaced:
+	SOP class, transfer syntax and implementation class UIDs are kept even when private, as are
+	all file meta UIDs but the media storage SOP instance UID, and any other well-known UID.
+
+	Pseudonym UIDs have the same length as the originals, so that DICOMDIR record offsets remain
+	valid. They use the `2.25.` root followed by decimal digits of the hash; UIDs shorter than 13
+	characters map to the digits alone. Short UIDs hence carry less entropy, down to about 50 bits
+	for 20 characters.
+
+	Mappings are cached in memory. With a store path every new mapping is also written to a SQLite
+	database, as a lookup table for re-identification by the key holder. Writes are committed per
+	dataset and the database runs in WAL mode, so worker processes can share it.
+
+	Attributes
+	----------
+	key: bytes
+		Secret key of the derivation.
+	store_path: Path | None
+		Path to SQLite mapping store.
+
+	Methods
+	-------
+	map_uid()
+		Pseudonym of a UID.
+	map_id()
+		Pseudonym of an identifier, e.g. a directory name.
+	keeps()
+		Whether UIDs of an element are kept as they are.
+	remap()
+		Replaces UIDs of instances in a dataset in place.
+	lookup()
+		Original UID of a pseudonym, from the store.
+	"""
+	def __init__(self, key: bytes | str, store_path: Path | str | None = None) -> None:
+		self.key = key.encode() if isinstance(key, str) else key
+		self.store_path = Path(store_path) if store_path is not None else None
+		self._cache = {}
+		self._pending = []
+		self._store = None
+
+	def __reduce__(self) -> tuple:
+		# workers rebuild the mapper once per process instead of once per task
+		return load_mapper, (self.key, str(self.store_path) if self.store_path is not None else None)
+
+	def _connect(self) -> sqlite3.Connection:
+		"""Opens the mapping store, creating it if needed."""
+		if self._store is None:
+			# the mapper may be used from several threads, though never at once, see `AsyncDeidentifier`
+			self._store = sqlite3.connect(self.store_path, timeout=60, check_same_thread=False)
+			self._store.execute('PRAGMA journal_mode=WAL')
+			self._store.execute('PRAGMA synchronous=NORMAL')
+			self._store.execute('CREATE TABLE IF NOT EXISTS uids (original TEXT PRIMARY KEY, pseudonym TEXT NOT NULL)')
+			self._store.execute('CREATE INDEX IF NOT EXISTS uids_pseudonym ON uids (pseudonym)')
+		return self._store
+
+	def _derive(self, uid: str) -> str:
+		"""Derives a pseudonym UID of the same length."""
+		digits = str(int(hash_oneway(uid, self.key), 16))
+		if len(uid) < _MIN_ROOTED_LENGTH:
+			return digits[:len(uid)]
+		return _UUID_ROOT + digits[:len(uid) - len(_UUID_ROOT)]
+
+	def map_uid(self, uid: str) -> str:
+		"""Pseudonym of a UID, well-known UIDs are returned as they are."""
+		pseudonym = self._cache.get(uid)
+		if pseudonym is not None:
+			return pseudonym
+		pseudonym = uid if uid in UID_dictionary or not uid else self._derive(uid)
+		if len(self._cache) >= CACHE_SIZE:
+			self._cache.clear()
+		self._cache[uid] = pseudonym
+		if self.store_path is not None and pseudonym != uid:
+			self._pending.append((uid, pseudonym))
+		return pseudonym
+
+	def map_id(self, identifier: str) -> str:
+		"""Pseudonym of an identifier, e.g. a directory name, as hex digits."""
+		return hash_oneway(identifier, self.key)[:ID_LENGTH]
+
+	def keeps(self, tag: int) -> bool:
+		"""Whether UIDs of an element are kept as they are, e.g. SOP classes and transfer syntaxes."""
+		return tag in CLASS_UID_TAGS or (tag >> 16 == 0x0002 and tag != _MEDIA_STORAGE_SOP_INSTANCE_UID)
+
+	def _remap_element(self, dataset: Dataset, elem) -> None:
+		if elem.VR != 'UI' or not elem.value or self.keeps(elem.tag):
+			return
+		if isinstance(elem.value, MultiValue):
+			elem.value = [self.map_uid(str(value)) for value in elem.value]
+		else:
+			elem.value = self.map_uid(str(elem.value))
+
+	def remap(self, header: Dataset) -> None:
+		"""Replaces UIDs of instances in a dataset, its sequences and its file meta in place."""
+		header.walk(self._remap_element)
+		file_meta = getattr(header, 'file_meta', None)
+		if file_meta is not None:
+			file_meta.walk(self._remap_element)
+		self.flush()
+
+	def flush(self) -> None:
+		"""Commits new mappings to the store."""
+		if not self._pending:
+			return
+		store = self._connect()
+		with store:
+			store.executemany('INSERT OR IGNORE INTO uids VALUES (?, ?)', self._pending)
+		self._pending = []
+
+	def lookup(self, pseudonym: str) -> str | None:
+		"""Original UID of a pseudonym, from the store."""
+		if self.store_path is None:
+			return None
+		row = self._connect().execute('SELECT original FROM uids WHERE pseudonym = ?', (pseudonym,)).fetchone()
+		return row[0] if row is not None else None
+
+
+@lru_cache(maxsize=None)
+def load_mapper(key: bytes, store_path: str | None = None) -> UidMapper:
+	"""Shared mapper of a key and store within a process."""
+	return UidMapper(key, store_path)
@@ -1,17 +1,33 @@
 from __future__ import annotations
 
+import io
 import os
 import json
+import mmap
 import shutil
 import logging
 from pathlib import Path
+from typing import BinaryIO
+from typing import Iterator
+from contextlib import contextmanager
 
 from . import package_config_path
 
+try:
+	import fcntl
+except ImportError:
+	# not available on Windows
+	fcntl = None
+
 
 log = logging.getLogger(__name__)
 
 
+COPY_CHUNK_SIZE = 1 << 20
+# ioctl request of Linux to share the extents of one file with another
+FICLONE = 0x40049409
+
+
 def parse_log_config() -> dict:
 	"""Parses logging config."""
 	with open(f'{package_config_path}/logger.json') as handler:
@@ -27,9 +43,22 @@ def clean(path_to_item: Path) -> None:
 		shutil.rmtree(path_to_item)
 
 
-def decompressed_path(compressed_path: Path) -> Path:
-	"""Parses path to decompressed file/dir, assuming compressed path ends with a file with extension."""
-	return Path('.'.join(str(compressed_path).split('\\')[-1].split('.')[:-1]))
+def clone_or_copy(source: Path, destination: Path) -> None:
+	"""Copies a file as a reflink if the filesystem supports it, otherwise as a regular copy.
+
+	A reflink shares the data blocks of the source copy-on-write, so nothing is written until
+	either of the files gets modified. Hard links are deliberately not used, as the copy would
+	then alias the original file.
+	"""
+	if fcntl is not None:
+		try:
+			with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+				fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+			shutil.copystat(source, destination)
+			return
+		except OSError:
+			pass
+	shutil.copy2(source, destination)
 
 
 def parse_tag_config(listname: str) -> list:
@@ -39,20 +68,104 @@ def parse_tag_config(listname: str) -> list:
 	return [line.strip() for line in lines if line[0] != '#']
 
 
-def clean_old_output(input_dir: Path) -> None:
-	"""Removed old output directories."""
-	paths = [Path('deidentified'), Path(f'{input_dir}/deidentified')]
-	for path_to_clean in paths:
-		if path_to_clean.is_dir():
-			shutil.rmtree(path_to_clean)
-			log.info(f'old bundled results removed at: {path_to_clean}')
-
-
-def output_bundler(input_dir: Path) -> None:
-	"""Bundles outputs into a directory and move to input directory."""
-	os.mkdir('deidentified')
-	for item in os.listdir('.'):
-		if '_deidentified' in item:
-			shutil.move(item, 'deidentified')
-	shutil.move('deidentified', input_dir)
-	log.info(f'deidentified data ready at: {input_dir}/deidentified')
+def clean_old_output(output_dir: Path) -> None:
+	"""Removes old output directory."""
+	if Path(output_dir).is_dir():
+		shutil.rmtree(output_dir)
+		log.info(f'old bundled results removed at: {output_dir}')
+
+
+def _copy_fd_range(source_fd: int, destination_fd: int, offset: int, length: int) -> int:
+	"""Copies a byte range between file descriptors with kernel side primitives.
+
+	The range is read from the given source offset and written at the current destination position.
+
+	Returns
+	-------
+	: int
+		Number of bytes copied, which is less than the length if no primitive is available.
+	"""
+	copied = 0
+	for primitive in ('copy_file_range', 'sendfile'):
+		if not hasattr(os, primitive):
+			continue
+		try:
+			while copied < length:
+				if primitive == 'copy_file_range':
+					count = os.copy_file_range(source_fd, destination_fd, length - copied, offset + copied)
+				else:
+					count = os.sendfile(destination_fd, source_fd, offset + copied, length - copied)
+				if count == 0:
+					break
+				copied += count
+		except OSError:
+			continue
+		if copied == length:
+			break
+	return copied
+
+
+@contextmanager
+def _mapped(source: BinaryIO) -> Iterator[memoryview | None]:
+	"""Zero-copy view of the whole source, an in-memory buffer or a memory map of a regular file.
+
+	Yields None if source can be neither.
+	"""
+	if isinstance(source, io.BytesIO):
+		# unlike getbuffer(), getvalue() does not copy a buffer shared with the bytes it was created from
+		with memoryview(source.getvalue()) as view:
+			yield view
+		return
+	try:
+		mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+	except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+		yield None
+		return
+	with mapped, memoryview(mapped) as view:
+		yield view
+
+
+def copy_range(source: BinaryIO, destination: BinaryIO, offset: int, length: int) -> None:
+	"""Copies a byte range from source to the current position of destination.
+
+	Uses `os.copy_file_range` or `os.sendfile` when both are regular files. Otherwise the range
+	is written out as a slice of a memory map of the source file, or of the buffer of an in-memory
+	source, so that it is never materialised as a bytes object. Other sources are copied in chunks.
+
+	Parameters
+	----------
+	source: BinaryIO
+		Seekable file object to copy from.
+	destination: BinaryIO
+		Writable file object.
+	offset: int
+		Start of the range in source.
+	length: int
+		Number of bytes to copy.
+
+	Raises
+	------
+	EOFError
+		If source ends before the range does.
+	"""
+	destination.flush()
+	copied = 0
+	try:
+		copied = _copy_fd_range(source.fileno(), destination.fileno(), offset, length)
+	except (AttributeError, OSError, io.UnsupportedOperation):
+		pass
+	offset, remaining = offset + copied, length - copied
+	with _mapped(source) as view:
+		if view is not None and remaining:
+			if offset + remaining > len(view):
+				raise EOFError(f'source ended {offset + remaining - len(view)} bytes before the end of copied range')
+			with view[offset:offset + remaining] as part:
+				destination.write(part)
+			return
+	source.seek(offset)
+	while remaining:
+		chunk = source.read(min(COPY_CHUNK_SIZE, remaining))
+		if not chunk:
+			raise EOFError(f'source ended {remaining} bytes before the end of copied range')
+		destination.write(chunk)
+		remaining -= len(chunk)
@@ -1,15 +1,13 @@
 from __future__ import annotations
 
-import glob
-import shutil
 import logging
 from pathlib import Path
 from collections import namedtuple
 
-from pydicom.misc import is_dicom
-
-from deidcm.utils import clean
-from deidcm.utils import decompressed_path
+from deidcm.archive import Archive
+from deidcm.archive import ARCHIVE_ERRORS
+from deidcm.classifier import Classifier
+from deidcm.archive import archive_format
 
 
 log = logging.getLogger(__name__)
@@ -34,60 +32,57 @@ class Validator:
 		Whether item is a directory.
 	compressed: bool
 		Whether item is a compressed file.
+	archive_format: str | None
+		Archive format of compressed file.
+	classifier: Classifier
+		DICOM file classifier, shared among validators to reuse its cached verdicts.
 
 	Methods
 	-------
 	check()
 		Evaluates input directory item and creates a namedtuple with its attributes. 
 	"""
-	def __init__(self, item_path: Path) -> None:
+	def __init__(self, item_path: Path, classifier: Classifier | None = None) -> None:
 		self.path = item_path
-		self._decompressed_path = decompressed_path(self.path)
+		self.classifier = classifier if classifier is not None else Classifier()
 		self.dir = False if self.path.is_file() else True
+		self.archive_format = None
 		self.compressed = self._get_compressed()
 
 	def _get_compressed(self) -> bool:
-		"""Checks if item is a compressed file.
-
-		ReadError raised when its not a compressed file.
-		ValueError raised when it does not contain any of the supported extensions.
-		"""
+		"""Checks if item is a compressed file, from its magic bytes and without unpacking it."""
 		if self.dir:
 			return False
-		try:
-			shutil.unpack_archive(self.path)
-			clean(self._decompressed_path)
-			return True
-		except (shutil.ReadError, ValueError):
-			return False
+		self.archive_format = archive_format(self.path)
+		return self.archive_format is not None
 
-	def _check_file_dicom(self, decompressed: bool = False) -> bool:
+	def _check_file_dicom(self) -> bool:
 		"""Checks if file is DICOM."""
-		path_to_file = self.path if not decompressed else self._decompressed_path
-		if is_dicom(path_to_file):
-			return True
-		return False
+		return self.classifier.is_dicom(self.path)
 
-	def _check_dir_dicom(self, decompressed: bool = False) -> bool:
+	def _check_dir_dicom(self) -> bool:
 		"""Checks if directory contains any DICOM."""
-		path_to_dir = self.path if not decompressed else self._decompressed_path
-		for path_to_file in glob.glob(str(path_to_dir) + '**/**', recursive=True):
-			if Path(path_to_file).is_file() and is_dicom(path_to_file):
-				return True
-		return False
+		return self.classifier.has_dicom(self.path)
+
+	def _check_archive_dicom(self) -> tuple:
+		"""Checks if archive contains any DICOM, along with the error of a corrupt archive."""
+		try:
+			return Archive(self.path, self.archive_format).has_dicom(), None
+		except ARCHIVE_ERRORS as error:
+			log.error(f'failed to read {self.path}: {error!r}')
+			return False, repr(error)
 
 	def check(self) -> namedtuple:
-		"""Checks whether input directory item is file vs dir, compressed or not, and is/has valid DICOM data in it."""
-		Item = namedtuple('Item', 'path dir compressed dicom')
+		"""Checks whether input directory item is file vs dir, compressed or not, and is/has valid DICOM data in it.
+
+		Unreadable archives are reported with their error, which is None for all other items.
+		"""
+		Item = namedtuple('Item', 'path dir compressed dicom archive_format error')
+		error = None
 		if not self.dir and not self.compressed:
 			dicom = self._check_file_dicom()
 		if self.dir:
 			dicom = self._check_dir_dicom()
 		if self.compressed:
-			shutil.unpack_archive(self.path)
-			if self._decompressed_path.is_file():
-				dicom = self._check_file_dicom(decompressed=True)
-			else:
-				dicom = self._check_dir_dicom(decompressed=True)
-			clean(self._decompressed_path)
-		return Item(self.path, self.dir, self.compressed, dicom)
+			dicom, error = self._check_archive_dicom()
+		return Item(self.path, self.dir, self.compressed, dicom, self.archive_format, error)
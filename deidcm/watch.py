@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+import time
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+	from watchdog.events import FileSystemEventHandler
+	from watchdog.observers import Observer
+except ImportError:
+	# events are optional, drop folders are polled without them
+	FileSystemEventHandler, Observer = object, None
+
+from deidcm.classifier import walk
+from deidcm.deidentifier import Deidentifier
+from deidcm.metrics import RunMetrics
+from deidcm.pool import warm_up
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = ['WatchService']
+
+
+def _signature(path: Path) -> tuple:
+	"""Number, total size and latest modification time of the files of an item."""
+	if not path.is_dir():
+		stat = path.stat()
+		return 1, stat.st_size, stat.st_mtime_ns
+	count, size, mtime = 0, 0, path.stat().st_mtime_ns
+	for _, _, files in walk(path):
+		for entry in files:
+			stat = entry.stat()
+			count, size, mtime = count + 1, size + stat.st_size, max(mtime, stat.st_mtime_ns)
+	return count, size, mtime
+
+
+class _Events(FileSystemEventHandler):
+	"""Marks top level items touched by file system events and wakes the service up."""
+	def __init__(self, service: WatchService) -> None:
+		self.service = service
+
+	def on_any_event(self, event) -> None:
+		# reads, e.g. by the deidentifier itself, change nothing
+		if event.event_type in ('opened', 'closed_no_write'):
+			return
+		for path in (event.src_path, getattr(event, 'dest_path', '')):
+			if path:
+				self.service._touch(path)
+
+
+class WatchService:
+	"""Watches a drop folder and de-identifies items as soon as they have fully arrived.
+
+	Items dropped into the input directory of the deidentifier are picked up without re-scanning
+	the whole directory: file system events (inotify, FSEvents, ...) flag the items they touch
+	when `watchdog` is installed, and otherwise only the top level listing is polled, along with
+	the contents of items still arriving. When polling, changes deep inside a processed directory
+	are thus only noticed along with a change of its top level entry. An item has arrived once
+	a sentinel file named after it, e.g. `study.zip.done` with `sentinel='.done'`, shows up, or
+	else once its file count, size and modification times have stayed the same for `settle`
+	seconds.
+
+	Arrived items are processed together in batches by the deidentifier, whose worker pool and
+	tag configs are loaded once and kept warm for the lifetime of the service. Processed items
+	are recorded in the incremental cache, so that a restarted service skips them, and an item
+	is processed again whenever it changes. Outputs of items removed from the drop folder, e.g.
+	moved away once ingested, are kept unless `prune_removed` is set.
+
+	Attributes
+	----------
+	deidentifier: Deidentifier
+		Deidentifier processing the items.
+	settle: float
+		Seconds an item must stay unchanged to count as arrived, without a sentinel.
+	sentinel: str | None
+		Suffix of sentinel files marking items as arrived.
+	poll_interval: float
+		Seconds between checks of the drop folder.
+	prune_removed: bool
+		Whether outputs and cache entries of items removed from the drop folder are deleted.
+	events: bool
+		Whether file system events are used.
+
+	Methods
+	-------
+	run()
+		Watches the drop folder until stopped.
+	stop()
+		Stops the service after the current batch.
+	"""
+	def __init__(self, deidentifier: Deidentifier, settle: float = 5.0, sentinel: str | None = None,
+		poll_interval: float = 1.0, prune_removed: bool = False) -> None:
+		self.deidentifier = deidentifier
+		self.settle = settle
+		self.sentinel = sentinel
+		self.poll_interval = poll_interval
+		self.prune_removed = prune_removed
+		self.events = Observer is not None
+		self._root = Path(deidentifier.input_directory).resolve()
+		self._pending = {}
+		self._done = {}
+		self._touched = set()
+		self._lock = threading.Lock()
+		self._wake = threading.Event()
+		self._stopped = threading.Event()
+
+	def _touch(self, path: str) -> None:
+		"""Flags the top level item of a path as changed."""
+		try:
+			parts = Path(path).resolve().relative_to(self._root).parts
+		except ValueError:
+			return
+		if parts:
+			with self._lock:
+				self._touched.add(parts[0])
+			self._wake.set()
+
+	def _top_stat(self, path: Path) -> tuple:
+		stat = path.stat()
+		return stat.st_size, stat.st_mtime_ns
+
+	def _items(self) -> list:
+		"""Current items of the drop folder, leaving out sentinel files."""
+		items = self.deidentifier._items()
+		if self.sentinel:
+			items = [item for item in items if not item.endswith(self.sentinel)]
+		return items
+
+	def _scan(self, items: list) -> None:
+		"""Tracks new and changed items until they have arrived."""
+		with self._lock:
+			touched, self._touched = self._touched, set()
+		now = time.monotonic()
+		for item in items:
+			path = self._root / item
+			try:
+				top = self._top_stat(path)
+				if item in self._done and self._done[item] == top and item not in touched:
+					continue
+				signature = _signature(path)
+			except OSError:
+				# removed or renamed while being looked at
+				continue
+			pending = self._pending.get(item)
+			if pending is None or pending[0] != signature:
+				self._pending[item] = (signature, now, top)
+
+	def _arrived(self) -> list:
+		"""Tracked items which have fully arrived."""
+		now = time.monotonic()
+		arrived = []
+		for item, (signature, since, _) in sorted(self._pending.items()):
+			if self.sentinel:
+				if (self._root / f'{item}{self.sentinel}').exists():
+					arrived.append(item)
+			elif now - since >= self.settle:
+				arrived.append(item)
+		return arrived
+
+	def _process(self, items: list, cache: RunCache) -> None:
+		"""De-identifies a batch of arrived items."""
+		log.info(f'processing {len(items)} arrived items: {", ".join(items)}')
+		self.deidentifier.metrics = RunMetrics()
+		try:
+			staged = self.deidentifier.process_items(items, cache)
+			cache.save()
+			self.deidentifier._report()
+			log.info(f'{len(staged)} items <--- deidentified.')
+		except Exception as error:
+			# e.g. an unreadable archive, retried once the items change again
+			log.exception(f'failed to process {", ".join(items)}: {error!r}')
+		for item in items:
+			_, _, top = self._pending.pop(item)
+			self._done[item] = top
+
+	def _forget_removed(self, items: list, cache: RunCache) -> None:
+		"""Stops tracking items removed from the drop folder, and removes their outputs with `prune_removed`."""
+		present = set(items)
+		for item in set(self._pending) - present:
+			del self._pending[item]
+		for item in set(self._done) - present:
+			del self._done[item]
+		if not self.prune_removed:
+			return
+		removed = set(cache.entries) - present
+		for item in removed:
+			log.info(f'{item} --- removed from input, removing its output')
+			self.deidentifier._remove_outputs(cache.outputs(item))
+			cache.forget(item)
+		if removed:
+			cache.save()
+
+	def _loop(self) -> None:
+		cache = self.deidentifier._open_cache()
+		while not self._stopped.is_set():
+			items = self._items()
+			self._forget_removed(items, cache)
+			self._scan(items)
+			arrived = self._arrived()
+			if arrived:
+				self._process(arrived, cache)
+			self._wake.wait(self.poll_interval)
+			self._wake.clear()
+
+	def run(self, executor: Executor | None = None) -> None:
+		"""Watches the drop folder until stopped, e.g. with `stop()` or a keyboard interrupt.
+
+		Parameters
+		----------
+		executor: Executor | None
+			Worker pool to run jobs on, a pool of `workers` processes of the deidentifier is
+			created and warmed up if not given.
+		"""
+		self.deidentifier._output_root().mkdir(parents=True, exist_ok=True)
+		owns_executor = executor is None and self.deidentifier.workers > 1
+		if owns_executor:
+			executor = ProcessPoolExecutor(max_workers=self.deidentifier.workers)
+			for future in [executor.submit(warm_up) for _ in range(self.deidentifier.workers)]:
+				future.result()
+		self.deidentifier.executor = executor
+		observer = None
+		if self.events:
+			observer = Observer()
+			observer.schedule(_Events(self), str(self._root), recursive=True)
+			observer.start()
+		log.info(f'watching {self._root} for new items, '
+			f'{"with file system events" if observer is not None else f"polling every {self.poll_interval} s"}')
+		try:
+			self._loop()
+		except KeyboardInterrupt:
+			log.info('stopping watch')
+		finally:
+			if observer is not None:
+				observer.stop()
+				observer.join()
+			if owns_executor:
+				executor.shutdown()
+			self.deidentifier.executor = None
+
+	def stop(self) -> None:
+		"""Stops the service after the current batch."""
+		self._stopped.set()
+		self._wake.set()
@@ -1,13 +1,21 @@
 from __future__ import annotations
 
+import os
+import signal
 import argparse
 import logging.config
+import multiprocessing
 
 from gooey import Gooey
 from gooey import GooeyParser
 
 from deidcm.utils import parse_log_config
 from deidcm.deidentifier import Deidentifier
+from deidcm.aio import AsyncDeidentifier
+from deidcm.watch import WatchService
+from deidcm.scp import StoreSCP
+from deidcm.plan import RunPlanner
+from deidcm.plan import load_rates
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~ TEMP FIX ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 # following redirects stdout to stderr
@@ -63,12 +71,74 @@ def generate_gui() -> None:
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
 	#generate_gui()
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--InputDirectory', required=True)
+    parser.add_argument('-i', '--InputDirectory')
     parser.add_argument('-p', '--skip_private_tags', action='store_true')
     parser.add_argument('-o', '--no_bundled_output', action='store_true')
+    parser.add_argument('-d', '--output_directory', type=str,
+        help='write de-identified copies straight into this directory')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+        help='number of worker processes used to de-identify instances')
+    parser.add_argument('-s', '--stream', action='store_true',
+        help='parse headers only and copy pixel data over without loading it')
+    parser.add_argument('-n', '--incremental', action='store_true',
+        help='only process items changed since the previous run, reusing previous outputs')
+    parser.add_argument('--content_hash', action='store_true',
+        help='in incremental mode, also compare file contents to detect changed items')
+    parser.add_argument('-m', '--metrics', type=str,
+        help='write per-stage timings, bytes and instance counts of the run to this JSON file')
+    parser.add_argument('--prometheus', type=str,
+        help='write run metrics in Prometheus text format to this file')
+    parser.add_argument('-k', '--uid_key', type=str, default=os.environ.get('DEIDCM_UID_KEY'),
+        help='secret key to pseudonymise UIDs with, defaults to the DEIDCM_UID_KEY environment variable')
+    parser.add_argument('--uid_store', type=str,
+        help='SQLite file to record UID mappings in, for re-identification by the key holder')
+    parser.add_argument('-z', '--archive_compression', choices=('keep', 'deflate', 'store', 'auto'), default='keep',
+        help='compression of output zip members, auto stores members with compressed pixel data')
+    parser.add_argument('-a', '--concurrency', type=int, default=0,
+        help='overlap up to this many file reads and writes, e.g. for inputs on network file systems')
+    parser.add_argument('--watch', action='store_true',
+        help='keep running and de-identify items as they are dropped into the input directory')
+    parser.add_argument('--settle', type=float, default=5.0,
+        help='in watch mode, seconds an item must stay unchanged to count as fully arrived')
+    parser.add_argument('--sentinel', type=str,
+        help='in watch mode, suffix of files marking items as fully arrived, e.g. .done for study.zip.done')
+    parser.add_argument('--poll_interval', type=float, default=1.0,
+        help='in watch mode, seconds between checks of the input directory')
+    parser.add_argument('--prune_removed', action='store_true',
+        help='in watch mode, delete outputs of items removed from the input directory')
+    parser.add_argument('--listen', type=int, metavar='PORT',
+        help='receive instances with DICOM C-STORE on this port and de-identify them in memory')
+    parser.add_argument('--ae_title', type=str, default='DEIDCM',
+        help='with --listen, application entity title of the receiver')
+    parser.add_argument('--forward', type=str, metavar='AE_TITLE@HOST:PORT',
+        help='with --listen, send de-identified instances on to this SCP instead of writing them out')
+    parser.add_argument('--max_associations', type=int, default=10,
+        help='with --listen, number of associations handled at once')
+    parser.add_argument('--plan', type=str, metavar='PATH',
+        help='only inspect the input and write what a run would do, and roughly how long it would take, as JSON (- for stdout)')
+    parser.add_argument('--plan_rates', type=str, metavar='RESULTS',
+        help='with --plan, estimate runtimes from this output of benchmarks/run_benchmarks.py, run on the target machine')
     args = parser.parse_args()
-
-    Deidentifier.create(args).run()
+    if args.listen is None and not args.InputDirectory:
+        parser.error('an input directory is required unless receiving with --listen')
+    if args.listen is not None and not args.InputDirectory and not args.output_directory and not args.forward:
+        parser.error('--listen needs an output directory, or a destination to --forward to')
+
+    deidentifier = (AsyncDeidentifier if args.concurrency else Deidentifier).create(args)
+    if args.plan:
+        RunPlanner(deidentifier, load_rates(args.plan_rates) if args.plan_rates else None).write(args.plan)
+    elif args.listen is not None:
+        receiver = StoreSCP(deidentifier, args.listen, args.ae_title, forward=args.forward,
+            store=args.forward is None or bool(args.output_directory), max_associations=args.max_associations)
+        signal.signal(signal.SIGTERM, lambda *_: receiver.stop())
+        receiver.run()
+    elif args.watch:
+        service = WatchService(deidentifier, args.settle, args.sentinel, args.poll_interval, args.prune_removed)
+        signal.signal(signal.SIGTERM, lambda *_: service.stop())
+        service.run()
+    else:
+        deidentifier.run()
@@ -1,16 +1,16 @@
-import os
 import json
-import shutil
 import logging.config
 import argparse
-from pathlib import Path
 
 import boto3
-from collections import namedtuple
 
-from deidcm.deidentifier import Deidentifier
 from sfredact import SfRedactor
 from deidcm import package_data_path
+from deidcm.batch import BatchRunner
+from deidcm.batch import load_studies
+from deidcm.manifest import RunManifest
+from deidcm.lease import LeaseStore
+from deidcm.lease import LeasedBatchRunner
 from deidcm.utils import parse_log_config
 
 
@@ -18,70 +18,48 @@ logging.config.dictConfig(parse_log_config())
 log = logging.getLogger(__name__)
 
 
-args = namedtuple('args', 'InputDirectory skip_private_tags no_bundled_output')
-args = args('tmp', False, False)
-deidentifier = Deidentifier.create(args)
+def redact_sf(source: str, destination: str) -> None:
+    SfRedactor(source).redact(destination)
 
-parent = 'tmp/deidentified'
 
-
-def main(in_bucket, out_bucket):
-    with open(package_data_path / 'gore.json', 'r') as f:
-        studies = json.load(f)
-
-
-    log.info(f'this script will process {len(studies)} studies')
-
-    for idx, study in enumerate(studies):
-        log.info(f'processing study - ')
-        log.info(f'DICOM: {study["DICOM"]}')
-        log.info(f'   SF: {study["SF"]}')
-        study_id = study["SF"].split("/")[-1].replace('.pdf', '')
-        log.info(f'study ID = {study_id}')
-        study_id = f'study{idx:03}'
-
-        log.info(f'downloading study...')
-        in_bucket.download_file(study['DICOM'], 'dcm.zip')
-        in_bucket.download_file(study['SF'], 'sf.pdf')
-
-        log.info('unpacking...')
-        if Path('tmp').is_dir():
-            shutil.rmtree('tmp')
-        os.mkdir('tmp')
-        shutil.unpack_archive('dcm.zip', extract_dir='tmp')
-        Path('dcm.zip').unlink()
-
-        log.info('deidentifying DICOM and SF')
-        deidentifier.run()
-        redacted_name = f'{study_id}.pdf'
-        SfRedactor('sf.pdf').redact(redacted_name)
-
-        log.info('packing deidentified study')
-        dirname = [item for item in os.listdir(parent) if '_deidentified' in item][0]
-        shutil.move(f'{parent}/{dirname}', f'{parent}/{study_id}')
-        shutil.make_archive(f'{parent}/{study_id}', 'zip', f'{parent}/{study_id}')
-
-        log.info('uploading...')
-        out_bucket.upload_file(f'{parent}/{study_id}.zip', f'{study_id}.zip')
-        out_bucket.upload_file(redacted_name, redacted_name)
-
-        log.info('cleaning...')
-        shutil.rmtree('tmp')
-        for fname in os.listdir():
-            if fname.endswith('.pdf') or fname.endswith('.zip'):
-                Path(fname).unlink()
-
-        log.info(f'---> done ({idx+1}/{len(studies)})')
+def main(in_bucket, out_bucket, args):
+    studies = load_studies(package_data_path / 'gore.json')
+    kwargs = dict(redactor=redact_sf, workers=args.workers, queue_size=args.queue_size,
+        transfer_concurrency=args.transfer_concurrency, manifest=RunManifest(args.manifest))
+    if not args.lease_store:
+        BatchRunner(in_bucket, out_bucket, args.scratch, **kwargs).run(studies)
+        return
+    store = LeaseStore(args.lease_store, args.lease_seconds, args.max_attempts)
+    if args.coordinate:
+        store.populate(studies)
+        report = store.wait()
+        with open(args.report, 'w') as handler:
+            json.dump(report, handler, indent=2)
+        log.info(f'run report written to {args.report}: {report["states"]}')
+        return
+    LeasedBatchRunner(store, in_bucket, out_bucket, args.scratch, **kwargs).run()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input_bucket', type=str, required=True, help='input s3 bucket name')
     parser.add_argument('-o', '--output_bucket', type=str, required=True, help='output s3 bucket name')
+    parser.add_argument('-s', '--scratch', type=str, default='tmp', help='directory for per-study scratch data')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='processes used to deidentify each study')
+    parser.add_argument('-q', '--queue_size', type=int, default=1, help='studies buffered between stages')
+    parser.add_argument('-c', '--transfer_concurrency', type=int, default=10, help='threads per s3 transfer')
+    parser.add_argument('-m', '--manifest', type=str, default='batch_manifest.jsonl', help='run manifest to resume from')
+    parser.add_argument('-l', '--lease_store', type=str,
+        help='shared SQLite queue of studies, e.g. on a shared file system, to run as one of several workers')
+    parser.add_argument('--coordinate', action='store_true',
+        help='with --lease_store, queue the studies and wait for the workers to finish them')
+    parser.add_argument('--lease_seconds', type=float, default=300.0, help='time a study stays leased without a heartbeat')
+    parser.add_argument('--max_attempts', type=int, default=3, help='times a study is tried before it is given up')
+    parser.add_argument('-r', '--report', type=str, default='batch_report.json', help='run report written by the coordinator')
     args = parser.parse_args()
 
     session = boto3.session.Session(profile_name='default')
     resource = session.resource('s3')
     in_bucket = resource.Bucket(args.input_bucket)
     out_bucket = resource.Bucket(args.output_bucket)
-    main(in_bucket, out_bucket)
+    main(in_bucket, out_bucket, args)
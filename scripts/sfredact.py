@@ -1,12 +1,23 @@
 from __future__ import annotations
 
+import time
+import argparse
+from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
 from dateutil.parser import parse
 
 from fitz import open as openpdf
 from fitz import Page
+from fitz import Rect
+from fitz import TextPage
 from fitz import Document
 
 
+Redaction = namedtuple('Redaction', 'source destination seconds error')
+
+
 class SfRedactor:
     """Redacts Selection/Screening form PDF file for PHI.
 
@@ -99,6 +110,61 @@ class SfRedactor:
         lines = page.get_text('text').split('\n')
         return [line.strip() for line in lines if line]
 
+    @staticmethod
+    def get_text_lines(page: Page, textpage: TextPage | None = None) -> list:
+        """Extracts all lines from page text along with their bounding boxes, in a single extraction.
+
+        Lines are the same as those of `get_lines()`.
+
+        Parameters
+        ----------
+        page: Page
+            Single page parsed document.
+        textpage: TextPage | None
+            Text of the page extracted already, to be reused.
+
+        Returns
+        -------
+        : list[tuple[str, Rect]]
+            All non-empty lines and their bounding boxes.
+        """
+        lines = []
+        for block in page.get_text('dict', textpage=textpage)['blocks']:
+            # image blocks have no lines
+            for line in block.get('lines', []):
+                text = ''.join(span['text'] for span in line['spans'])
+                if text:
+                    lines.append((text.strip(), Rect(line['bbox'])))
+        return lines
+
+    @staticmethod
+    def get_redact_areas(page: Page, lines: list, idx_start: int, idx_end: int, textpage: TextPage | None = None) -> list:
+        """Locates all areas of the page to redact, i.e. every occurrence of the redaction lines.
+
+        The page is searched for each redaction line, ignoring case, so that PHI repeated anywhere
+        else on the page, e.g. within a footer, is redacted as well.
+
+        Parameters
+        ----------
+        page: Page
+            Single page parsed document.
+        lines: list[tuple[str, Rect]]
+            All parsed lines and their bounding boxes, see `get_text_lines()`.
+        idx_start, idx_end: int
+            Start and end indices of lines to be redacted.
+        textpage: TextPage | None
+            Text of the page extracted already, to be searched.
+
+        Returns
+        -------
+        : list[Rect]
+            Areas to redact.
+        """
+        areas = []
+        for text in dict.fromkeys(text for text, _ in lines[idx_start:idx_end+1] if text):
+            areas += page.search_for(text, textpage=textpage)
+        return areas
+
     def get_redact_idxs(self, redact_kwds: list, lines: list) -> tuple:
         """Locates start and end indices of redaction lines.
 
@@ -128,8 +194,9 @@ class SfRedactor:
             if redact_kwd_end in line:
                 idx_end = idx
                 try:
-                    parse(lines[idx])
-                    idx_end = idx+1
+                    if idx+1 < len(lines):
+                        parse(lines[idx+1])
+                        idx_end = idx+1
                 except ValueError:
                     ...
                 break
@@ -138,18 +205,81 @@ class SfRedactor:
     def redact(self, savename: str) -> None:
         """Performs PDF redaction.
 
+        Text of each page is extracted once, to both find and search the redaction lines, and all of
+        its redactions are applied together.
+
         Parameters
         ----------
         savename: str
             Full file name to save the modified PDF file as.
         """
-        for i,page in enumerate(self.sf):
-            lines = self.get_lines(page)
+        for page in self.sf:
+            textpage = page.get_textpage()
+            text_lines = self.get_text_lines(page, textpage)
+            lines = [text for text, _ in text_lines]
             redact_kwds = self.redact_kwds[self.get_sf_version(lines)]
             idx_start, idx_end = self.get_redact_idxs(redact_kwds, lines)
-            for idx in range(idx_start, idx_end+1):
-                if lines[idx]:
-                    areas = page.search_for(lines[idx])
-                    [page.add_redact_annot(area, fill = (0, 0, 0)) for area in areas]
-                    page.apply_redactions()
+            areas = self.get_redact_areas(page, text_lines, idx_start, idx_end, textpage)
+            for area in areas:
+                page.add_redact_annot(area, fill = (0, 0, 0))
+            if areas:
+                page.apply_redactions()
         self.sf.save(savename)
+
+
+def redact_file(source: str, destination: str) -> Redaction:
+    """Redacts a single SF file, timing it and reporting any failure instead of raising it."""
+    start = time.perf_counter()
+    try:
+        SfRedactor(source).redact(destination)
+    except (Exception, SystemExit) as error:
+        # unrecognized versions exit, which must not bring down a whole batch
+        return Redaction(source, destination, time.perf_counter() - start, repr(error))
+    return Redaction(source, destination, time.perf_counter() - start, None)
+
+
+def redact_batch(pairs: list, workers: int = 1) -> list:
+    """Redacts many SF files, optionally over a process pool.
+
+    Parameters
+    ----------
+    pairs: list[tuple[str, str]]
+        Paths to input SF files and to save the redacted copies as.
+    workers: int
+        Number of worker processes, 1 redacts everything in the current process.
+
+    Returns
+    -------
+    : list[Redaction]
+        Paths, redaction time in seconds and error message or None of each file, in the same order.
+    """
+    if workers <= 1 or len(pairs) <= 1:
+        return [redact_file(source, destination) for source, destination in pairs]
+    sources, destinations = zip(*pairs)
+    chunksize = max(1, len(pairs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(redact_file, sources, destinations, chunksize=chunksize))
+
+
+def redact_directory(input_dir: str, output_dir: str, workers: int = 1) -> list:
+    """Redacts all PDF files of a directory into another one, keeping their names, see `redact_batch()`."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    sources = sorted(path for path in Path(input_dir).iterdir() if path.suffix.lower() == '.pdf')
+    return redact_batch([(str(path), str(output_dir / path.name)) for path in sources], workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_dir', type=str, help='directory of SF PDF files')
+    parser.add_argument('output_dir', type=str, help='directory to save redacted copies in')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of worker processes')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    redactions = redact_directory(args.input_dir, args.output_dir, args.workers)
+    for redaction in redactions:
+        status = 'ok' if redaction.error is None else f'failed: {redaction.error}'
+        print(f'{redaction.source}: {redaction.seconds:.3f} s {status}')
+    failed = sum(redaction.error is not None for redaction in redactions)
+    print(f'{len(redactions)} files redacted in {time.perf_counter() - start:.2f} s, {failed} failed')
@@ -10,5 +10,9 @@ setup(
         'boto3>=1.24',
         'PyMuPDF>=1.20'
     ],
+    extras_require={
+        'watch': ['watchdog>=2.1'],
+        'scp': ['pynetdicom>=2.0'],
+    },
     python_requires='>=3.7.10',
 )
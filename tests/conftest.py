@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import sys
+import shutil
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from pydicom.dataset import Dataset
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'benchmarks'))
+
+import corpus
+from deidcm.deidentifier import Deidentifier
+
+
+def make_dataset(study_uid: str | None = None, series_uid: str | None = None, number: int = 1,
+	rows: int = 8) -> Dataset:
+	"""CT-like dataset of the benchmark corpus, with a little pixel data."""
+	return corpus.make_dataset(rows, study_uid=study_uid, series_uid=series_uid, number=number)
+
+
+def write_series(path: Path, count: int) -> list:
+	"""Writes a series of small instances into a directory."""
+	return corpus.write_series(path, count, rows=8)
+
+
+def write_study_archive(path: Path, series: int = 2, count: int = 3) -> Path:
+	"""Zips a study of a few series, along with a non-DICOM report, under a single top level directory."""
+	staging = path.parent / f'{path.name}.staging'
+	for number in range(series):
+		write_series(staging / 'study' / f'exam{number}' / 'images', count)
+	(staging / 'study' / 'report.txt').write_text('non-DICOM file copied over')
+	shutil.make_archive(str(path.with_suffix('')), 'zip', staging)
+	shutil.rmtree(staging)
+	return path
+
+
+def make_deidentifier(input_directory: Path, deidentifier_class: type = Deidentifier, **options) -> Deidentifier:
+	"""Deidentifier of an input directory, with command line options given as keywords."""
+	args = SimpleNamespace(InputDirectory=str(input_directory), skip_private_tags=False, no_bundled_output=False)
+	for name, value in options.items():
+		setattr(args, name, value)
+	return deidentifier_class.create(args)
+
+
+@pytest.fixture
+def dataset():
+	return make_dataset()
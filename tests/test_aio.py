@@ -0,0 +1,44 @@
+import pytest
+from pydicom.fileset import FileSet
+from pydicom.uid import generate_uid
+
+from conftest import make_dataset
+from conftest import make_deidentifier
+from conftest import write_series
+from conftest import write_study_archive
+from deidcm import aio
+from deidcm.aio import AsyncDeidentifier
+from deidcm.deidentifier import Deidentifier
+
+
+def outputs(root):
+	return {str(path.relative_to(root)): path.read_bytes() for path in sorted(root.rglob('*')) if path.is_file()}
+
+
+@pytest.fixture
+def inputs(tmp_path):
+	"""Input directory of a series with a non-DICOM file, a DICOMDIR study, a zipped study and a single instance."""
+	write_series(tmp_path / 'in' / 'series', 3)
+	(tmp_path / 'in' / 'series' / 'notes.txt').write_text('non-DICOM file copied over')
+	fileset = FileSet()
+	study_uid, series_uid = generate_uid(), generate_uid()
+	for number in range(1, 3):
+		fileset.add(make_dataset(study_uid, series_uid, number))
+	fileset.write(tmp_path / 'in' / 'dicomdir')
+	write_study_archive(tmp_path / 'in' / 'study.zip')
+	make_dataset().save_as(tmp_path / 'in' / 'single.dcm', write_like_original=False)
+	return tmp_path / 'in'
+
+
+@pytest.mark.parametrize('stream', (False, True), ids=('buffered', 'streamed'))
+def test_output_is_identical_to_deidentifier(inputs, stream, monkeypatch):
+	make_deidentifier(inputs, output_directory=str(inputs.parent / 'plain'), stream=stream, uid_key='secret').run()
+	if stream:
+		# streamed jobs are handed over by path, their files are never read whole
+		monkeypatch.setattr(aio, '_read_file', None)
+	make_deidentifier(inputs, AsyncDeidentifier, output_directory=str(inputs.parent / 'async'), stream=stream,
+		uid_key='secret', concurrency=4).run()
+
+	plain, concurrent = outputs(inputs.parent / 'plain'), outputs(inputs.parent / 'async')
+	assert len(plain) == 9
+	assert concurrent == plain
@@ -0,0 +1,111 @@
+import io
+import base64
+import shutil
+import zipfile
+import tarfile
+
+import pytest
+from pydicom import dcmread
+
+from conftest import write_series
+from deidcm.archive import Archive
+from deidcm.archive import ARCHIVE_ERRORS
+from deidcm.archive import archive_format
+from deidcm.archive import split_archive_name
+from deidcm.pool import JobRunner
+from deidcm.validation import Validator
+
+
+FORMATS = ('zip', 'tar', 'gztar', 'bztar', 'xztar')
+LARGE_MEMBER = bytes(range(256)) * 8192
+
+
+@pytest.fixture
+def study(tmp_path):
+	"""Study directory of a series, a small and a large non-DICOM file, under a single top level directory."""
+	staging = tmp_path / 'staging'
+	write_series(staging / 'study' / 'exam0' / 'images', 3)
+	(staging / 'study' / 'report.txt').write_text('non-DICOM file copied over')
+	(staging / 'study' / 'viewer.bin').write_bytes(LARGE_MEMBER)
+	return staging
+
+
+def make_archive(study, path, fmt):
+	# no extension, the format is identified from the contents
+	archive_path = shutil.make_archive(str(path), fmt, study)
+	return shutil.move(archive_path, path)
+
+
+def read_members(path, fmt):
+	"""Names and contents of the file members of an archive, in archive order."""
+	if fmt == 'zip':
+		with zipfile.ZipFile(path) as archive:
+			return [(info.filename, archive.read(info)) for info in archive.infolist() if not info.is_dir()]
+	with tarfile.open(path) as archive:
+		return [(info.name, archive.extractfile(info).read()) for info in archive if info.isfile()]
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_format_is_identified_from_magic_bytes(study, tmp_path, fmt):
+	assert archive_format(make_archive(study, tmp_path / 'upload', fmt)) == fmt
+	assert archive_format(study / 'study' / 'report.txt') is None
+	assert archive_format(study) is None
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_round_trip(study, tmp_path, fmt):
+	archive = Archive(make_archive(study, tmp_path / 'upload', fmt))
+	archive.scan()
+	output_path = tmp_path / 'output'
+	with JobRunner(False, total=len(archive.dicom)) as runner:
+		results = archive.deidentify(output_path, runner)
+
+	assert len(results) == 3 and all(result.error is None for result in results)
+	assert archive_format(output_path) == fmt
+	members = dict(read_members(output_path, fmt))
+	renamed = base64.b64encode(b'exam0').decode('ascii')
+	assert sorted(members) == sorted([f'{renamed}/images/IM0000{number}.dcm' for number in (1, 2, 3)]
+		+ ['report.txt', 'viewer.bin'])
+	assert members['report.txt'] == b'non-DICOM file copied over'
+	assert members['viewer.bin'] == LARGE_MEMBER
+	header = dcmread(io.BytesIO(members[f'{renamed}/images/IM00001.dcm']))
+	assert 'PatientName' not in header
+	assert header.PixelData == dcmread(study / 'study' / 'exam0' / 'images' / 'IM00001.dcm').PixelData
+
+
+@pytest.mark.parametrize('compression, compress_type', [('store', zipfile.ZIP_STORED), ('deflate', zipfile.ZIP_DEFLATED)])
+def test_zip_compression(study, tmp_path, compression, compress_type):
+	archive = Archive(make_archive(study, tmp_path / 'upload', 'zip'), compression=compression)
+	archive.scan()
+	with JobRunner(False) as runner:
+		archive.deidentify(tmp_path / 'output.zip', runner)
+
+	with zipfile.ZipFile(tmp_path / 'output.zip') as output:
+		assert {info.compress_type for info in output.infolist() if not info.is_dir()} == {compress_type}
+
+
+@pytest.mark.parametrize('fmt', ('zip', 'gztar'))
+def test_truncated_archive_fails_to_scan(study, tmp_path, fmt):
+	path = make_archive(study, tmp_path / 'upload', fmt)
+	with open(path, 'r+b') as handler:
+		handler.truncate(2000)
+
+	with pytest.raises(ARCHIVE_ERRORS):
+		Archive(path, fmt).scan()
+
+
+def test_truncated_archive_is_reported_by_validator(study, tmp_path):
+	path = make_archive(study, tmp_path / 'upload', 'zip')
+	with open(path, 'r+b') as handler:
+		handler.truncate(2000)
+
+	item = Validator(path).check()
+
+	assert item.compressed and not item.dicom
+	assert item.error.startswith('BadZipFile')
+
+
+def test_split_archive_name():
+	assert split_archive_name('study.tar.gz') == ('study', '.tar.gz')
+	assert split_archive_name('study.ZIP') == ('study', '.ZIP')
+	assert split_archive_name('study.v2.tgz') == ('study.v2', '.tgz')
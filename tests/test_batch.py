@@ -0,0 +1,83 @@
+import json
+import zipfile
+
+import pytest
+from pydicom import dcmread
+
+from conftest import write_study_archive
+from deidcm.batch import BatchRunner
+from deidcm.batch import LocalBucket
+from deidcm.batch import load_studies
+from deidcm.manifest import RunManifest
+
+
+@pytest.fixture
+def batch(tmp_path):
+	"""Input bucket of three zipped studies, the second one truncated, and its gore.json."""
+	(tmp_path / 'in' / 'dicom').mkdir(parents=True)
+	records = []
+	for idx in range(3):
+		write_study_archive(tmp_path / 'in' / 'dicom' / f'{idx}.zip')
+		records.append({'DICOM': f'dicom/{idx}.zip'})
+	broken = tmp_path / 'in' / 'dicom' / '1.zip'
+	broken.write_bytes(broken.read_bytes()[:2000])
+	(tmp_path / 'gore.json').write_text(json.dumps(records))
+	return tmp_path
+
+
+def run(root, manifest=None):
+	runner = BatchRunner(LocalBucket(root / 'in'), LocalBucket(root / 'out'), root / 'scratch', manifest=manifest)
+	return runner, runner.run(load_studies(root / 'gore.json'))
+
+
+def test_pipeline_uploads_deidentified_studies(batch):
+	run(batch)
+
+	assert sorted(path.name for path in (batch / 'out').iterdir()) == ['study000.zip', 'study002.zip']
+	with zipfile.ZipFile(batch / 'out' / 'study000.zip') as archive:
+		names = archive.namelist()
+		instances = [name for name in names if name.endswith('.dcm')]
+		assert len(instances) == 6
+		assert 'report.txt' in names
+		header = dcmread(archive.open(instances[0]))
+	assert 'PatientName' not in header
+	assert not list((batch / 'scratch').iterdir())
+
+
+def test_report_counts_stages_and_failures(batch):
+	_, report = run(batch)
+
+	assert report['studies'] == 3
+	assert report['skipped'] == 0
+	assert report['stages']['download']['studies'] == 3
+	assert report['stages']['deidentify']['studies'] == 2
+	assert report['stages']['upload']['studies'] == 2
+	assert [(failure['study_id'], failure['stage']) for failure in report['failures']] == [('study001', 'deidentify')]
+
+
+def test_rerun_skips_done_studies_and_retries_failed(batch):
+	manifest = RunManifest(batch / 'manifest.jsonl')
+	run(batch, manifest)
+	assert manifest.summary() == {'done': 2, 'failed': 1}
+	assert manifest.studies['study001']['instances']['failed']
+
+	write_study_archive(batch / 'in' / 'dicom' / '1.zip')
+	runner, report = run(batch, RunManifest(batch / 'manifest.jsonl'))
+
+	assert [study.study_id for study in runner.skipped] == ['study000', 'study002']
+	assert report['skipped'] == 2
+	assert report['failures'] == []
+	assert RunManifest(batch / 'manifest.jsonl').summary() == {'done': 3}
+	assert (batch / 'out' / 'study001.zip').is_file()
+
+
+def test_rerun_processes_changed_sources(batch):
+	manifest = RunManifest(batch / 'manifest.jsonl')
+	run(batch, manifest)
+
+	write_study_archive(batch / 'in' / 'dicom' / '0.zip', count=4)
+	runner, _ = run(batch, RunManifest(batch / 'manifest.jsonl'))
+
+	assert [study.study_id for study in runner.skipped] == ['study002']
+	with zipfile.ZipFile(batch / 'out' / 'study000.zip') as archive:
+		assert len([name for name in archive.namelist() if name.endswith('.dcm')]) == 8
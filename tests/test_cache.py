@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from conftest import make_dataset
+from conftest import make_deidentifier
+from conftest import write_series
+from deidcm.cache import CACHE_FILE_NAME
+
+
+@pytest.fixture
+def inputs(tmp_path):
+	"""Input directory of a series and a stand-alone instance."""
+	write_series(tmp_path / 'in' / 'series', 2)
+	make_dataset().save_as(tmp_path / 'in' / 'single.dcm', write_like_original=False)
+	return tmp_path / 'in'
+
+
+def run(inputs, **options):
+	"""Runs an incremental deidentifier, returning the items it processed."""
+	deidentifier = make_deidentifier(inputs, output_directory=str(inputs.parent / 'out'), incremental=True, **options)
+	deidentifier.run()
+	return sorted(deidentifier.metrics.items)
+
+
+def cached(inputs):
+	return sorted(json.loads((inputs.parent / 'out' / CACHE_FILE_NAME).read_text())['items'])
+
+
+def test_unchanged_items_are_skipped(inputs):
+	assert run(inputs) == ['series', 'single.dcm']
+	assert run(inputs) == []
+	assert sorted(path.name for path in (inputs.parent / 'out').iterdir()) == [
+		CACHE_FILE_NAME, 'series_deidentified', 'single_deidentified.dcm']
+
+
+def test_changed_and_new_items_are_processed(inputs):
+	run(inputs)
+	write_series(inputs / 'series', 3)
+	make_dataset().save_as(inputs / 'other.dcm', write_like_original=False)
+
+	assert run(inputs) == ['other.dcm', 'series']
+	assert len(list((inputs.parent / 'out' / 'series_deidentified').glob('*.dcm'))) == 3
+
+
+def test_removed_items_are_pruned(inputs):
+	run(inputs)
+	(inputs / 'single.dcm').unlink()
+
+	assert run(inputs) == []
+	assert cached(inputs) == ['series']
+	assert not (inputs.parent / 'out' / 'single_deidentified.dcm').exists()
+
+
+def test_config_change_invalidates_all_items(inputs):
+	run(inputs)
+
+	assert run(inputs, skip_private_tags=True) == ['series', 'single.dcm']
+	assert run(inputs, skip_private_tags=True) == []
+	assert run(inputs, archive_compression='store') == ['series', 'single.dcm']
+
+
+def test_items_with_failed_files_are_not_cached(inputs):
+	(inputs / 'series' / 'broken.dcm').write_bytes(b'\0' * 128 + b'DICM' + b'\x02\x00\x10\x00UI\xff\xff')
+
+	assert run(inputs) == ['series', 'single.dcm']
+	assert cached(inputs) == ['single.dcm']
+	assert run(inputs) == ['series']
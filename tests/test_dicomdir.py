@@ -0,0 +1,103 @@
+import io
+import struct
+
+from pydicom import dcmread
+from pydicom.filereader import read_dataset
+from pydicom.fileset import FileSet
+from pydicom.uid import ImplicitVRLittleEndian
+from pydicom.uid import generate_uid
+
+from conftest import make_dataset
+from deidcm.dicomdir import DicomDir
+from deidcm.uids import UidMapper
+
+
+OFFSET_TAGS = (0x00041200, 0x00041202, 0x00041400, 0x00041420)
+# as long as the CT image storage and explicit VR little endian UIDs they replace, so records stay in place
+PRIVATE_SOP_CLASS = '1.3.6.1.4.1.9590.100.1.12'
+PRIVATE_TRANSFER_SYNTAX = '1.3.6.1.4.1.9590.51'
+
+
+def write_dicomdir(path):
+	fileset = FileSet()
+	study_uid, series_uid = generate_uid(), generate_uid()
+	for number in range(1, 4):
+		fileset.add(make_dataset(study_uid, series_uid, number))
+	fileset.write(path)
+	return path / 'DICOMDIR'
+
+
+def implicit_vr(dicomdir):
+	"""DICOMDIR converted to implicit VR little endian, as some archives hold them, in a file object."""
+	header = dcmread(dicomdir)
+	header.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+	header.is_implicit_VR = True
+	source = io.BytesIO()
+	header.save_as(source, write_like_original=False)
+	# shorter element headers move the records, so their offsets are looked up and written again
+	meta_length, = struct.unpack_from('<L', source.getbuffer(), 140)
+	source.seek(144 + meta_length)
+	records = read_dataset(source, True, True).DirectoryRecordSequence
+	offsets = {old.seq_item_tell: new.seq_item_tell for old, new in zip(header.DirectoryRecordSequence, records)}
+	for item in [header, *header.DirectoryRecordSequence]:
+		for elem in item:
+			if elem.tag in OFFSET_TAGS and elem.value:
+				elem.value = offsets[elem.value]
+	source = io.BytesIO()
+	header.save_as(source, write_like_original=False)
+	source.seek(0)
+	return source
+
+
+def record_values(header):
+	return [(elem.tag, elem.value) for item in header.DirectoryRecordSequence for elem in item
+		if elem.VR != 'SQ']
+
+
+def test_patched_in_place_as_with_pydicom(tmp_path):
+	dicomdir = write_dicomdir(tmp_path / 'study')
+	patched, rewritten = tmp_path / 'patched', tmp_path / 'rewritten'
+	DicomDir(dicomdir).deidentify(patched)
+	header = dcmread(dicomdir)
+	DicomDir(dicomdir)._redact_tags(header)
+	header.save_as(rewritten)
+
+	assert patched.stat().st_size == dicomdir.stat().st_size
+	assert record_values(dcmread(patched)) == record_values(dcmread(rewritten))
+	patient = dcmread(patched).DirectoryRecordSequence[0]
+	assert patient.PatientName == '00000000'
+	assert patient.PatientID == '000000'
+
+
+def test_implicit_vr_file_object_falls_back_to_pydicom(tmp_path):
+	source = implicit_vr(write_dicomdir(tmp_path / 'study'))
+	output = io.BytesIO()
+
+	DicomDir(source).deidentify(output)
+
+	output.seek(0)
+	patient = dcmread(output).DirectoryRecordSequence[0]
+	assert patient.PatientName == '00000000'
+	assert patient.PatientID == '000000'
+
+
+def test_private_classes_and_transfer_syntaxes_of_records_are_kept(tmp_path):
+	dicomdir = write_dicomdir(tmp_path / 'study')
+	header = dcmread(dicomdir)
+	images = [record for record in header.DirectoryRecordSequence if record.DirectoryRecordType == 'IMAGE']
+	for record in images:
+		record.ReferencedSOPClassUIDInFile = PRIVATE_SOP_CLASS
+		record.ReferencedTransferSyntaxUIDInFile = PRIVATE_TRANSFER_SYNTAX
+	header.save_as(dicomdir)
+	mapper = UidMapper(b'secret')
+
+	for source, output in ((dicomdir, tmp_path / 'patched'), (implicit_vr(dicomdir), io.BytesIO())):
+		DicomDir(source, uids=mapper).deidentify(output)
+
+		if hasattr(output, 'seek'):
+			output.seek(0)
+		records = [record for record in dcmread(output).DirectoryRecordSequence if record.DirectoryRecordType == 'IMAGE']
+		for record, original in zip(records, images):
+			assert record.ReferencedSOPClassUIDInFile == PRIVATE_SOP_CLASS
+			assert record.ReferencedTransferSyntaxUIDInFile == PRIVATE_TRANSFER_SYNTAX
+			assert record.ReferencedSOPInstanceUIDInFile == mapper.map_uid(original.ReferencedSOPInstanceUIDInFile)
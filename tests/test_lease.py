@@ -0,0 +1,78 @@
+import time
+
+from conftest import write_study_archive
+from deidcm.batch import Study
+from deidcm.batch import LocalBucket
+from deidcm.lease import LeaseStore
+from deidcm.lease import LeasedBatchRunner
+
+
+STUDIES = [Study(idx, f'study{idx:03}', f'dicom/{idx}.zip', None) for idx in range(2)]
+
+
+def test_expired_lease_is_handed_out_again(tmp_path):
+	store = LeaseStore(tmp_path / 'leases.db', lease_seconds=0.05)
+	store.populate(STUDIES[:1])
+	assert store.claim('lost').study_id == 'study000'
+	assert store.claim('other') is None
+
+	time.sleep(0.1)
+
+	assert store.claim('other').study_id == 'study000'
+	assert store.report()['states'] == {'leased': 1}
+
+
+def test_heartbeat_keeps_leases(tmp_path):
+	store = LeaseStore(tmp_path / 'leases.db', lease_seconds=0.2)
+	store.populate(STUDIES[:1])
+	study = store.claim('alive')
+	for _ in range(4):
+		time.sleep(0.1)
+		assert store.heartbeat('alive') == 1
+
+	assert store.claim('other') is None
+	store.complete('alive', study)
+	assert store.remaining() == 0
+
+
+def test_study_is_given_up_after_max_attempts(tmp_path):
+	store = LeaseStore(tmp_path / 'leases.db', lease_seconds=0.05, max_attempts=2)
+	store.populate(STUDIES[:1])
+	for worker in ('first', 'second'):
+		assert store.claim(worker) is not None
+		time.sleep(0.1)
+
+	report = store.wait(poll_interval=0.01)
+
+	assert report['states'] == {'failed': 1}
+	assert report['failures'] == [{'study_id': 'study000', 'attempts': 2, 'error': 'lease of second expired'}]
+
+
+def test_populate_keeps_state_of_known_studies(tmp_path):
+	store = LeaseStore(tmp_path / 'leases.db')
+	store.populate(STUDIES)
+	store.complete('worker', store.claim('worker'))
+
+	assert store.populate(STUDIES) == 0
+	assert store.report()['states'] == {'done': 1, 'pending': 1}
+
+
+def test_worker_picks_up_studies_of_a_lost_worker(tmp_path):
+	(tmp_path / 'in' / 'dicom').mkdir(parents=True)
+	for study in STUDIES:
+		write_study_archive(tmp_path / 'in' / study.dicom_key)
+	store = LeaseStore(tmp_path / 'leases.db', lease_seconds=0.5)
+	store.populate(STUDIES)
+	store.claim('lost')
+
+	runner = LeasedBatchRunner(store, LocalBucket(tmp_path / 'in'), LocalBucket(tmp_path / 'out'), tmp_path / 'scratch',
+		worker_id='worker', poll_interval=0.05)
+	worker_report = runner.run()
+
+	assert [study.study_id for study in runner.claimed] == ['study001', 'study000']
+	assert worker_report['failures'] == []
+	report = store.report()
+	assert report['states'] == {'done': 2}
+	assert report['stages']['upload']['studies'] == 2
+	assert sorted(report['workers']) == ['worker']
+	assert sorted(path.name for path in (tmp_path / 'out').iterdir()) == ['study000.zip', 'study001.zip']
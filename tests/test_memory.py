@@ -0,0 +1,34 @@
+import io
+
+from pydicom import dcmread
+
+from conftest import make_dataset
+from deidcm.memory import deidentify_bytes
+from deidcm.memory import deidentify_dataset
+from deidcm.uids import UidMapper
+
+
+def test_dataset_matches_bytes():
+	dataset = make_dataset()
+	source = io.BytesIO()
+	dataset.save_as(source, write_like_original=False)
+
+	edited = deidentify_dataset(dataset)
+	written = dcmread(io.BytesIO(deidentify_bytes(source.getvalue())))
+
+	assert sorted(edited.keys()) == sorted(written.keys())
+	assert 'PatientName' not in edited
+	assert 0x00091010 not in edited
+	assert 'PatientName' in dataset
+
+
+def test_dataset_in_place_with_private_tags_and_uids():
+	dataset = make_dataset()
+	original = dataset.SOPInstanceUID
+	mapper = UidMapper(b'secret')
+
+	edited = deidentify_dataset(dataset, skip_private_tags=True, uids=mapper, in_place=True)
+
+	assert edited is dataset
+	assert 'PatientName' not in dataset
+	assert dataset.SOPInstanceUID == mapper.map_uid(original)
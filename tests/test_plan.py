@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from conftest import make_dataset
+from conftest import make_deidentifier
+from conftest import write_series
+from conftest import write_study_archive
+from deidcm.plan import RunPlanner
+
+
+def snapshot(root):
+	return {str(path.relative_to(root)): (path.stat().st_size, path.stat().st_mtime_ns) for path in root.rglob('*')}
+
+
+@pytest.fixture
+def inputs(tmp_path):
+	"""Input directory of a series, a zipped study, a single instance, a report folder and a truncated archive."""
+	write_series(tmp_path / 'in' / 'series', 3)
+	(tmp_path / 'in' / 'series' / 'notes.txt').write_text('non-DICOM file copied over')
+	write_study_archive(tmp_path / 'in' / 'study.zip')
+	make_dataset().save_as(tmp_path / 'in' / 'single.dcm', write_like_original=False)
+	(tmp_path / 'in' / 'reports').mkdir()
+	(tmp_path / 'in' / 'reports' / 'report.txt').write_text('no DICOM here')
+	broken = tmp_path / 'in' / 'broken.zip'
+	write_study_archive(broken)
+	broken.write_bytes(broken.read_bytes()[:100])
+	return tmp_path / 'in'
+
+
+def plan(inputs, capsys):
+	deidentifier = make_deidentifier(inputs, output_directory=str(inputs.parent / 'out'), incremental=True)
+	RunPlanner(deidentifier).write('-')
+	return json.loads(capsys.readouterr().out)
+
+
+def test_plan_counts_items_and_skip_reasons(inputs, capsys):
+	before = snapshot(inputs.parent)
+
+	result = plan(inputs, capsys)
+
+	assert snapshot(inputs.parent) == before
+	items = result['items']
+	assert sorted(items) == ['broken.zip', 'reports', 'series', 'single.dcm', 'study.zip']
+	assert result['totals']['items'] == 5
+	assert result['totals']['skipped'] == 2
+	assert result['totals']['instances'] == 3 + 6 + 1
+	assert (items['series']['instances'], items['series']['copied']) == (3, 1)
+	assert items['study.zip']['archive_format'] == 'zip'
+	assert items['reports']['reason'] == 'no DICOM data'
+	assert items['broken.zip']['reason'].startswith('unreadable: ')
+
+
+def test_plan_skips_items_unchanged_in_cache(inputs, capsys):
+	make_deidentifier(inputs, output_directory=str(inputs.parent / 'out'), incremental=True).run()
+	make_dataset().save_as(inputs / 'other.dcm', write_like_original=False)
+	before = snapshot(inputs.parent)
+
+	result = plan(inputs, capsys)
+
+	assert snapshot(inputs.parent) == before
+	actions = {item: (entry['action'], entry.get('reason')) for item, entry in result['items'].items()}
+	assert actions['series'] == actions['single.dcm'] == ('skip', 'unchanged since the previous run')
+	assert actions['other.dcm'] == ('deidentify', None)
+	assert result['totals']['instances'] == 1
@@ -0,0 +1,72 @@
+import pytest
+from pydicom.dataset import Dataset
+
+from deidcm.policy import TagPolicy
+from deidcm.policy import load_policy
+
+
+def test_keywords_and_hexadecimal_tags():
+	policy = TagPolicy.compile(['PatientName', '(0028,0030)', '  ', 'NotAKeyword'])
+
+	assert 0x00100010 in policy
+	assert 0x00280030 in policy
+	assert 0x00100020 not in policy
+	assert policy.tags == frozenset({0x00100010, 0x00280030})
+
+
+def test_wildcard_digits():
+	policy = TagPolicy.compile(['(60xx,3000)', '(0019,10XX)'])
+
+	assert 0x60003000 in policy
+	assert 0x60FE3000 in policy
+	assert 0x60003001 not in policy
+	assert 0x001910AB in policy
+	assert 0x00191100 not in policy
+
+
+def test_ranges_are_inclusive_in_either_order():
+	policy = TagPolicy.compile(['(0028,0100)-(0028,0103)', '( 0018 , 0050 ) - (0018,0020)'])
+
+	assert all(tag in policy for tag in (0x00280100, 0x00280102, 0x00280103))
+	assert 0x00280104 not in policy
+	assert 0x00180020 in policy and 0x00180050 in policy
+	assert 0x00180051 not in policy
+
+
+@pytest.mark.parametrize('line', ['(0028,01)', '(0028,0100)-', '(ZZZZ,0100)', '(0009,"")'])
+def test_malformed_lines_raise(line):
+	with pytest.raises(ValueError):
+		TagPolicy.compile([line])
+
+
+def test_private_creator_blocks_are_kept():
+	header = Dataset()
+	header.PatientName = 'DOE^JOHN'
+	header.Modality = 'CT'
+	header.add_new(0x00090010, 'LO', 'ACME')
+	header.add_new(0x00090011, 'LO', 'OTHER')
+	header.add_new(0x00091001, 'LO', 'kept')
+	header.add_new(0x00091101, 'LO', 'removed')
+	header.add_new(0x00111001, 'LO', 'removed')
+
+	TagPolicy.compile(['Modality', '(0009,"ACME")']).filter(header)
+
+	assert sorted(header.keys()) == [0x00080060, 0x00090010, 0x00091001]
+
+
+def test_private_creator_found_in_any_reserved_slot():
+	header = Dataset()
+	header.add_new(0x00090010, 'LO', 'OTHER')
+	header.add_new(0x00090012, 'LO', ' ACME ')
+	header.add_new(0x00091001, 'LO', 'removed')
+	header.add_new(0x000912FF, 'LO', 'kept')
+
+	TagPolicy.compile(['(0009,"ACME")']).filter(header)
+
+	assert sorted(header.keys()) == [0x00090012, 0x000912FF]
+
+
+def test_package_configs_are_compiled_once():
+	assert load_policy('keep') is load_policy('keep')
+	assert 0x7FE00010 in load_policy('keep')
+	assert 0x00100010 in load_policy('redact')
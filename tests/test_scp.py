@@ -0,0 +1,63 @@
+import pytest
+from pydicom import dcmread
+from pydicom.uid import CTImageStorage
+from pydicom.uid import ExplicitVRLittleEndian
+from pydicom.uid import JPEG2000Lossless
+
+pynetdicom = pytest.importorskip('pynetdicom')
+
+from conftest import make_dataset
+from conftest import make_deidentifier
+from deidcm.scp import StoreSCP
+from deidcm.scp import STATUS_CANNOT_UNDERSTAND
+from deidcm.scp import STATUS_SUCCESS
+
+
+@pytest.fixture
+def receiver(tmp_path):
+	"""Receiver listening on a free loopback port, pseudonymising UIDs."""
+	deidentifier = make_deidentifier(tmp_path, output_directory=str(tmp_path / 'out'), uid_key='secret')
+	scp = StoreSCP(deidentifier, port=0, host='127.0.0.1')
+	scp.start()
+	yield scp
+	scp.stop()
+
+
+def send(scp, *datasets):
+	ae = pynetdicom.AE(ae_title='SENDER')
+	for syntax in (ExplicitVRLittleEndian, JPEG2000Lossless):
+		ae.add_requested_context(CTImageStorage, syntax)
+	assoc = ae.associate('127.0.0.1', scp.port, ae_title=scp.ae_title)
+	assert assoc.is_established
+	try:
+		return [assoc.send_c_store(ds).Status for ds in datasets]
+	finally:
+		assoc.release()
+
+
+def test_received_instances_are_stored_deidentified(receiver, tmp_path):
+	sent = make_dataset()
+
+	assert send(receiver, sent) == [STATUS_SUCCESS]
+
+	outputs = list((tmp_path / 'out').rglob('*.dcm'))
+	assert len(outputs) == 1
+	header = dcmread(outputs[0])
+	assert outputs[0] == tmp_path / 'out' / header.StudyInstanceUID / header.SeriesInstanceUID / f'{header.SOPInstanceUID}.dcm'
+	assert header.SOPInstanceUID != sent.SOPInstanceUID
+	assert header.StudyInstanceUID != sent.StudyInstanceUID
+	assert 'PatientName' not in header
+	assert header.PixelData == sent.PixelData
+
+
+def test_instances_failing_deidentification_are_refused(receiver, tmp_path):
+	broken = make_dataset()
+	broken.file_meta.TransferSyntaxUID = JPEG2000Lossless
+	# an empty Basic Offset Table followed by a fragment without its item tag, which can not be walked over
+	broken.PixelData = b'\xfe\xff\x00\xe0' + bytes(12)
+	broken['PixelData'].VR = 'OB'
+	broken['PixelData'].is_undefined_length = True
+
+	assert send(receiver, broken, make_dataset()) == [STATUS_CANNOT_UNDERSTAND, STATUS_SUCCESS]
+	assert len(list((tmp_path / 'out').rglob('*.dcm'))) == 1
+	assert receiver.deidentifier.metrics.items['SENDER']['failed'] == 1
@@ -0,0 +1,57 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+fitz = pytest.importorskip('fitz')
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+
+from corpus import sf_lines
+from sfredact import SfRedactor
+
+
+def phi(version, idx):
+	"""PHI values of a synthetic form, i.e. the values of the lines to redact."""
+	lines = sf_lines(version, idx)
+	start = 1
+	end = lines.index('Case Date:' if version == 'new' else 'Procedure Date:') + 1
+	return [line.partition(': ')[2] or line for line in lines[start:end + 1] if not line.endswith(':')]
+
+
+def write_form(path, version, idx, footer=True):
+	document = fitz.open()
+	page = document.new_page()
+	lines = sf_lines(version, idx)
+	if footer:
+		# PHI repeated elsewhere on the page, in another case and within another line
+		lines = lines + [f'Footer: {lines[2].lower()}', f'Ref {lines[1].upper()} end']
+	for number, line in enumerate(lines):
+		page.insert_text((72, 72 + 20 * number), line)
+	document.save(path)
+	return path
+
+
+@pytest.mark.parametrize('version', ['new', 'old'])
+@pytest.mark.parametrize('idx', range(4))
+def test_no_phi_left(tmp_path, version, idx):
+	source = write_form(tmp_path / 'sf.pdf', version, idx)
+
+	SfRedactor(str(source)).redact(str(tmp_path / 'redacted.pdf'))
+
+	text = fitz.open(tmp_path / 'redacted.pdf')[0].get_text().lower()
+	for value in phi(version, idx):
+		assert value.lower() not in text
+	assert 'physician: smith jane' in text
+	assert 'footer:' in text
+
+
+@pytest.mark.parametrize('version', ['new', 'old'])
+def test_other_lines_are_kept(tmp_path, version):
+	source = write_form(tmp_path / 'sf.pdf', version, 0, footer=False)
+
+	SfRedactor(str(source)).redact(str(tmp_path / 'redacted.pdf'))
+
+	lines = [line.strip() for line in fitz.open(tmp_path / 'redacted.pdf')[0].get_text().split('\n') if line.strip()]
+	assert lines[0] == sf_lines(version, 0)[0]
+	assert lines[-2:] == sf_lines(version, 0)[-2:]
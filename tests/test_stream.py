@@ -0,0 +1,127 @@
+import io
+import os
+
+import pytest
+from pydicom import dcmread
+from pydicom.encaps import encapsulate
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+from pydicom.uid import ExplicitVRBigEndian
+from pydicom.uid import ExplicitVRLittleEndian
+from pydicom.uid import ImplicitVRLittleEndian
+from pydicom.uid import JPEG2000Lossless
+
+from conftest import make_dataset
+from deidcm.instance import Instance
+from deidcm.policy import load_policy
+from deidcm.utils import _copy_fd_range
+from deidcm.utils import copy_range
+
+
+SYNTAXES = (ExplicitVRLittleEndian, ImplicitVRLittleEndian, ExplicitVRBigEndian, JPEG2000Lossless)
+
+
+def write_instance(path, syntax):
+	"""Writes an instance in a transfer syntax, encapsulated ones with random fragments and a Basic Offset Table."""
+	ds = make_dataset(rows=16)
+	ds.file_meta.TransferSyntaxUID = syntax
+	ds.is_little_endian = syntax != ExplicitVRBigEndian
+	ds.is_implicit_VR = syntax == ImplicitVRLittleEndian
+	if syntax == JPEG2000Lossless:
+		ds.NumberOfFrames = 3
+		ds.PixelData = encapsulate([os.urandom(301) for _ in range(3)], has_bot=True)
+		ds['PixelData'].VR = 'OB'
+		ds['PixelData'].is_undefined_length = True
+	ds.save_as(path, write_like_original=False)
+	return path
+
+
+def rewritten(path):
+	"""Instance de-identified on a full read by pydicom."""
+	header = dcmread(path, force=True)
+	Instance.edit(header, load_policy('keep'), False)
+	output = io.BytesIO()
+	header.save_as(output)
+	return output.getvalue()
+
+
+@pytest.mark.parametrize('syntax', SYNTAXES, ids=lambda syntax: syntax.name)
+def test_streamed_output_is_identical_to_full_read(tmp_path, syntax):
+	source = write_instance(tmp_path / 'source.dcm', syntax)
+
+	Instance(source).deidentify(False, False, tmp_path / 'read.dcm')
+	Instance(source).deidentify(False, True, tmp_path / 'streamed.dcm')
+
+	assert (tmp_path / 'streamed.dcm').read_bytes() == (tmp_path / 'read.dcm').read_bytes() == rewritten(source)
+	assert 'PatientName' not in dcmread(tmp_path / 'streamed.dcm')
+
+
+def test_encapsulated_pixel_data_is_copied_over(tmp_path):
+	source = write_instance(tmp_path / 'source.dcm', JPEG2000Lossless)
+
+	Instance(source).deidentify(False, False, tmp_path / 'output.dcm')
+
+	output = dcmread(tmp_path / 'output.dcm')
+	assert output.file_meta.TransferSyntaxUID == JPEG2000Lossless
+	assert output.PixelData == dcmread(source).PixelData
+
+
+@pytest.mark.parametrize('syntax', (ExplicitVRLittleEndian, JPEG2000Lossless), ids=lambda syntax: syntax.name)
+def test_file_objects_and_memory_maps_are_streamed_alike(tmp_path, syntax):
+	source = write_instance(tmp_path / 'source.dcm', syntax)
+	expected = rewritten(source)
+	from_file, from_memory = io.BytesIO(), io.BytesIO()
+
+	# a file object output has no descriptor to copy to, so the source file is memory-mapped
+	Instance(source).deidentify(False, True, from_file)
+	Instance(io.BytesIO(source.read_bytes())).deidentify(False, True, from_memory)
+
+	assert from_file.getvalue() == from_memory.getvalue() == expected
+
+
+def test_deflated_instances_fall_back_to_a_full_read(tmp_path):
+	source = write_instance(tmp_path / 'source.dcm', DeflatedExplicitVRLittleEndian)
+
+	Instance(source).deidentify(False, True, tmp_path / 'streamed.dcm')
+
+	assert (tmp_path / 'streamed.dcm').read_bytes() == rewritten(source)
+
+
+@pytest.mark.parametrize('syntax', (ExplicitVRLittleEndian, JPEG2000Lossless), ids=lambda syntax: syntax.name)
+def test_instance_is_overwritten_in_place(tmp_path, syntax):
+	source = write_instance(tmp_path / 'source.dcm', syntax)
+	expected = rewritten(source)
+
+	Instance(source).deidentify(False, True)
+
+	assert source.read_bytes() == expected
+	assert os.listdir(tmp_path) == ['source.dcm']
+
+
+def test_copy_range_between_files_and_buffers(tmp_path):
+	data = os.urandom(100_000)
+	(tmp_path / 'source').write_bytes(data)
+	with open(tmp_path / 'source', 'rb') as source, open(tmp_path / 'destination', 'wb') as destination:
+		destination.write(b'head')
+		copy_range(source, destination, 1000, 50_000)
+		for source_object in (source, io.BytesIO(data), io.BufferedReader(io.BytesIO(data))):
+			buffer = io.BytesIO()
+			copy_range(source_object, buffer, 1000, 50_000)
+			assert buffer.getvalue() == data[1000:51_000]
+
+	assert (tmp_path / 'destination').read_bytes() == b'head' + data[1000:51_000]
+
+
+def test_copy_range_fails_past_the_end_of_source():
+	for source in (io.BytesIO(b'0123456789'), io.BufferedReader(io.BytesIO(b'0123456789'))):
+		with pytest.raises(EOFError):
+			copy_range(source, io.BytesIO(), 5, 10)
+
+
+def test_kernel_copy_between_descriptors(tmp_path):
+	data = os.urandom(10_000)
+	(tmp_path / 'source').write_bytes(data)
+	with open(tmp_path / 'source', 'rb') as source, open(tmp_path / 'destination', 'wb') as destination:
+		copied = _copy_fd_range(source.fileno(), destination.fileno(), 100, 5000)
+
+	assert copied == 5000
+	assert (tmp_path / 'destination').read_bytes() == data[100:5100]
@@ -0,0 +1,105 @@
+import re
+import pickle
+
+import pytest
+from pydicom.dataset import Dataset
+from pydicom.uid import CTImageStorage
+from pydicom.uid import ExplicitVRLittleEndian
+
+from conftest import make_dataset
+from deidcm.uids import UidMapper
+from deidcm.uids import ID_LENGTH
+
+
+UID_PATTERN = re.compile(r'(0|[1-9][0-9]*)(\.(0|[1-9][0-9]*))*')
+PRIVATE_SOP_CLASS = '1.3.6.1.4.1.9590.100.1.1'
+PRIVATE_TRANSFER_SYNTAX = '1.3.6.1.4.1.9590.5.1'
+PRIVATE_IMPLEMENTATION = '1.3.6.1.4.1.9590.7.2'
+# every length up to the maximum, across the 2.25. root threshold
+UIDS = ['1.2.' + '3' * (length - 4) if length > 4 else '9' * length for length in range(1, 65)]
+
+
+@pytest.mark.parametrize('uid', UIDS)
+def test_pseudonym_keeps_length(uid):
+	pseudonym = UidMapper(b'secret').map_uid(uid)
+
+	assert len(pseudonym) == len(uid)
+	assert pseudonym != uid
+	assert UID_PATTERN.fullmatch(pseudonym)
+
+
+def test_long_uids_get_the_uuid_root():
+	assert UidMapper(b'secret').map_uid('1.2.840.113619.2.55.3').startswith('2.25.')
+	assert '.' not in UidMapper(b'secret').map_uid('1.2.840.1136')
+
+
+def test_pseudonyms_depend_on_key_only():
+	uid = '1.2.840.113619.2.55.3.604688119.971.1258398273.371'
+
+	assert UidMapper(b'secret').map_uid(uid) == UidMapper('secret').map_uid(uid)
+	assert UidMapper(b'secret').map_uid(uid) != UidMapper(b'other').map_uid(uid)
+	assert len(UidMapper(b'secret').map_id('patient01')) == ID_LENGTH
+
+
+def test_well_known_uids_are_kept():
+	mapper = UidMapper(b'secret')
+
+	assert mapper.map_uid(CTImageStorage) == CTImageStorage
+	assert mapper.map_uid(ExplicitVRLittleEndian) == ExplicitVRLittleEndian
+	assert mapper.map_uid('') == ''
+
+
+def test_remap_is_consistent_across_sequences_and_file_meta():
+	mapper = UidMapper(b'secret')
+	header = make_dataset()
+	reference = Dataset()
+	reference.ReferencedSOPClassUID = CTImageStorage
+	reference.ReferencedSOPInstanceUID = header.SOPInstanceUID
+	header.ReferencedImageSequence = [reference]
+	original = header.SOPInstanceUID
+
+	mapper.remap(header)
+
+	assert header.SOPInstanceUID == mapper.map_uid(original) != original
+	assert header.file_meta.MediaStorageSOPInstanceUID == header.SOPInstanceUID
+	assert header.ReferencedImageSequence[0].ReferencedSOPInstanceUID == header.SOPInstanceUID
+	assert header.SOPClassUID == CTImageStorage
+	assert header.file_meta.TransferSyntaxUID == ExplicitVRLittleEndian
+
+
+def test_store_maps_pseudonyms_back(tmp_path):
+	mapper = UidMapper(b'secret', tmp_path / 'uids.db')
+	header = make_dataset()
+	original = header.StudyInstanceUID
+	mapper.remap(header)
+
+	assert UidMapper(b'secret', tmp_path / 'uids.db').lookup(header.StudyInstanceUID) == original
+	assert mapper.lookup('2.25.0') is None
+
+
+def test_pickled_mapper_derives_the_same_pseudonyms():
+	mapper = UidMapper(b'secret')
+	uid = '1.2.840.113619.2.55.3.604688119'
+
+	assert pickle.loads(pickle.dumps(mapper)).map_uid(uid) == mapper.map_uid(uid)
+
+
+def test_private_classes_and_transfer_syntaxes_are_kept():
+	mapper = UidMapper(b'secret')
+	header = make_dataset()
+	header.SOPClassUID = header.file_meta.MediaStorageSOPClassUID = PRIVATE_SOP_CLASS
+	header.file_meta.TransferSyntaxUID = PRIVATE_TRANSFER_SYNTAX
+	header.file_meta.ImplementationClassUID = PRIVATE_IMPLEMENTATION
+	reference = Dataset()
+	reference.ReferencedSOPClassUID = PRIVATE_SOP_CLASS
+	reference.ReferencedSOPInstanceUID = header.SOPInstanceUID
+	header.ReferencedImageSequence = [reference]
+	original = header.SOPInstanceUID
+
+	mapper.remap(header)
+
+	assert header.SOPClassUID == header.file_meta.MediaStorageSOPClassUID == PRIVATE_SOP_CLASS
+	assert header.ReferencedImageSequence[0].ReferencedSOPClassUID == PRIVATE_SOP_CLASS
+	assert header.file_meta.TransferSyntaxUID == PRIVATE_TRANSFER_SYNTAX
+	assert header.file_meta.ImplementationClassUID == PRIVATE_IMPLEMENTATION
+	assert header.file_meta.MediaStorageSOPInstanceUID == header.SOPInstanceUID == mapper.map_uid(original) != original
@@ -0,0 +1,58 @@
+import time
+import shutil
+import threading
+
+import pytest
+
+from conftest import make_deidentifier
+from conftest import write_series
+from deidcm.watch import WatchService
+
+
+def wait_for(condition, timeout=20.0):
+	deadline = time.monotonic() + timeout
+	while not condition():
+		assert time.monotonic() < deadline, 'timed out'
+		time.sleep(0.05)
+
+
+@pytest.fixture
+def service(tmp_path, request):
+	"""Running service on an empty drop folder, with outputs written next to it."""
+	(tmp_path / 'drop').mkdir()
+	deidentifier = make_deidentifier(tmp_path / 'drop', output_directory=str(tmp_path / 'out'), incremental=True)
+	service = WatchService(deidentifier, settle=0.0, poll_interval=0.05, prune_removed=request.param)
+	thread = threading.Thread(target=service.run)
+	thread.start()
+	yield service
+	service.stop()
+	thread.join()
+
+
+def drop_and_remove(service):
+	root = service._root
+	write_series(root.parent / 'staging' / 'series', 2)
+	shutil.move(str(root.parent / 'staging' / 'series'), str(root / 'series'))
+	output = root.parent / 'out' / 'series_deidentified'
+	wait_for(lambda: len(list(output.glob('*.dcm'))) == 2)
+	shutil.rmtree(root / 'series')
+	wait_for(lambda: 'series' not in service._done)
+	# lets a pass over the drop folder finish after the item is forgotten
+	time.sleep(0.2)
+	return output
+
+
+@pytest.mark.parametrize('service', [False], indirect=True)
+def test_outputs_of_removed_items_are_kept(service):
+	output = drop_and_remove(service)
+
+	assert len(list(output.glob('*.dcm'))) == 2
+
+
+@pytest.mark.parametrize('service', [True], indirect=True)
+def test_outputs_of_removed_items_are_pruned_on_request(service):
+	output = drop_and_remove(service)
+
+	wait_for(lambda: not output.exists())
+	cache = service.deidentifier._open_cache()
+	assert 'series' not in cache.entries
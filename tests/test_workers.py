@@ -0,0 +1,26 @@
+from pydicom import dcmread
+
+from conftest import make_dataset
+from conftest import make_deidentifier
+from conftest import write_series
+from conftest import write_study_archive
+
+
+def outputs(root):
+	return {str(path.relative_to(root)): path.read_bytes() for path in sorted(root.rglob('*')) if path.is_file()}
+
+
+def test_worker_pool_output_is_identical_to_a_single_process(tmp_path):
+	write_series(tmp_path / 'in' / 'series', 4)
+	write_study_archive(tmp_path / 'in' / 'study.zip')
+	make_dataset().save_as(tmp_path / 'in' / 'single.dcm', write_like_original=False)
+
+	for workers in (1, 2):
+		make_deidentifier(tmp_path / 'in', output_directory=str(tmp_path / f'out{workers}'), workers=workers,
+			uid_key='secret').run()
+
+	single, pooled = outputs(tmp_path / 'out1'), outputs(tmp_path / 'out2')
+	assert len(single) == 6
+	assert pooled == single
+	header = dcmread(tmp_path / 'out2' / 'single_deidentified.dcm')
+	assert header.SOPInstanceUID != dcmread(tmp_path / 'in' / 'single.dcm').SOPInstanceUID